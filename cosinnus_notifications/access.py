@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+
+from cosinnus.conf import settings
+from cosinnus.models.tagged import BaseTaggableObjectModel, BaseTagObject
+from cosinnus.utils.functions import resolve_attributes
+from cosinnus.utils.group import get_cosinnus_group_model
+from cosinnus.utils.permissions import check_object_read_access,\
+    check_user_superuser, check_user_portal_admin
+from cosinnus.utils.user import is_user_active
+from cosinnus_notifications.utils import LRUCache
+
+
+logger = logging.getLogger('cosinnus')
+
+# group content that is only visible to the group's members (and has no extra read permissions) always has
+# its read access checked only once for all users with the same membership status in the object's group.
+# if True, this is done for all objects in a group, instead of once per user. Only enable this if the portal's
+# read permissions depend on nothing but the group membership, the object's visibility, its creator and 
+# admin status, as a wrongly shared result would expose content in notification mails!
+SHARE_READ_ACCESS_BY_MEMBERSHIP = getattr(settings, 'COSINNUS_NOTIFICATIONS_SHARE_READ_ACCESS_BY_MEMBERSHIP', False)
+# maximum number of memoized read access and state check results kept in memory
+ACCESS_MEMO_SIZE = getattr(settings, 'COSINNUS_NOTIFICATIONS_ACCESS_MEMO_SIZE', 50000)
+
+# membership classes of users in an object's group
+MEMBERSHIP_CLASS_ANONYMOUS = 'anonymous'
+MEMBERSHIP_CLASS_ADMIN = 'admin'
+MEMBERSHIP_CLASS_MEMBER = 'member'
+MEMBERSHIP_CLASS_NONE = 'none'
+
+
+def _get_object_key(obj):
+    return (obj.__class__, obj.pk)
+
+
+class AccessCheckMemo(object):
+    """ Memoizes the read access, actor and state checks done for notification events during a single
+        notification fan-out or digest run, so that they are not repeated for every (user, event) pair.
+
+        For group content that is only visible to the group's members, read access depends only on the user's 
+        membership in the object's group, so for most users the check is only done once per object and 
+        membership class. With `COSINNUS_NOTIFICATIONS_SHARE_READ_ACCESS_BY_MEMBERSHIP`, this is assumed for 
+        all objects in a group. Otherwise, the check is done once per user. Users whose access may depend on 
+        more (superusers, portal admins, the object's creator, objects with extra read permissions) are 
+        checked and memoized individually.
+
+        The results are not invalidated: use a new memo for each run. Not thread-safe. """
+
+    def __init__(self):
+        self.read_access = LRUCache(ACCESS_MEMO_SIZE)
+        self.statechecks = LRUCache(ACCESS_MEMO_SIZE)
+        # actor user id --> bool
+        self.active_actors = {}
+        # group id --> (set of admin ids, set of member ids)
+        self.group_memberships = {}
+
+    def _get_object_group(self, obj):
+        """ Returns the group whose membership determines the read access to an object, or None """
+        group_model = get_cosinnus_group_model()
+        if isinstance(obj, group_model):
+            return obj
+        group = getattr(obj, 'group', None)
+        if isinstance(group, group_model):
+            return group
+        return None
+
+    def _is_membership_only_object(self, obj):
+        """ Checks if the read access to an object is known to depend only on the membership in its group:
+            group content visible to group members only, that doesn't grant any extra read permissions """
+        if not isinstance(obj, BaseTaggableObjectModel):
+            return False
+        media_tag = getattr(obj, 'media_tag', None)
+        if media_tag is None or media_tag.visibility != BaseTagObject.VISIBILITY_GROUP:
+            return False
+        return getattr(type(obj), 'grant_extra_read_permissions', None) is \
+                getattr(BaseTaggableObjectModel, 'grant_extra_read_permissions', None)
+
+    def _get_group_memberships(self, group):
+        memberships = self.group_memberships.get(group.id, None)
+        if memberships is None:
+            # both are resolved from cosinnus' membership cache, or with a single query
+            memberships = (set(group.admins), set(group.members))
+            self.group_memberships[group.id] = memberships
+        return memberships
+
+    def get_read_access_key(self, obj, user):
+        """ Returns the memo key for the read access of a user to an object. Users with the same key are
+            guaranteed to have the same read access to the object. """
+        object_key = _get_object_key(obj)
+        if not user.is_authenticated:
+            return object_key + (MEMBERSHIP_CLASS_ANONYMOUS,)
+        membership_only = self._is_membership_only_object(obj)
+        group = self._get_object_group(obj) if SHARE_READ_ACCESS_BY_MEMBERSHIP or membership_only else None
+        if group is None or (not membership_only and hasattr(obj, 'grant_extra_read_permissions')) or \
+                getattr(obj, 'creator_id', None) == user.id or \
+                check_user_superuser(user) or check_user_portal_admin(user):
+            return object_key + ('user', user.id)
+        admin_ids, member_ids = self._get_group_memberships(group)
+        if user.id in admin_ids:
+            return object_key + (MEMBERSHIP_CLASS_ADMIN,)
+        if user.id in member_ids:
+            return object_key + (MEMBERSHIP_CLASS_MEMBER,)
+        return object_key + (MEMBERSHIP_CLASS_NONE,)
+
+    def check_read_access(self, obj, user):
+        """ Memoized `check_object_read_access(obj, user)` """
+        return self.read_access.get_or_set(self.get_read_access_key(obj, user),
+                                           lambda: check_object_read_access(obj, user))
+
+    def is_actor_active(self, actor):
+        """ Memoized `is_user_active(actor)`, for the user that caused a notification event """
+        if actor is None:
+            return is_user_active(actor)
+        active = self.active_actors.get(actor.id, None)
+        if active is None:
+            active = is_user_active(actor)
+            self.active_actors[actor.id] = active
+        return active
+
+    def check_object_state(self, obj, statecheck, user):
+        """ Memoized `resolve_attributes(obj, statecheck, func_args=[user])`, for a notification's
+            `requires_object_state_check` """
+        return self.statechecks.get_or_set(_get_object_key(obj) + (statecheck, user.id),
+                                           lambda: resolve_attributes(obj, statecheck, func_args=[user]))
+
+    def get_stats(self):
+        return {
+            'read_access_hits': self.read_access.hits,
+            'read_access_misses': self.read_access.misses,
+            'statecheck_hits': self.statechecks.hits,
+            'statecheck_misses': self.statechecks.misses,
+            'active_actors': len(self.active_actors),
+        }
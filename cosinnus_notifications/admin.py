@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 
 from django.contrib import admin
 from cosinnus_notifications.models import UserNotificationPreference, NotificationEvent,\
-    NotificationAlert
+    NotificationAlert, NotificationOutboxEntry, DigestRun, DigestRunRange
 
 
 class UserNotificationPreferenceAdmin(admin.ModelAdmin):
@@ -32,3 +32,27 @@ class NotificationAlertAdmin(admin.ModelAdmin):
 
 admin.site.register(NotificationAlert, NotificationAlertAdmin)
 
+
+
+class NotificationOutboxEntryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'created', 'state', 'attempts', 'claimed_at', 'portal')
+    list_filter = ('state', 'portal',)
+    readonly_fields = ('created', 'claimed_at', 'last_error')
+
+admin.site.register(NotificationOutboxEntry, NotificationOutboxEntryAdmin)
+
+
+class DigestRunRangeInline(admin.TabularInline):
+    model = DigestRunRange
+    extra = 0
+    readonly_fields = ('user_id_start', 'user_id_end', 'state', 'lease_owner', 'lease_expires_at', 'attempts',
+                       'users_emailed', 'total_users', 'completed_at')
+
+
+class DigestRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'portal', 'digest_setting', 'window_start', 'window_end', 'state', 'distributed', 'cohort', 'completed_at')
+    list_filter = ('state', 'distributed', 'digest_setting', 'portal',)
+    readonly_fields = ('created', 'completed_at')
+    inlines = [DigestRunRangeInline]
+
+admin.site.register(DigestRun, DigestRunAdmin)
@@ -2,15 +2,18 @@
 from __future__ import unicode_literals
 
 from cosinnus_notifications.models import NotificationAlert
+from collections import defaultdict
 from datetime import timedelta
 import logging
 
+from django.db import transaction
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
 from cosinnus.conf import settings
 from cosinnus.models.group import CosinnusPortal
 from django.core.cache import cache
+from cosinnus_notifications.preferences import chunked
 
 
 logger = logging.getLogger('cosinnus')
@@ -18,6 +21,13 @@ logger = logging.getLogger('cosinnus')
 
 ALERTS_USER_DATA_CACHE_KEY = 'cosinnus/core/alerts/user/%(user_id)s/data'
 
+# the fields of an existing alert that may be changed by merging a new alert into it
+ALERT_MERGE_UPDATE_FIELDS = ['type', 'last_event_at', 'seen', 'action_user', 'content_type', 'object_id', 
+    'counter', 'target_title', 'target_url', 'label', 'icon_or_image_url', 'subtitle', 'subtitle_icon', 
+    'multi_user_list', 'bundle_list']
+# number of alerts written in one query in `create_user_alerts_bulk()`
+ALERT_BULK_BATCH_SIZE = 500
+
 ALERT_REASONS = {
     'is_group': None, # -- reason will not be shown. the item is a group and is always shown for invitations etc
     'is_creator': _('You are seeing this alert because you created this content.'),
@@ -95,14 +105,122 @@ def create_user_alert(obj, group, receiver, action_user, notification_id, reason
     cache.delete(cache_key)
     
 
-def merge_new_alert_into_multi_alert(new_alert, multi_alert):
+def _find_mergeable_alerts(user_ids, alert_filter, log_message, debug_message):
+    """ Retrieves the existing alerts matching `alert_filter` for all given users with a single query.
+        @return: a dict of {user_id: alert} of users with exactly one mergeable alert. Users with more than one
+            matching alert are left out (just like `create_user_alert()` does not merge for them) """
+    alerts_by_user = defaultdict(list)
+    for user_id_chunk in chunked(user_ids):
+        for existing_alert in NotificationAlert.objects.filter(user_id__in=user_id_chunk, **alert_filter):
+            alerts_by_user[existing_alert.user_id].append(existing_alert)
+    mergeable_alerts = {}
+    for user_id, user_alerts in alerts_by_user.items():
+        if len(user_alerts) > 1:
+            logger.warning(log_message, extra={'alert': str(user_alerts[0])})
+            if settings.DEBUG:
+                raise Exception(debug_message)
+        else:
+            mergeable_alerts[user_id] = user_alerts[0]
+    return mergeable_alerts
+
+
+def create_user_alerts_bulk(obj, group, receivers, action_user, notification_id):
+    """ Creates NotificationAlerts for a NotificationEvent for many receivers at once, with the same
+        results as calling `create_user_alert()` for each of them, but with a constant number of queries:
+            - the object-dependent data of the alert is generated only once
+            - existing alerts to merge into are retrieved with one query (per hash type)
+            - merged alerts are saved with one `bulk_update()`, new alerts with one `bulk_create()`
+            - the alert caches of all receivers are cleared with one `delete_many()`
+        @param group: can be None (for non-group items or groups themselves) 
+        @param receivers: a list of tuples of (receiver, reason_key), with each receiver only appearing once """
+    if not receivers:
+        return
+    # create one preliminary alert to generate the data that is the same for all receivers
+    prototype_alert = NotificationAlert()
+    prototype_alert.initialize(
+        user=receivers[0][0],
+        target_object=obj,
+        group=group,
+        action_user=action_user,
+        notification_id=notification_id
+    )
+    prototype_alert.fill_notification_dependent_data()
+    prototype_alert.generate_label()
+    allowed_type = prototype_alert.get_allowed_type()
+    
+    portal = CosinnusPortal.get_current()
+    user_ids = [receiver.id for receiver, __ in receivers]
+    
+    # Case A: multi user alerts matched by item_hash (see `create_user_alert()`)
+    multi_alerts = {}
+    if allowed_type == NotificationAlert.TYPE_MULTI_USER_ALERT:
+        multi_alerts = _find_mergeable_alerts(user_ids, {
+                'portal': portal,
+                'item_hash': prototype_alert.item_hash,
+                'type__in': [NotificationAlert.TYPE_SINGLE_ALERT, NotificationAlert.TYPE_MULTI_USER_ALERT],
+            }, 'Inconsistency: Trying to match a multi user alert, but had a QS with more than 1 items!',
+            'DEBUG ERROR: Multi alert double inconsistency')
+    # Case B: bundle alerts matched by bundle_hash
+    bundle_alerts = {}
+    if allowed_type == NotificationAlert.TYPE_BUNDLE_ALERT:
+        a_short_time_ago = now() - timedelta(hours=3)
+        bundle_alerts = _find_mergeable_alerts(user_ids, {
+                'portal': portal,
+                'last_event_at__gte': a_short_time_ago,
+                'bundle_hash': prototype_alert.bundle_hash,
+                'type__in': [NotificationAlert.TYPE_SINGLE_ALERT, NotificationAlert.TYPE_BUNDLE_ALERT],
+            }, 'Inconsistency: Trying to match a multi user alert, but had a QS with more than 1 items!',
+            'DEBUG ERROR: Bundle alert double inconsistency')
+    
+    merged_alerts = []
+    new_alerts = []
+    for receiver, reason_key in receivers:
+        alert = NotificationAlert()
+        alert.initialize(
+            user=receiver,
+            target_object=obj,
+            group=group,
+            action_user=action_user,
+            notification_id=notification_id
+        )
+        copy_notification_dependent_data(prototype_alert, alert)
+        alert.reason_key = reason_key
+        
+        if receiver.id in multi_alerts:
+            if merge_new_alert_into_multi_alert(alert, multi_alerts[receiver.id], commit=False, reuse_new_alert_data=True):
+                merged_alerts.append(multi_alerts[receiver.id])
+            continue
+        if receiver.id in bundle_alerts:
+            if merge_new_alert_into_bundle_alert(alert, bundle_alerts[receiver.id], commit=False):
+                merged_alerts.append(bundle_alerts[receiver.id])
+            continue
+        # Case C: save alert as a new alert
+        alert.label = prototype_alert.label
+        new_alerts.append(alert)
+    
+    with transaction.atomic():
+        if merged_alerts:
+            NotificationAlert.objects.bulk_update(merged_alerts, ALERT_MERGE_UPDATE_FIELDS, 
+                                                  batch_size=ALERT_BULK_BATCH_SIZE)
+        if new_alerts:
+            NotificationAlert.objects.bulk_create(new_alerts, batch_size=ALERT_BULK_BATCH_SIZE)
+    
+    # delete user-entry caches to be fresh instantly alerts on refresh
+    cache.delete_many([ALERTS_USER_DATA_CACHE_KEY % {'user_id': user_id} for user_id in user_ids])
+
+
+def merge_new_alert_into_multi_alert(new_alert, multi_alert, commit=True, reuse_new_alert_data=False):
     """ Merges a newly arrived alert into an existing alert as multi alert.
-        The existing alert may yet still be a single alert """
+        The existing alert may yet still be a single alert
+        @param commit: if False, the merged alert is not saved
+        @param reuse_new_alert_data: if True, the notification dependent data already filled into
+            `new_alert` is copied instead of being generated again
+        @return: True if the existing alert was changed """
     # sanity check, cannot convert bundle alerts
     if multi_alert.type not in (NotificationAlert.TYPE_SINGLE_ALERT, NotificationAlert.TYPE_MULTI_USER_ALERT):
         logger.warning('Inconsistency: Trying to create a multi user alert, but matched existing alert was a bundle alert!',
                        extra={'alert': str(multi_alert)})
-        return
+        return False
     
     is_repeat_alert = bool(new_alert.action_user == multi_alert.action_user or \
             any([user_item['user_id'] == new_alert.action_user.id for user_item in multi_alert.multi_user_list]))
@@ -120,7 +238,10 @@ def merge_new_alert_into_multi_alert(new_alert, multi_alert):
     multi_alert.seen = False
     multi_alert.action_user = new_alert.action_user
     multi_alert.target_object = new_alert.target_object
-    multi_alert.fill_notification_dependent_data()
+    if reuse_new_alert_data:
+        copy_notification_dependent_data(new_alert, multi_alert)
+    else:
+        multi_alert.fill_notification_dependent_data()
     multi_alert.generate_label()
     
     # If the new alert's action_user is any of the action_users in the old alert, we only bump this alert to most recent
@@ -131,17 +252,21 @@ def merge_new_alert_into_multi_alert(new_alert, multi_alert):
         multi_alert.counter += 1
         multi_alert.add_new_multi_action_user(new_alert.action_user)
     
-    multi_alert.save()
+    if commit:
+        multi_alert.save()
+    return True
 
 
-def merge_new_alert_into_bundle_alert(new_alert, bundle_alert):
+def merge_new_alert_into_bundle_alert(new_alert, bundle_alert, commit=True):
     """ Merges a newly arrived alert into an existing alert as bundle alert.
-        The existing alert may yet still be a single alert  """
+        The existing alert may yet still be a single alert
+        @param commit: if False, the merged alert is not saved
+        @return: True if the existing alert was changed """
     # sanity check, cannot convert multi alerts
     if bundle_alert.type not in (NotificationAlert.TYPE_SINGLE_ALERT, NotificationAlert.TYPE_BUNDLE_ALERT):
         logger.warning('Inconsistency: Trying to create a bundle alert, but matched existing alert was a multi user alert!',
                        extra={'alert': str(bundle_alert)})
-        return
+        return False
     
     # If the new alert's target_object is any of the bundle objects in the old alert, we only bump this alert to most recent
     # and make it unseen. this is case like users editing items multiple times in a short time frame
@@ -154,8 +279,9 @@ def merge_new_alert_into_bundle_alert(new_alert, bundle_alert):
         bundle_alert.target_title = new_alert.target_title
         bundle_alert.target_url = new_alert.target_url
         bundle_alert.icon_or_image_url = new_alert.icon_or_image_url
-        bundle_alert.save()
-        return
+        if commit:
+            bundle_alert.save()
+        return True
     
     # make the old alert a bundle alert, add the new alert to the bundle and reset it to be current
     if bundle_alert.type == NotificationAlert.TYPE_SINGLE_ALERT:
@@ -168,5 +294,18 @@ def merge_new_alert_into_bundle_alert(new_alert, bundle_alert):
     bundle_alert.target_object = new_alert.target_object
     bundle_alert.add_new_bundle_item(new_alert)
     bundle_alert.generate_label()
-    bundle_alert.save()
+    if commit:
+        bundle_alert.save()
+    return True
+
+
+def copy_notification_dependent_data(source_alert, target_alert):
+    """ Copies the data filled by `NotificationAlert.fill_notification_dependent_data()` from one alert 
+        to another alert for the same target object, action user and group """
+    target_alert.target_title = source_alert.target_title
+    target_alert.target_url = source_alert.target_url
+    target_alert.icon_or_image_url = source_alert.icon_or_image_url
+    if source_alert.group:
+        target_alert.subtitle = source_alert.subtitle
+        target_alert.subtitle_icon = source_alert.subtitle_icon
 
@@ -10,4 +10,5 @@ class CosinnusNotificationsAppConfig(AppConfig):
     def ready(self):
         from cosinnus_notifications import cosinnus_app
         cosinnus_app.register()
+        import cosinnus_notifications.hooks  # noqa
 
@@ -3,15 +3,22 @@ from __future__ import unicode_literals
 from __future__ import print_function
 
 import datetime
+import hashlib
+import itertools
 import logging
 
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist
 from django.urls import reverse
-from django.db.models import Q
+from django.db import connections, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.functions import Mod
 from django.template.loader import render_to_string
 from django.utils import translation, timezone
 from django.utils.html import strip_tags
 from django.utils.encoding import force_text
+from django.utils.dateparse import parse_datetime
 from django.utils.safestring import mark_safe
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
@@ -19,26 +26,73 @@ from django.utils.translation import ugettext_lazy as _
 from cosinnus.conf import settings
 from cosinnus.models.group import CosinnusPortal
 from cosinnus_notifications.models import UserNotificationPreference,\
-    NotificationEvent, UserMultiNotificationPreference
-from cosinnus_notifications.notifications import NO_NOTIFICATIONS_ID,\
-    ALL_NOTIFICATIONS_ID, NOTIFICATION_REASONS,\
+    NotificationEvent, UserMultiNotificationPreference, NotificationEventAudience,\
+    DigestBufferEntry, DigestRun, DigestRunRange, DigestRunRecipient
+from cosinnus_notifications.notifications import ALL_NOTIFICATIONS_ID,\
+    NOTIFICATION_REASONS, MULTI_NOTIFICATION_IDS, DIGEST_BUFFER_ENABLED,\
     render_digest_item_for_notification_event,\
     get_multi_preference_notification_ids, is_notification_multipref,\
-    get_superceded_multi_preferences, get_requires_object_state_check
+    deduplicate_notification_events, get_requires_object_state_check
 from cosinnus.templatetags.cosinnus_tags import full_name, cosinnus_setting
-from cosinnus.core.mail import send_mail_or_fail
-from cosinnus.utils.permissions import check_object_read_access,\
-    check_user_can_receive_emails
+from cosinnus_notifications.preferences import load_digest_preferences, chunked
+from cosinnus_notifications.utils import LRUCache
+from cosinnus_notifications.mail import NotificationMailer, EmailFileWriter,\
+    build_html_mail_message
+from cosinnus_notifications.access import AccessCheckMemo
+from cosinnus_notifications.profiling import DigestRunProfiler,\
+    merge_profile_summaries, write_profile_report
+from cosinnus.utils.permissions import check_user_can_receive_emails
 import traceback
 from django.templatetags.static import static
 from cosinnus.models.profile import GlobalUserNotificationSetting
-from cosinnus.utils.functions import resolve_attributes
 from cosinnus.utils.files import get_image_url_for_icon
-from cosinnus.utils.user import is_user_active
 import copy
+import pytz
+import random
+import six
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 
 logger = logging.getLogger('cosinnus')
 
+# if True, a user's notification events are retrieved via the indexed `NotificationEventAudience` table.
+# only enable this once the `backfill_notification_event_audience` command has been run after migrating,
+# or the digests will be missing all events created before the migration!
+USE_AUDIENCE_INDEX = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_USE_AUDIENCE_INDEX', False)
+
+# relations of notification events and of their target objects that are retrieved along with them for digests
+DIGEST_EVENT_SELECT_RELATED = ('group', 'user__cosinnus_profile')
+DIGEST_TARGET_SELECT_RELATED = ('group', 'creator')
+
+# maximum number of rendered digest items kept in memory during a digest run
+DIGEST_FRAGMENT_CACHE_SIZE = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_FRAGMENT_CACHE_SIZE', 5000)
+# maximum number of rendered digest group blocks kept in memory during a digest run
+DIGEST_GROUP_BLOCK_CACHE_SIZE = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_GROUP_BLOCK_CACHE_SIZE', 1000)
+
+DIGEST_ENGINE_QUERYSETS = 'querysets'
+DIGEST_ENGINE_SINGLE_PASS = 'single_pass'
+# how users' digest events are retrieved:
+# - `DIGEST_ENGINE_QUERYSETS`: with a set of DB queries per user
+# - `DIGEST_ENGINE_SINGLE_PASS`: all events of the digest's time span are loaded once, and mapped to users in memory.
+#     Produces the same digests, but the number of queries no longer grows with the number of users
+DIGEST_ENGINE = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_ENGINE', DIGEST_ENGINE_QUERYSETS)
+
+# number of users fetched from the DB at once while iterating the users of a digest run
+DIGEST_USER_CHUNK_SIZE = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_USER_CHUNK_SIZE', 500)
+# maximum number of rendered digest mails held in memory before they are handed to the mail backend
+DIGEST_MAX_IN_FLIGHT_MAILS = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_MAX_IN_FLIGHT_MAILS', 100)
+# the progress of a digest run is logged every this many users. 0 to disable
+DIGEST_PROGRESS_INTERVAL = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_PROGRESS_INTERVAL', 1000)
+
+# if set to an hour (0-23), digests are delivered staggered by the users' timezones: the digest commands are run
+# hourly, and the users of each timezone get their digest once their local time has reached this hour
+DIGEST_LOCAL_SEND_HOUR = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_LOCAL_SEND_HOUR', None)
+# with staggered digest delivery, the local weekday weekly digests are sent on (0 is Monday)
+DIGEST_LOCAL_SEND_WEEKDAY = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_LOCAL_SEND_WEEKDAY', 0)
+
 # this category header will only be shown if there is at least one other category defined in
 # COSINNUS_NOTIFICATIONS_DIGEST_CATEGORIES
 DEFAULT_DIGEST_CATEGORY = [
@@ -46,289 +100,1168 @@ DEFAULT_DIGEST_CATEGORY = [
 ]
 
 
-def send_digest_for_current_portal(digest_setting, debug_run_for_user=None):
+def send_digest_for_current_portal(digest_setting, debug_run_for_user=None, workers=1, resume=False, report_file=None,
+                                   send_hour=None):
     """ Sends out a daily/weekly digest email to all users *IN THE CURRENT PORTAL*
              who have any notification preferences set to that frequency.
         We will send all events that happened within this
         
         Will not use an own thread because it is assumend that this is run from a management command.
-        TODO: We may want to split up the user-loop into 4 independent threads covering 1/4th of the users each
-              to balance loads better.
+        With `workers` > 1, the users are split up into shards by their id, which are processed in parallel
+        by a pool of worker processes (each with its own DB connection). The time of the last sent digest 
+        is only saved once all shards have completed successfully.
+        
+        The run is recorded as a `DigestRun`, along with each user that has been sent the digest. If the run
+        is interrupted or a shard fails, it can be resumed with `resume`, which only sends the digest to the
+        users that haven't gotten it yet.
+        
+        With a `send_hour`, the digests are delivered staggered by the users' timezones. This is meant to be
+        run hourly: each run only sends the digests of the timezones whose local time has reached the send hour
+        since their last sent digest (see `get_due_digest_cohorts()`). Each timezone has its own time of 
+        the last sent digest. The due timezones that share it are sent together in one `DigestRun`.
     
         @param digest_setting: UserNotificationPreference.SETTING_DAILY or UserNotificationPreference.SETTING_WEEKLY
         @param debug_run_for_user: if set to a User object, this will only generate a test digest for the given user
             and return it as html string. no portal modifications will be made
+        @param workers: number of worker processes to generate the digests in
+        @param resume: if True, the last interrupted run is resumed with its time span, if there is one
+        @param report_file: if given, the timings of the run are also written into this file as JSON report
+        @param send_hour: if given, the local hour (0-23) at which the users of each timezone get their digest
     """
     portal = CosinnusPortal.get_current()
-    portal_group_ids = portal.groups.all().filter(is_active=True).values_list('id', flat=True)
     
-    # read the time for the last sent digest of this time
-    # (its saved as a string, but django QS will auto-box it when filtering on datetime fields)
-    TIME_DIGEST_START = portal.saved_infos.get(CosinnusPortal.SAVED_INFO_LAST_DIGEST_SENT % digest_setting, None)
-    if not TIME_DIGEST_START:
-        TIME_DIGEST_START = now() - datetime.timedelta(days=UserNotificationPreference.SETTINGS_DAYS_DURATIONS[digest_setting])
-    TIME_DIGEST_END = now()
-    
-    # the main Notification Events QS. anything not in here did not happen in the digest's time span
-    timescope_notification_events = NotificationEvent.objects.filter(date__gte=TIME_DIGEST_START, date__lt=TIME_DIGEST_END)
     if debug_run_for_user:
-        users = [debug_run_for_user]
+        TIME_DIGEST_START, TIME_DIGEST_END = get_digest_time_span(portal, digest_setting)
+        return send_digest_for_users(digest_setting, [debug_run_for_user], TIME_DIGEST_START, TIME_DIGEST_END,
+                                     debug_run_for_user=debug_run_for_user)
+    
+    if send_hour is None:
+        result = send_digest_for_cohort(portal, digest_setting, workers=workers, resume=resume)
+        if report_file and result is not None:
+            write_profile_report(report_file, _get_digest_run_profile_report(*result))
+        return
+    
+    # the times of the last sent digests may have been saved by another digest command since the portal was loaded
+    portal.refresh_from_db(fields=['saved_infos'])
+    due_cohorts = get_due_digest_cohorts(portal, digest_setting, send_hour)
+    logger.info('Staggered digests of SETTING=%s in Portal "%s" are due for %d cohorts. Data in extra.' % \
+                (UserNotificationPreference.SETTING_CHOICES[digest_setting][1], portal.slug, len(due_cohorts)),
+                extra={'send_hour': send_hour, 'due_cohorts': dict(due_cohorts)})
+    reports = []
+    for cohort, timezone_names in due_cohorts:
+        result = send_digest_for_cohort(portal, digest_setting, workers=workers, resume=resume, 
+                                        cohort=cohort, timezone_names=timezone_names)
+        if result is not None:
+            reports.append(_get_digest_run_profile_report(*result))
+    if report_file:
+        write_profile_report(report_file, {
+            'digest_setting': digest_setting,
+            'send_hour': send_hour,
+            'cohorts': reports,
+            'profile': merge_profile_summaries([report['profile'] for report in reports]),
+        })
+
+
+def _get_digest_run_profile_report(digest_run, shard_results):
+    return get_digest_profile_report(digest_run.digest_setting, digest_run.window_start, digest_run.window_end,
+                                     shard_results, timezone_names=digest_run.get_timezone_names())
+
+
+def send_digest_for_cohort(portal, digest_setting, workers=1, resume=False, cohort='', timezone_names=None):
+    """ Sends out the digest of a portal in a local `DigestRun`, to all of its users or to the users of a cohort 
+        of timezones. See `send_digest_for_current_portal()`.
+        @param cohort: with staggered digest delivery, the key of the cohort, see `get_due_digest_cohorts()`
+        @param timezone_names: with staggered digest delivery, the timezones whose users are sent their digest
+        @return: a tuple of (digest run, shard results), or None if the run couldn't be started """
+    from cosinnus_notifications.digest_runs import get_node_id, claim_local_digest_run, complete_digest_range,\
+        release_digest_range, DigestRangeLeaseLost
+    digest_run = start_local_digest_run(portal, digest_setting, resume=resume, cohort=cohort, 
+                                        timezone_names=timezone_names)
+    if digest_run is None:
+        return None
+    # the lease on the run is renewed while sending, so that the run can't be resumed by another process meanwhile
+    node_id = get_node_id()
+    digest_range = claim_local_digest_run(digest_run, node_id)
+    if digest_range is None:
+        return None
+    TIME_DIGEST_START, TIME_DIGEST_END = digest_run.window_start, digest_run.window_end
+    
+    users = get_portal_digest_users(portal, digest_run.get_timezone_names())
+    extra_info = {
+        'notification_event_count': NotificationEvent.objects.filter(date__gte=TIME_DIGEST_START, date__lt=TIME_DIGEST_END).count(),
+        'potential_user_count': users.count(), 
+        'workers': workers,
+        'digest_run': str(digest_run),
+        'already_sent_user_count': digest_run.recipients.count(),
+    }
+    logger.info('Now starting to sending out digests of SETTING=%s in Portal "%s". Data in extra.' % \
+                (UserNotificationPreference.SETTING_CHOICES[digest_setting][1], portal.slug), extra=extra_info)
+    if settings.DEBUG:
+        print((">> ", extra_info))
+    
+    if workers > 1:
+        shard_results = _run_digest_shards_in_process_pool(digest_setting, TIME_DIGEST_START, TIME_DIGEST_END, workers,
+                                                           digest_run, digest_range=digest_range, node_id=node_id)
     else:
-        users = get_user_model().objects.all().filter(id__in=portal.members)
-        extra_info = {
-            'notification_event_count': timescope_notification_events.count(),
-            'potential_user_count': users.count(), 
-        }
-        logger.info('Now starting to sending out digests of SETTING=%s in Portal "%s". Data in extra.' % \
-                    (UserNotificationPreference.SETTING_CHOICES[digest_setting][1], portal.slug), extra=extra_info)
-        if settings.DEBUG:
-            print((">> ", extra_info))
+        shard_results = [_send_digest_for_leased_users(digest_setting, users, TIME_DIGEST_START, TIME_DIGEST_END,
+                                                       digest_run, digest_range, node_id)]
     
+    if workers > 1:
+        logger.info('Digest run profile of all shards. Data in extra.', 
+                    extra=merge_profile_summaries([result['profile'] for result in shard_results if result]))
     
-    emailed = 0
-    for user in users:
-        if debug_run_for_user:
-            global_wanted = True
-            multi_prefs = list(UserMultiNotificationPreference.objects.filter(user=user, portal=CosinnusPortal.get_current(), setting=digest_setting)\
-                    .values_list('multi_notification_id', flat=True))
-        else:
-            if getattr(settings, 'COSINNUS_DIGEST_ONLY_FOR_ADMINS', False) and not user.is_superuser:
-                continue
-            if not check_user_can_receive_emails(user):
-                continue
+    failed_shards = [shard for shard, result in enumerate(shard_results) if result is None]
+    if failed_shards:
+        # the digest run stays running, and can be resumed for the users that haven't been sent their digest yet
+        logger.error('Digest generation failed for some user shards. Not saving the time of the last sent digest, the run can be resumed! Data in extra.', 
+                     extra={'failed_shards': failed_shards, 'workers': workers, 'digest_setting': digest_setting, 
+                            'users_emailed': sum([result['users_emailed'] for result in shard_results if result]),
+                            'digest_run': str(digest_run)})
+        release_digest_range(digest_range, node_id)
+        return digest_run, shard_results
+    
+    try:
+        complete_digest_range(digest_range, node_id, {
+            'users_emailed': sum([result['users_emailed'] for result in shard_results]),
+            'total_users': sum([result['total_users'] for result in shard_results]),
+        })
+    except DigestRangeLeaseLost:
+        # another process may have resumed the run after our lease expired, it will complete the run
+        logger.error('Lost the lease on a digest run while sending it, not completing the run. Data in extra.',
+                     extra={'digest_run': str(digest_run), 'node_id': node_id})
+        return digest_run, shard_results
+    digest_run.state = DigestRun.STATE_COMPLETED
+    digest_run.completed_at = now()
+    digest_run.save(update_fields=['state', 'completed_at'])
+    finish_digest(portal, digest_setting, TIME_DIGEST_END, shard_results, digest_run=digest_run)
+    return digest_run, shard_results
+
+
+def render_digests_for_current_portal(digest_setting, output_dir, sample_size=None, sample_seed=0, mbox=False,
+                                      report_file=None):
+    """ Runs the full digest pipeline for the users of the current portal like `send_digest_for_current_portal()`,
+        but writes the digest mails into files instead of sending them. Nothing is saved: neither the time of 
+        the last sent digest, nor a digest run, and the digest buffers are left untouched.
+        Used to inspect, benchmark and diff digest generation, e.g. on a copy of a production DB.
         
-            # get all of user's multi prefs for this digest setting 
-            only_multi_prefs_wanted = False
-            multi_prefs = list(UserMultiNotificationPreference.objects.filter(user=user, portal=CosinnusPortal.get_current(), setting=digest_setting)\
-                    .values_list('multi_notification_id', flat=True))
-            # check global blanket settings
-            global_wanted = False # flag to allow all events
-            global_setting = GlobalUserNotificationSetting.objects.get_for_user(user)
-            
-            # check if global blanketing settings allow for sending this digest to the user
-            if global_setting != digest_setting and global_setting != GlobalUserNotificationSetting.SETTING_GROUP_INDIVIDUAL:
-                if not multi_prefs:
-                    # users who don't have the global setting AND the multi pref setting set to this digest never get an email
-                    continue 
-                else:
-                    # user still has a multi pref setting for this digest_setting, so go on and check
-                    only_multi_prefs_wanted = True 
-            
-            if (digest_setting == UserNotificationPreference.SETTING_DAILY and global_setting == GlobalUserNotificationSetting.SETTING_DAILY) \
-                    or (digest_setting == UserNotificationPreference.SETTING_WEEKLY and global_setting == GlobalUserNotificationSetting.SETTING_WEEKLY):
-                global_wanted = True # user wants ALL events in his digest for this digest setting
+        @param output_dir: the directory the mails are written into, see `EmailFileWriter`
+        @param sample_size: if given, only a random sample of this many of the portal's users is rendered
+        @param sample_seed: the seed for picking the sample, so that the same sample can be rendered again
+        @param mbox: if True, all mails are written into a single mbox file instead of an .eml file each
+        @param report_file: if given, the timings of the run are also written into this file as JSON report
+        @return: a dict of stats: `users_emailed`, `total_users`, `duration_seconds` and the run's `profile` """
+    portal = CosinnusPortal.get_current()
+    time_digest_start, time_digest_end = get_digest_time_span(portal, digest_setting)
+    users = get_user_model().objects.all().filter(id__in=portal.members)
+    if sample_size:
+        user_ids = sorted(users.values_list('id', flat=True))
+        sample_user_ids = random.Random(sample_seed).sample(user_ids, min(sample_size, len(user_ids)))
+        users = users.filter(id__in=sample_user_ids)
+    # a stable order, so that the files of repeated runs can be compared
+    users = users.order_by('id')
+    
+    start_time = time.monotonic()
+    pipeline = DigestPipeline(digest_setting, time_digest_start, time_digest_end)
+    stats = pipeline.run(users, mailer=EmailFileWriter(output_dir, mbox=mbox))
+    stats['duration_seconds'] = time.monotonic() - start_time
+    logger.info('Finished rendering digests of SETTING=%s in Portal "%s" into files. Data in extra.' % \
+                (UserNotificationPreference.SETTING_CHOICES[digest_setting][1], portal.slug), 
+                extra=dict(stats, output_dir=output_dir))
+    if report_file:
+        write_profile_report(report_file, get_digest_profile_report(digest_setting, time_digest_start, 
+                                                                    time_digest_end, [stats]))
+    return stats
+
+
+def get_digest_profile_report(digest_setting, time_digest_start, time_digest_end, shard_results, timezone_names=None):
+    """ Returns the timings of a digest run as JSON-serializable report, with the profile of each shard 
+        and the merged profile of all shards.
+        @param shard_results: a list of the stats dicts returned by `send_digest_for_users()`, 
+            containing None for each failed shard """
+    return {
+        'digest_setting': digest_setting,
+        'timezones': timezone_names or [],
+        'window_start': time_digest_start,
+        'window_end': time_digest_end,
+        'failed_shards': len([result for result in shard_results if result is None]),
+        'shards': [result['profile'] if result else None for result in shard_results],
+        'profile': merge_profile_summaries([result['profile'] for result in shard_results if result]),
+    }
+
+
+def start_local_digest_run(portal, digest_setting, resume=False, cohort='', timezone_names=None):
+    """ Returns the `DigestRun` record for a local (non-distributed) digest run of a portal and digest setting.
+        With `resume`, an interrupted run is continued with its original time span. Otherwise, an interrupted run
+        is abandoned, and a new run is started for the time span since the last sent digest.
+        A running run that is still being sent by another process (see `claim_local_digest_run()`) is 
+        neither resumed nor abandoned.
+        @param cohort: with staggered digest delivery, the key of the cohort of the run's users
+        @param timezone_names: with staggered digest delivery, the timezones of the run's users. A resumed run
+            is extended by any timezones it doesn't cover yet
+        @return: the `DigestRun`, or None if a distributed run is currently running, or the running run is
+            still being sent """
+    from cosinnus_notifications.digest_runs import is_digest_run_leased, create_local_digest_run_range
+    running_runs = DigestRun.objects.filter(portal=portal, digest_setting=digest_setting, state=DigestRun.STATE_RUNNING)
+    distributed_run = running_runs.filter(distributed=True).first()
+    if distributed_run is not None:
+        logger.error('Cannot start a digest run while a distributed digest run is running. Data in extra.',
+                     extra={'digest_run': str(distributed_run)})
+        return None
+    running_run = running_runs.filter(cohort=cohort).first()
+    if running_run is not None:
+        if is_digest_run_leased(running_run):
+            logger.error('Cannot start a digest run while the running one is still being sent by another process. '
+                         'Data in extra.', extra={'digest_run': str(running_run)})
+            return None
+        if resume:
+            logger.info('Resuming an interrupted digest run. Data in extra.', extra={'digest_run': str(running_run)})
+            # timezones that have become due since share the run's time span, so they can join it
+            missing_timezone_names = set(timezone_names or []) - set(running_run.get_timezone_names())
+            if missing_timezone_names:
+                running_run.set_timezone_names(set(running_run.get_timezone_names()) | missing_timezone_names)
+                running_run.save(update_fields=['timezones'])
+            return running_run
+        logger.warning('Abandoning an interrupted digest run. Users that already got its digest will get it again, '
+                       'resume the run to avoid this. Data in extra.', extra={'digest_run': str(running_run)})
+        running_run.state = DigestRun.STATE_ABANDONED
+        running_run.save(update_fields=['state'])
+        running_run.recipients.all().delete()
+    elif resume:
+        logger.info('No interrupted digest run found to resume, starting a new one.')
+    
+    time_digest_start, time_digest_end = get_digest_time_span(portal, digest_setting, timezone_names=timezone_names)
+    with transaction.atomic():
+        digest_run = DigestRun(portal=portal, digest_setting=digest_setting, window_start=time_digest_start,
+                               window_end=time_digest_end, distributed=False, cohort=cohort)
+        digest_run.set_timezone_names(timezone_names or [])
+        digest_run.save()
+        create_local_digest_run_range(digest_run)
+    return digest_run
+
+
+def get_last_digest_sent_key(digest_setting, timezone_name=''):
+    """ Returns the portal's `saved_infos` key for the time of the last sent digest of a digest setting,
+        with staggered digest delivery for a timezone """
+    key = CosinnusPortal.SAVED_INFO_LAST_DIGEST_SENT % digest_setting
+    if timezone_name:
+        key = '%s__%s' % (key, timezone_name)
+    return key
+
+
+def get_last_digest_sent_time(portal, digest_setting, timezone_name=''):
+    """ Returns the time of the last sent digest of a digest setting. A timezone without a digest sent yet
+        continues from the last digest sent to all users.
+        @return: the datetime, or None if no digest has been sent yet """
+    # (its saved as a string, but is parsed, so it can be compared)
+    time_digest_sent = None
+    if timezone_name:
+        time_digest_sent = portal.saved_infos.get(get_last_digest_sent_key(digest_setting, timezone_name), None)
+    if not time_digest_sent:
+        time_digest_sent = portal.saved_infos.get(get_last_digest_sent_key(digest_setting), None)
+    if isinstance(time_digest_sent, six.string_types):
+        time_digest_sent = parse_datetime(time_digest_sent)
+    return time_digest_sent or None
+
+
+def get_digest_time_span(portal, digest_setting, timezone_names=None):
+    """ Returns the time span the next digest of a digest setting covers: from the time of the 
+        last sent digest until now.
+        @param timezone_names: with staggered digest delivery, the timezones the digest is sent to.
+            the time span starts at the earliest of their last sent digests
+        @return: a tuple of (start, end) """
+    # read the time for the last sent digest of this time
+    if timezone_names:
+        sent_times = [get_last_digest_sent_time(portal, digest_setting, timezone_name=timezone_name)
+                      for timezone_name in timezone_names]
+        time_digest_start = None if None in sent_times else min(sent_times)
+    else:
+        time_digest_start = get_last_digest_sent_time(portal, digest_setting)
+    if not time_digest_start:
+        time_digest_start = now() - datetime.timedelta(days=UserNotificationPreference.SETTINGS_DAYS_DURATIONS[digest_setting])
+    return time_digest_start, now()
+
 
-        cur_time_zone = timezone.get_current_timezone()
-        user_time_zone = user.cosinnus_profile.timezone.zone
-        cur_language = translation.get_language()
+def get_portal_digest_users(portal, timezone_names=None):
+    """ Returns the users of a portal that a digest is sent to, with staggered digest delivery only those of 
+        the given timezones. Users without a timezone belong to the portal's default timezone. """
+    users = get_user_model().objects.all().filter(id__in=portal.members)
+    if timezone_names:
+        timezone_filter = Q(cosinnus_profile__timezone__in=list(timezone_names))
+        if settings.TIME_ZONE in timezone_names:
+            timezone_filter |= Q(cosinnus_profile__timezone__isnull=True)
+        users = users.filter(timezone_filter)
+    return users
+
+
+def get_digest_timezones(users):
+    """ Returns the names of all timezones of the given users, sorted. See `get_portal_digest_users()` """
+    timezone_names = set()
+    for user_timezone in users.order_by().values_list('cosinnus_profile__timezone', flat=True).distinct():
+        if user_timezone is None:
+            timezone_names.add(settings.TIME_ZONE)
+        else:
+            # depending on the timezone field, either a timezone or its name
+            timezone_names.add(force_text(getattr(user_timezone, 'zone', user_timezone)))
+    return sorted(timezone_names)
+
+
+def get_scheduled_digest_time(digest_setting, tz, send_hour, current_time=None):
+    """ Returns the time the digest was last scheduled for, for the users of a timezone: the last time 
+        their local time reached `send_hour`, for weekly digests on `DIGEST_LOCAL_SEND_WEEKDAY`.
+        @param tz: the timezone
+        @return: an aware datetime, not after `current_time` """
+    local_time = timezone.localtime(current_time or now(), tz)
+    scheduled_date = local_time.date()
+    if local_time.hour < send_hour:
+        scheduled_date -= datetime.timedelta(days=1)
+    if digest_setting == UserNotificationPreference.SETTING_WEEKLY:
+        scheduled_date -= datetime.timedelta(days=(scheduled_date.weekday() - DIGEST_LOCAL_SEND_WEEKDAY) % 7)
+    return timezone.make_aware(datetime.datetime.combine(scheduled_date, datetime.time(send_hour)), tz, is_dst=False)
+
+
+def get_digest_cohort_key(time_digest_sent):
+    """ Returns the key of the cohort of timezones whose last digest was sent at the given time """
+    return time_digest_sent.isoformat() if time_digest_sent else 'initial'
+
+
+def get_due_digest_cohorts(portal, digest_setting, send_hour, current_time=None):
+    """ Returns the timezones of the portal's users whose digest is due with staggered digest delivery:
+        those whose last sent digest is older than the last time their local time reached `send_hour`.
+        Timezones with an interrupted digest run stay due until the run has been completed.
+        
+        The due timezones are grouped into cohorts of those whose last digest was sent at the same time,
+        which share a time span and are sent in one run. As timezones with the same UTC offset become due 
+        together, there are about as many cohorts as there are offsets, instead of one per timezone.
+        @return: a list of (cohort key, list of timezone names), ordered by key """
+    due_cohorts = defaultdict(list)
+    for timezone_name in get_digest_timezones(get_portal_digest_users(portal)):
         try:
-            # only active users that have logged in before accepted the TOS get notifications
-            if not user.is_active or not user.last_login or not cosinnus_setting(user, 'tos_accepted'):
-                continue
-            
-            # switch language to user's preference language so all i18n and date formats are in their language
-            translation.activate(getattr(user.cosinnus_profile, 'language', settings.LANGUAGES[0][0]))
+            tz = pytz.timezone(timezone_name)
+        except pytz.UnknownTimeZoneError:
+            logger.warning('Skipping staggered digests for users with an unknown timezone. Data in extra.', 
+                           extra={'timezone': timezone_name})
+            continue
+        scheduled_time = get_scheduled_digest_time(digest_setting, tz, send_hour, current_time=current_time)
+        time_digest_sent = get_last_digest_sent_time(portal, digest_setting, timezone_name=timezone_name)
+        if time_digest_sent is None or time_digest_sent < scheduled_time:
+            due_cohorts[get_digest_cohort_key(time_digest_sent)].append(timezone_name)
+    return sorted(due_cohorts.items())
 
-            # switch time zone to user's preference time zone so all time formats are in their time zones
-            timezone.activate(user_time_zone)
-            
-            # get all notification events where the user is in the intended audience
-            events = timescope_notification_events.filter(audience__contains=',%d,' % user.id)
-            
-            # if we have a blanket YES for this digest, filter events only by portal affiliance,
-            # otherwise filter events by group notification settings
-            if global_wanted:
-                events = events.filter(group_id__in=portal_group_ids)
-            elif only_multi_prefs_wanted:
-                # set the regular group events to none; mix in multi pref events later
-                events = NotificationEvent.objects.none()
-            else:
-                # these groups will never get digest notifications because they have a blanketing NONE setting or 
-                # ALL setting (of anything but this ``digest_setting``)
-                # (they may still have individual preferences in the DB, which are ignored because of the blanket setting)
-                unwanted_digest_settings = [key for key in list(dict(UserNotificationPreference.SETTING_CHOICES).keys()) if key != digest_setting]
-                exclude_digest_groups = UserNotificationPreference.objects.filter(user=user, group_id__in=portal_group_ids) 
-                exclude_digest_groups = exclude_digest_groups.filter(Q(notification_id=ALL_NOTIFICATIONS_ID, setting__in=unwanted_digest_settings) | Q(notification_id=NO_NOTIFICATIONS_ID))
-                exclude_digest_groups = exclude_digest_groups.values_list('group_id', flat=True)  
-                
-                # find out any notification preferences the user has for groups in this portal with the daily/weekly setting
-                # if he doesn't have any, we will not send a mail for them
-                prefs = UserNotificationPreference.objects.filter(user=user, group_id__in=portal_group_ids, setting=digest_setting)
-                prefs = prefs.exclude(notification_id=NO_NOTIFICATIONS_ID).exclude(group_id__in=exclude_digest_groups)
-                
-                if len(prefs) == 0:
-                    continue
-                
-                # only for these groups does the user get any digest news at all
-                pref_group_ids = list(set([pref.group for pref in prefs]))
-                # so filter for these groups
-                events = events.filter(group_id__in=pref_group_ids)
-                
-            # add multi pref events that the user wants to see to regular events
-            if multi_prefs:
-                multi_pref_notification_ids = []
-                for multi_pref in multi_prefs:
-                    multi_pref_notification_ids.extend(get_multi_preference_notification_ids(multi_pref))
-                # filter all notification events to fit multi prefs andbe in the current portal
-                multi_pref_events = timescope_notification_events.filter(
-                    notification_id__in=multi_pref_notification_ids,
-                    group_id__in=portal_group_ids
-                )
-                events = events | multi_pref_events
-                
-            if events.count() == 0:
-                continue
-            
-            if not global_wanted and not only_multi_prefs_wanted:
-                # collect a comparable hash for all wanted user prefs
-                wanted_group_notifications = ['%(group_id)d__%(notification_id)s' % {
-                    'group_id': pref.group_id,
-                    'notification_id': pref.notification_id,
-                } for pref in prefs]
-            
-            # cluster event messages by categories and then by group. 
-            # from here on, the user will almost definitely get an email.
-            categories = copy.deepcopy(settings.COSINNUS_NOTIFICATIONS_DIGEST_CATEGORIES) or []
-            categories += DEFAULT_DIGEST_CATEGORY
-            body_html = ''
-            categorized_notification_ids = [nid for __,nids,__,__,__ in categories for nid in nids]
-            for cat_label, cat_notification_ids, cat_icon, cat_url_rev, cat_group_func in categories:
-                # add category header if there is more than one category
-                category_header_html = ''
-                category_html = ''
-                if len(categories) > 1:
-                    header_context = {
-                        'group_body_html': '', # empty on purpose as a header has no body
-                        'group_image_url': portal.get_domain() + get_image_url_for_icon(cat_icon, large=True),
-                        'group_url': reverse(cat_url_rev),
-                        'group_name': cat_label,
-                    }
-                    category_header_html = render_to_string('cosinnus/html_mail/summary_group.html', context=header_context)
+
+def finish_digest(portal, digest_setting, time_digest_end, shard_results, digest_run=None):
+    """ Saves the end of a completely sent digest's time span as the time of the last sent digest, 
+        cleans up stale notification events and logs the stats.
+        @param shard_results: a list of the stats dicts returned by `send_digest_for_users()` for all users
+        @param digest_run: the completed `DigestRun`, if any. Its recipient markers are deleted. 
+            If it is the run of a timezone, only that timezone's time of the last sent digest is saved """
+    timezone_names = digest_run.get_timezone_names() if digest_run is not None else []
+    # save the end time of the digest period as last digest time for this type.
+    # other digest commands may be saving their own keys at the same time (e.g. the daily and weekly commands with
+    # staggered digest delivery), so only this key is set on a freshly locked portal
+    with transaction.atomic():
+        locked_portal = CosinnusPortal.objects.select_for_update().get(id=portal.id)
+        for timezone_name in (timezone_names or ['']):
+            locked_portal.saved_infos[get_last_digest_sent_key(digest_setting, timezone_name)] = time_digest_end
+        locked_portal.save()
+    portal.saved_infos = locked_portal.saved_infos
+    
+    if digest_run is not None:
+        digest_run.recipients.all().delete()
+    if DIGEST_BUFFER_ENABLED:
+        # truncate the digest buffers of the sent digest
+        buffer_entries = DigestBufferEntry.objects.filter(digest_setting=digest_setting, group__portal=portal,
+                                                          event__date__lt=time_digest_end)
+        if timezone_names:
+            buffer_entries = buffer_entries.filter(user__in=get_portal_digest_users(portal, timezone_names))
+        buffer_entries.delete()
+    deleted = cleanup_stale_notifications()
+    
+    extra_log = {
+        'users_emailed': sum([result['users_emailed'] for result in shard_results]),
+        'total_users': sum([result['total_users'] for result in shard_results]),
+        'deleted_stale_notifications': deleted,
+        'remaining_past_and_future_notifications': NotificationEvent.objects.all().count(),
+    }
+    logger.info('Finished sending out digests of SETTING=%s in Portal "%s". Data in extra.' % (UserNotificationPreference.SETTING_CHOICES[digest_setting][1], portal.slug), extra=extra_log)
+    if settings.DEBUG:
+        print(extra_log)
+
+
+def get_digest_user_shard(users, shard_index, shard_count):
+    """ Returns the deterministic part of a users queryset that belongs to a shard, by user id """
+    return users.annotate(digest_shard=Mod('id', shard_count)).filter(digest_shard=shard_index)
+
+
+def get_digest_eligible_users(users, digest_setting, timescope_notification_events, portal_group_ids, portal=None):
+    """ Narrows down a users queryset to the users that may get a digest at all, in SQL: users that are active,
+        have logged in before and could have at least one event in their digest. These are the users in the
+        audience of an event of the digest's time span (or with the digest buffer enabled, the users with 
+        a filled buffer), and for multi preference events in the time span,
+        the users whose multi preference for it is (or defaults to) the digest setting.
+        All other checks are still done for each remaining user while sending the digest.
+        @param timescope_notification_events: the `NotificationEvent`s of the digest's time span """
+    if portal is None:
+        portal = CosinnusPortal.get_current()
+    users = users.filter(is_active=True, last_login__isnull=False)
+    if getattr(settings, 'COSINNUS_DIGEST_ONLY_FOR_ADMINS', False):
+        users = users.filter(is_superuser=True)
+    portal_events = timescope_notification_events.filter(group_id__in=portal_group_ids)
+    if DIGEST_BUFFER_ENABLED:
+        # group events can only come from a filled digest buffer
+        eligibility = Q(has_digest_buffer_entries=True)
+        users = users.annotate(has_digest_buffer_entries=Exists(
+            DigestBufferEntry.objects.filter(user_id=OuterRef('pk'), digest_setting=digest_setting, 
+                                             group_id__in=portal_group_ids,
+                                             event__in=timescope_notification_events.values('id'))
+        ))
+    elif USE_AUDIENCE_INDEX:
+        eligibility = Q(has_digest_audience_events=True)
+        users = users.annotate(has_digest_audience_events=Exists(
+            NotificationEventAudience.objects.filter(user_id=OuterRef('pk'), event__in=portal_events.values('id'))
+        ))
+    else:
+        # the plain audience field can't be matched against users efficiently
+        return users
+    
+    for multi_notification_id, default_setting in MULTI_NOTIFICATION_IDS.items():
+        multi_pref_notification_ids = get_multi_preference_notification_ids(multi_notification_id)
+        if not portal_events.filter(notification_id__in=multi_pref_notification_ids).exists():
+            continue
+        # users without a stored multi preference get the default setting
+        annotation_name = 'has_digest_multi_pref_%s' % multi_notification_id.lower()
+        multi_preferences = UserMultiNotificationPreference.objects.filter(user_id=OuterRef('pk'), portal=portal, 
+                                                                           multi_notification_id=multi_notification_id)
+        if default_setting == digest_setting:
+            users = users.annotate(**{annotation_name: ~Exists(multi_preferences.exclude(setting=digest_setting))})
+        else:
+            users = users.annotate(**{annotation_name: Exists(multi_preferences.filter(setting=digest_setting))})
+        eligibility |= Q(**{annotation_name: True})
+    return users.filter(eligibility)
+
+
+def _run_digest_shards_in_process_pool(digest_setting, time_digest_start, time_digest_end, workers, digest_run=None,
+                                       digest_range=None, node_id=None):
+    """ Runs `_send_digest_shard()` for `workers` user shards in a pool of forked worker processes.
+        @param digest_range: the `DigestRunRange` of the local run leased by `node_id`, renewed by all workers
+        @return: a list of the shard results, containing None for each failed shard """
+    # the forked workers must not share the parent's DB connections, they will each open their own
+    connections.close_all()
+    mp_context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+        digest_run_id = digest_run.id if digest_run is not None else None
+        timezone_names = digest_run.get_timezone_names() if digest_run is not None else []
+        digest_range_id = digest_range.id if digest_range is not None else None
+        futures = [executor.submit(_send_digest_shard, digest_setting, time_digest_start, time_digest_end, shard_index, workers,
+                                   digest_run_id, timezone_names, digest_range_id, node_id)
+                   for shard_index in range(workers)]
+        shard_results = []
+        for shard_index, future in enumerate(futures):
+            try:
+                shard_results.append(future.result())
+            except Exception as e:
+                logger.error('A digest worker process failed! Exception was: %s' % force_text(e), 
+                             extra={'exception': e, 'shard': shard_index, 'workers': workers, 'digest_setting': digest_setting})
+                shard_results.append(None)
+    return shard_results
+
+
+def _send_digest_shard(digest_setting, time_digest_start, time_digest_end, shard_index, shard_count, digest_run_id=None,
+                       timezone_names=None, digest_range_id=None, node_id=None):
+    """ Entry point of a digest worker process: sends the digests to all users of one shard """
+    try:
+        portal = CosinnusPortal.get_current()
+        users = get_digest_user_shard(get_portal_digest_users(portal, timezone_names), shard_index, shard_count)
+        digest_run = DigestRun.objects.get(id=digest_run_id) if digest_run_id else None
+        digest_range = DigestRunRange.objects.get(id=digest_range_id) if digest_range_id else None
+        return _send_digest_for_leased_users(digest_setting, users, time_digest_start, time_digest_end, 
+                                             digest_run, digest_range, node_id)
+    finally:
+        connections.close_all()
+
+
+def _send_digest_for_leased_users(digest_setting, users, time_digest_start, time_digest_end, digest_run, 
+                                  digest_range, node_id):
+    """ `send_digest_for_users()`, renewing the lease on the local run's range while sending, if any """
+    progress_callback = None
+    if digest_range is not None:
+        from cosinnus_notifications.digest_runs import get_lease_renewal_callback
+        progress_callback = get_lease_renewal_callback(digest_range, node_id)
+    return send_digest_for_users(digest_setting, users, time_digest_start, time_digest_end, 
+                                 progress_callback=progress_callback, digest_run=digest_run)
+
+
+def send_digest_for_users(digest_setting, users, time_digest_start, time_digest_end, debug_run_for_user=None,
+                          progress_callback=None, max_in_flight=None, digest_run=None):
+    """ Sends out the digest emails of a digest run for a time span to the given users. 
+        Does not save the time of the last sent digest.
+        
+        The users are streamed through a `DigestPipeline`, so memory use does not grow with their number.
+        
+        @param debug_run_for_user: see `send_digest_for_current_portal()`
+        @param progress_callback: if given, is called with the number of processed users before each user.
+            Exceptions raised by it abort the run.
+        @param max_in_flight: the maximum number of rendered digest mails held in memory before they are sent
+        @param digest_run: the `DigestRun` the digests are sent for, if any. Users that have already been sent
+            its digest are skipped, and each user that is sent the digest is recorded
+        @return: a dict of stats: `users_emailed`, `total_users` and the run's `profile` 
+            (see `DigestPipeline.get_profile()`). In a debug run, the debug user's digest html string instead. """
+    pipeline = DigestPipeline(digest_setting, time_digest_start, time_digest_end, 
+                              debug_run_for_user=debug_run_for_user, progress_callback=progress_callback,
+                              digest_run=digest_run)
+    if debug_run_for_user:
+        for __, body_html in pipeline.iter_rendered_bodies(pipeline.iter_user_bundles(pipeline.iter_user_chunks(users))):
+            return body_html
+        return None
+    return pipeline.run(users, max_in_flight=max_in_flight)
+
+
+@contextmanager
+def _activate_user_locale(user):
+    """ Switches language and time zone to the user's preferences, so all i18n and date and time formats
+        are in their language and time zone, and switches them back afterwards """
+    cur_time_zone = timezone.get_current_timezone()
+    cur_language = translation.get_language()
+    try:
+        translation.activate(getattr(user.cosinnus_profile, 'language', settings.LANGUAGES[0][0]))
+        timezone.activate(user.cosinnus_profile.timezone.zone)
+        yield
+    finally:
+        translation.activate(cur_language)
+        timezone.activate(cur_time_zone)
+
+
+class DigestUserBundle(object):
+    """ A user's candidate events for a digest, with the preferences needed to filter them down """
+    
+    __slots__ = ('user', 'events', 'global_wanted', 'only_multi_prefs_wanted', 'wanted_group_notifications')
+    
+    def __init__(self, user, events, global_wanted, only_multi_prefs_wanted, wanted_group_notifications):
+        self.user = user
+        self.events = events
+        self.global_wanted = global_wanted
+        self.only_multi_prefs_wanted = only_multi_prefs_wanted
+        self.wanted_group_notifications = wanted_group_notifications
+
+
+class DigestPipeline(object):
+    """ Sends the digests of a digest run as a chain of generators:
+            users --> chunks of users --> `DigestUserBundle`s --> rendered digest mails --> batches sent by the mailer
+        Each stage only pulls as many items from the previous one as it needs, so at most one chunk of users 
+        (with their preferences) and `max_in_flight` rendered mails are held in memory at any time. 
+        Caches shared between users (rendered fragments, access checks) are bounded in size. 
+        The time and DB queries spent in each phase are recorded by a `DigestRunProfiler` and logged
+        as one summary when the run is done. """
+    
+    def __init__(self, digest_setting, time_digest_start, time_digest_end, debug_run_for_user=None,
+                 progress_callback=None, progress_interval=None, digest_run=None):
+        # timings of all phases of the run
+        self.profiler = DigestRunProfiler()
+        self.digest_setting = digest_setting
+        self.digest_run = digest_run
+        self.time_digest_end = time_digest_end
+        self.debug_run_for_user = debug_run_for_user
+        self.progress_callback = progress_callback
+        self.progress_interval = DIGEST_PROGRESS_INTERVAL if progress_interval is None else progress_interval
+        self.portal = CosinnusPortal.get_current()
+        self.portal_group_ids = set(self.portal.groups.all().filter(is_active=True).values_list('id', flat=True))
+        # the main Notification Events QS. anything not in here did not happen in the digest's time span
+        self.timescope_notification_events = NotificationEvent.objects.filter(date__gte=time_digest_start, 
+                                                                              date__lt=time_digest_end)
+        # rendered digest items are shared between users
+        self.render_cache = DigestRenderCache(profiler=self.profiler)
+        # read access, actor and state checks are shared between users
+        self.access_memo = AccessCheckMemo()
+        # for the single-pass engine, all events of the time span are loaded once and mapped to their audience users
+        self.event_index = None
+        if not debug_run_for_user and not DIGEST_BUFFER_ENABLED and DIGEST_ENGINE == DIGEST_ENGINE_SINGLE_PASS:
+            with self.profiler.phase('event_selection'):
+                self.event_index = DigestEventIndex(self.timescope_notification_events, self.portal_group_ids)
+        # the digest buffers only hold group events, multi preference events are read from the time span once
+        self.multi_pref_events_by_notification_id = None
+        if not debug_run_for_user and DIGEST_BUFFER_ENABLED:
+            with self.profiler.phase('event_selection'):
+                self.multi_pref_events_by_notification_id = get_multi_pref_digest_events(
+                    self.timescope_notification_events, self.portal_group_ids)
+        # stats
+        self.total_users = 0
+        self.users_emailed = 0
+    
+    def iter_user_chunks(self, users):
+        """ Stage 1: yields the users in lists of at most `DIGEST_USER_CHUNK_SIZE`. A users queryset is narrowed 
+            down to the eligible users and fetched in chunks, without caching the whole result """
+        if self.debug_run_for_user:
+            yield list(users)
+            return
+        users = get_digest_eligible_users(users, self.digest_setting, self.timescope_notification_events, 
+                                          self.portal_group_ids, portal=self.portal)
+        if self.digest_run is not None:
+            # skip users that have already been sent this run's digest
+            users = users.exclude(id__in=DigestRunRecipient.objects.filter(run=self.digest_run).values('user_id'))
+        users = users.select_related('cosinnus_profile').iterator(chunk_size=DIGEST_USER_CHUNK_SIZE)
+        while True:
+            with self.profiler.phase('user_selection'):
+                user_chunk = list(itertools.islice(users, DIGEST_USER_CHUNK_SIZE))
+            if not user_chunk:
+                break
+            yield user_chunk
+    
+    def _report_progress(self):
+        if self.progress_callback is not None:
+            self.progress_callback(self.total_users)
+        if self.progress_interval and self.total_users and self.total_users % self.progress_interval == 0:
+            logger.info('Digest run progress. Data in extra.', extra={'digest_setting': self.digest_setting,
+                    'total_users': self.total_users, 'users_emailed': self.users_emailed})
+    
+    def iter_user_bundles(self, user_chunks):
+        """ Stage 2: yields a `DigestUserBundle` for each user that wants a digest and has candidate events.
+            The preferences are bulk-loaded for each chunk of users. """
+        digest_setting = self.digest_setting
+        for user_chunk in user_chunks:
+            if not self.debug_run_for_user:
+                # snapshots of all notification preferences of the chunk's users relevant for this digest
+                with self.profiler.phase('preference_loading'):
+                    user_preferences = load_digest_preferences([user.id for user in user_chunk], digest_setting, 
+                                                               self.portal_group_ids, portal=self.portal)
+                if DIGEST_BUFFER_ENABLED:
+                    # the candidate events of the chunk's users are read from their digest buffers
+                    with self.profiler.phase('event_selection'):
+                        buffer_index = DigestBufferIndex([user.id for user in user_chunk], digest_setting, 
+                                                         self.timescope_notification_events, self.portal_group_ids,
+                                                         self.multi_pref_events_by_notification_id)
+            for user in user_chunk:
+                self._report_progress()
+                self.profiler.start_user(user.id)
+                self.total_users += 1
+                if self.debug_run_for_user:
+                    global_wanted = True
+                    only_multi_prefs_wanted = False
+                    multi_prefs = [multi_notification_id for multi_notification_id, setting in 
+                            UserMultiNotificationPreference.get_settings_for_user(user, portal=self.portal).items() 
+                            if setting == digest_setting]
+                else:
+                    if getattr(settings, 'COSINNUS_DIGEST_ONLY_FOR_ADMINS', False) and not user.is_superuser:
+                        continue
+                    if not check_user_can_receive_emails(user):
+                        continue
+                    
+                    preferences = user_preferences[user.id]
+                    
+                    # get all of user's multi prefs for this digest setting 
+                    only_multi_prefs_wanted = False
+                    multi_prefs = [multi_notification_id for multi_notification_id, setting in 
+                            preferences.multi_settings.items() if setting == digest_setting]
+                    # check global blanket settings
+                    global_wanted = False # flag to allow all events
+                    global_setting = preferences.global_setting
+                    if global_setting is None:
+                        # no stored setting, so the manager determines the default
+                        with self.profiler.phase('preference_loading'):
+                            global_setting = GlobalUserNotificationSetting.objects.get_for_user(user)
+                    
+                    # check if global blanketing settings allow for sending this digest to the user
+                    if global_setting != digest_setting and global_setting != GlobalUserNotificationSetting.SETTING_GROUP_INDIVIDUAL:
+                        if not multi_prefs:
+                            # users who don't have the global setting AND the multi pref setting set to this digest never get an email
+                            continue 
+                        else:
+                            # user still has a multi pref setting for this digest_setting, so go on and check
+                            only_multi_prefs_wanted = True 
+                    
+                    if (digest_setting == UserNotificationPreference.SETTING_DAILY and global_setting == GlobalUserNotificationSetting.SETTING_DAILY) \
+                            or (digest_setting == UserNotificationPreference.SETTING_WEEKLY and global_setting == GlobalUserNotificationSetting.SETTING_WEEKLY):
+                        global_wanted = True # user wants ALL events in his digest for this digest setting
                 
-                for group in list(set(events.values_list('group', flat=True))): 
-                    group_events = events.filter(group=group).order_by('-id') # id faster than ordering by created date 
+                try:
+                    # only active users that have logged in before accepted the TOS get notifications
+                    if not user.is_active or not user.last_login or not cosinnus_setting(user, 'tos_accepted'):
+                        continue
                     
-                    # filter only those events that the user actually has in his prefs, for this group and also
-                    # check for target object existing, being visible to user, and other sanity checks if the user should see this object
-                    wanted_group_events = []
-                    for event in group_events:
-                        # include the event only if it belongs to the right category,
-                        # i.e. it is either in the current list of category-ids or 
-                        # the current list is empty ("all ids") and the id does not 
-                        # appear in any other category
-                        _app_label, current_notification_id = event.notification_id.split('__')
-                        if not (current_notification_id in cat_notification_ids or \
-                                (len(cat_notification_ids) == 0 and current_notification_id not in categorized_notification_ids)):
-                            continue
-                        if cat_group_func is not None and hasattr(event, 'group') and event.group and not cat_group_func(event.group):
+                    # if we have a blanket YES for this digest, filter events only by portal affiliance,
+                    # otherwise filter events by group notification settings
+                    wanted_group_notifications = None
+                    if global_wanted:
+                        wanted_group_ids = self.portal_group_ids
+                    elif only_multi_prefs_wanted:
+                        # no regular group events; only multi pref events are mixed in later
+                        wanted_group_ids = set()
+                    else:
+                        # find out any notification preferences the user has for groups in this portal with the daily/weekly setting
+                        # (excluding groups with a blanketing NONE setting or ALL setting of anything but this ``digest_setting``)
+                        # if he doesn't have any, we will not send a mail for them
+                        prefs = preferences.group_preferences
+                        if len(prefs) == 0:
                             continue
                         
-                        is_multipref = is_notification_multipref(event.notification_id)
-                        statecheck = get_requires_object_state_check(event.notification_id)
-                        if user == event.user:
-                            continue  # users don't receive infos about events they caused
-                        if not is_user_active(event.user):
-                            continue # users who are inactive by now are probably banned, so ignore their content
-                        if not is_multipref and not global_wanted and not only_multi_prefs_wanted: # skip finegrained preference check on blanket YES
-                            if not (('%d__%s' % (event.group_id, ALL_NOTIFICATIONS_ID) in wanted_group_notifications) or \
-                                    ('%d__%s' % (event.group_id, event.notification_id) in wanted_group_notifications)):
-                                continue  # must have an actual subscription to that event type
-                        if event.target_object is None:
-                            continue  # referenced object has been deleted by now
-                        if not check_object_read_access(event.target_object, user):
-                            continue  # user must be able to even see referenced object 
-                        # statecheck if defined, for example for checking if the user is still following the object
-                        if statecheck:
-                            if not resolve_attributes(event.target_object, statecheck, func_args=[user]):
-                                continue
-                        wanted_group_events.append(event)
+                        # only for these groups does the user get any digest news at all
+                        wanted_group_ids = set([group_id for group_id, __ in prefs])
+                        # collect a comparable hash for all wanted user prefs
+                        wanted_group_notifications = ['%(group_id)d__%(notification_id)s' % {
+                            'group_id': group_id,
+                            'notification_id': notification_id,
+                        } for group_id, notification_id in prefs]
                     
-                    wanted_group_events = sorted(wanted_group_events,  key=lambda e: e.date)
+                    # multi pref events that the user wants to see are added to regular events
+                    multi_pref_notification_ids = []
+                    for multi_pref in multi_prefs:
+                        multi_pref_notification_ids.extend(get_multi_preference_notification_ids(multi_pref))
                     
-                    # Throw out duplicate events (eg "X was updated" multiple times) for the same object and superceded events. 
-                    # The most recent event is always kept.
-                    # - follow-events have a supercede list of events that are always less important than the follow-event
-                    # - this means that a "created" event would be thrown out by a later "an item you followed was updated" on the same object
-                    for this_event in wanted_group_events[:]:
-                        for other_event in wanted_group_events[:]:
-                            if not other_event == this_event:
-                                unprefixed_this_notification_id = this_event.notification_id.split('__')[1]
-                                if this_event.target_object == other_event.target_object and \
-                                        (this_event.notification_id == other_event.notification_id or \
-                                         unprefixed_this_notification_id in get_superceded_multi_preferences(other_event.notification_id)):
-                                    wanted_group_events.remove(this_event)
-                                    break
-                    
-                    if wanted_group_events:
-                        group = wanted_group_events[0].group # needs to be resolved, values_list returns only id ints
-                        group_body_html = '\n'.join([render_digest_item_for_notification_event(event) for event in wanted_group_events])
-                        # categories may display their items in a condensed list directly under their header
-                        # and the default category displays in a clustered form within a header for each group
-                        # note: currently disabled and not extracted into a conf setting until it is wished for
-                        condense_categories = False
-                        if condense_categories and len(cat_notification_ids) > 0:
-                            category_html += group_body_html + '\n'
+                    # get all notification events where the user is in the intended audience
+                    with self.profiler.phase('event_selection'):
+                        if not self.debug_run_for_user and DIGEST_BUFFER_ENABLED:
+                            events = buffer_index.get_events_for_user(user.id, wanted_group_ids, multi_pref_notification_ids)
+                        elif self.event_index is not None:
+                            events = self.event_index.get_events_for_user(user.id, wanted_group_ids, multi_pref_notification_ids)
                         else:
-                            group_template_context = {
-                                'group_body_html': mark_safe(group_body_html),
-                                'group_image_url': CosinnusPortal.get_current().get_domain() + group.get_avatar_thumbnail_url(),
-                                'group_url': group.get_absolute_url(),
-                                'group_name': group['name'],
-                            }
-                            group_html = render_to_string('cosinnus/html_mail/summary_group.html', context=group_template_context)
-                            category_html += group_html + '\n'
-                # end for group
+                            events = get_user_digest_events(self.timescope_notification_events, user, wanted_group_ids, 
+                                                            multi_pref_notification_ids, self.portal_group_ids)
+                    if not events:
+                        continue
+                except Exception as e:
+                    self._log_user_error(user, e)
+                    continue
                 
-                if category_html:
-                    category_html = category_header_html + '\n' + category_html
-                    body_html += category_html + '\n'
-                    # we currently don't have a proper category header, so add a larger space in-between categories, except for the last
-                    if len(cat_notification_ids) > 0:
-                        body_html += '<br/><br/>\n'
-            # end for category
-                    
-                    
-            
-            if debug_run_for_user:
-                return body_html
-            # send actual email with full frame template
-            if body_html:
-                _send_digest_email(user, mark_safe(body_html), TIME_DIGEST_END, digest_setting)
-                emailed += 1
-            
-        except Exception as e:
-            # we never want this subroutine to just die, we need the final saves at the end to ensure
-            # the same items do not get into digests twice
-            logger.error('An error occured while doing a digest for a user! Exception was: %s' % force_text(e), 
-                         extra={'exception': e, 'trace': traceback.format_exc(), 'user_mail': user.email, 'digest_setting': digest_setting})
-            if settings.DEBUG:
-                raise
+                yield DigestUserBundle(user, events, global_wanted, only_multi_prefs_wanted, wanted_group_notifications)
+    
+    def _log_user_error(self, user, e):
+        # we never want the digest to just die, we need the final saves at the end to ensure
+        # the same items do not get into digests twice
+        logger.error('An error occured while doing a digest for a user! Exception was: %s' % force_text(e), 
+                     extra={'exception': e, 'trace': traceback.format_exc(), 'user_mail': user.email, 
+                            'digest_setting': self.digest_setting})
+        if settings.DEBUG:
+            raise e
+    
+    def iter_rendered_bodies(self, user_bundles):
+        """ Stage 3: yields (user, body_html) for each user bundle, rendered in the user's language and time zone.
+            The body may be empty if none of the candidate events remained after filtering. """
+        for bundle in user_bundles:
+            try:
+                with _activate_user_locale(bundle.user):
+                    body_html = render_digest_body_for_user(bundle.user, bundle.events, bundle.global_wanted, 
+                            bundle.only_multi_prefs_wanted, bundle.wanted_group_notifications, 
+                            render_cache=self.render_cache, access_memo=self.access_memo, profiler=self.profiler)
+            except Exception as e:
+                self._log_user_error(bundle.user, e)
+                continue
+            yield bundle.user, body_html
+    
+    def iter_digest_messages(self, rendered_bodies):
+        """ Stage 4: yields (user, message) with the full digest email message for each non-empty rendered body """
+        for user, body_html in rendered_bodies:
+            if not body_html:
+                continue
+            try:
+                with _activate_user_locale(user), self.profiler.phase('mail_rendering'):
+                    message = _build_digest_email(user, mark_safe(body_html), self.time_digest_end, self.digest_setting)
+            except Exception as e:
+                self._log_user_error(user, e)
+                continue
+            yield user, message
+    
+    def _send_batch(self, mailer, batch):
+        """ Sends a batch of (user, message) and records its users as recipients of the digest run """
+        with self.profiler.phase('sending'):
+            for __, message in batch:
+                mailer.send(message)
+            failed_message_ids = set(id(message) for message in mailer.flush())
+        # only the users whose mail was delivered are recorded, the others are retried when the run is resumed
+        sent_user_ids = [user.id for user, message in batch if id(message) not in failed_message_ids]
+        self.users_emailed += len(sent_user_ids)
+        if self.digest_run is None or not sent_user_ids:
+            return
+        DigestRunRecipient.objects.bulk_create([DigestRunRecipient(run=self.digest_run, user_id=user_id) 
+                                                for user_id in sent_user_ids], ignore_conflicts=True)
+    
+    def run(self, users, max_in_flight=None, mailer=None):
+        """ Runs all stages for the given users, sending the digest mails in batches of at most
+            `max_in_flight` messages.
+            @param mailer: the `NotificationMailer` (or `EmailFileWriter`) the mails are handed to. 
+                by default, a new `NotificationMailer`
+            @return: a dict of stats: `users_emailed`, `total_users` and the run's `profile` """
+        max_in_flight = max_in_flight or DIGEST_MAX_IN_FLIGHT_MAILS
+        if mailer is None:
+            # all digest mails of this run are sent in batches over one mail connection
+            mailer = NotificationMailer(batch_size=max_in_flight)
+        try:
+            with self.profiler.track_queries():
+                user_chunks = self.iter_user_chunks(users)
+                messages = self.iter_digest_messages(self.iter_rendered_bodies(self.iter_user_bundles(user_chunks)))
+                batch = []
+                for user, message in messages:
+                    # the user's digest is done once it is queued for sending
+                    self.profiler.end_user()
+                    batch.append((user, message))
+                    if len(batch) >= max_in_flight:
+                        self._send_batch(mailer, batch)
+                        batch = []
+                if batch:
+                    # send out the remaining mails
+                    self._send_batch(mailer, batch)
         finally:
-            # switch language back
-            translation.activate(cur_language)
-            timezone.activate(cur_time_zone)
+            mailer.close()
+            self.profiler.finish()
         
-            
-    # save the end time of the digest period as last digest time for this type
-    portal.saved_infos[CosinnusPortal.SAVED_INFO_LAST_DIGEST_SENT % digest_setting] = TIME_DIGEST_END
-    portal.save()
+        profile = self.get_profile()
+        logger.info('Digest run profile. Data in extra.', extra=profile)
+        return {
+            'users_emailed': self.users_emailed,
+            'total_users': self.total_users,
+            'profile': profile,
+        }
     
-    deleted = cleanup_stale_notifications()
+    def get_profile(self):
+        """ Returns the timings of the run along with its stats and cache stats, as JSON-serializable dict """
+        profile = self.profiler.get_summary()
+        profile.update({
+            'digest_setting': self.digest_setting,
+            'users_emailed': self.users_emailed,
+            'total_users': self.total_users,
+            'render_cache': self.render_cache.get_stats(),
+            'access_memo': self.access_memo.get_stats(),
+        })
+        return profile
+
+
+def _get_target_select_related_fields(model_class):
+    """ Returns the names of the forward relations of `DIGEST_TARGET_SELECT_RELATED` the model has """
+    field_names = []
+    for field_name in DIGEST_TARGET_SELECT_RELATED:
+        try:
+            field = model_class._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            continue
+        if field.is_relation and (field.many_to_one or field.one_to_one) and not getattr(field, 'is_generic', False):
+            field_names.append(field_name)
+    return field_names
+
+
+def prefetch_notification_event_targets(notification_events):
+    """ Retrieves the target objects of many notification events with one query per content type (with their 
+        group and creator), instead of one query per event. Each found target object is set as cached 
+        generic foreign key value and as `_target_object` of its events, like `NotificationsThread.inner_run()` does.
+        Events whose target object has been deleted are left untouched. """
+    event_ids_by_content_type = defaultdict(set)
+    for event in notification_events:
+        if not hasattr(event, '_target_object'):
+            event_ids_by_content_type[event.content_type_id].add(event.object_id)
     
-    extra_log = {
-        'users_emailed': emailed,
-        'total_users': len(users),
-        'deleted_stale_notifications': deleted,
-        'remaining_past_and_future_notifications': NotificationEvent.objects.all().count(),
-    }
-    logger.info('Finished sending out digests of SETTING=%s in Portal "%s". Data in extra.' % (UserNotificationPreference.SETTING_CHOICES[digest_setting][1], portal.slug), extra=extra_log)
-    if settings.DEBUG:
-        print(extra_log)
+    targets = {}
+    for content_type_id, object_ids in event_ids_by_content_type.items():
+        model_class = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model_class is None:
+            continue # model has been removed
+        queryset = model_class._default_manager.all()
+        select_related_fields = _get_target_select_related_fields(model_class)
+        if select_related_fields:
+            queryset = queryset.select_related(*select_related_fields)
+        for object_id_chunk in chunked(object_ids):
+            for target_object in queryset.filter(pk__in=object_id_chunk):
+                targets[(content_type_id, target_object.pk)] = target_object
+    
+    target_object_field = NotificationEvent._meta.get_field('target_object')
+    for event in notification_events:
+        target_object = targets.get((event.content_type_id, event.object_id), None)
+        if target_object is not None:
+            target_object_field.set_cached_value(event, target_object)
+            setattr(event, '_target_object', target_object)
+
+
+class DigestEventIndex(object):
+    """ All notification events of a digest's time span, loaded with a single query and inverted into
+        a map of audience user --> events. Used by the single-pass digest engine to retrieve each user's events
+        in memory, instead of running a set of querysets for every user.
+        `get_events_for_user()` returns the same events in the same order as `get_user_digest_events()`. """
+    
+    def __init__(self, timescope_notification_events, portal_group_ids):
+        self.portal_group_ids = portal_group_ids
+        # user_id --> list of events with the user in their audience, ordered by date
+        self.events_by_user_id = defaultdict(list)
+        # notification_id --> list of events in groups of this portal, ordered by date
+        self.portal_events_by_notification_id = defaultdict(list)
+        self.event_count = 0
+        events = list(timescope_notification_events.select_related(*DIGEST_EVENT_SELECT_RELATED).order_by('date', 'id'))
+        prefetch_notification_event_targets(events)
+        for event in events:
+            for user_id in event.get_audience_user_ids():
+                self.events_by_user_id[user_id].append(event)
+            if event.group_id in portal_group_ids:
+                self.portal_events_by_notification_id[event.notification_id].append(event)
+            self.event_count += 1
+    
+    def get_events_for_user(self, user_id, group_ids, multi_pref_notification_ids=None):
+        """ Returns all events in the user's audience in the given groups, plus all events in the portal
+            for the given multi preference notification ids. 
+            @return: a list of events, ordered by date """
+        events = [event for event in self.events_by_user_id.get(user_id, []) if event.group_id in group_ids]
+        if multi_pref_notification_ids:
+            event_ids = set([event.id for event in events])
+            for notification_id in set(multi_pref_notification_ids):
+                for event in self.portal_events_by_notification_id.get(notification_id, []):
+                    if event.id not in event_ids:
+                        event_ids.add(event.id)
+                        events.append(event)
+            events = sorted(events, key=lambda e: (e.date, e.id))
+        return events
+
+
+def get_multi_pref_digest_events(timescope_notification_events, portal_group_ids):
+    """ Loads all events of a digest's time span in the portal's groups that belong to a multi preference.
+        @return: a dict of notification_id --> list of events, ordered by date """
+    multi_pref_notification_ids = [notification_id for multi_notification_id in MULTI_NOTIFICATION_IDS
+                                   for notification_id in get_multi_preference_notification_ids(multi_notification_id)]
+    events = list(timescope_notification_events.filter(notification_id__in=multi_pref_notification_ids, 
+                                                       group_id__in=portal_group_ids)\
+                  .select_related(*DIGEST_EVENT_SELECT_RELATED).order_by('date', 'id'))
+    prefetch_notification_event_targets(events)
+    events_by_notification_id = defaultdict(list)
+    for event in events:
+        events_by_notification_id[event.notification_id].append(event)
+    return events_by_notification_id
+
+
+class DigestBufferIndex(object):
+    """ The digest buffer entries (see `DigestBufferEntry`) of a chunk of users for a digest, loaded with a 
+        single query, along with their events. `get_events_for_user()` returns the same events as
+        `DigestEventIndex.get_events_for_user()`, but the group events only from the user's buffer. 
+        Like without the buffer, multi preference events reach all users with the multi preference set to 
+        the digest, whether or not they were in the event's audience. """
+    
+    def __init__(self, user_ids, digest_setting, timescope_notification_events, portal_group_ids,
+                 multi_pref_events_by_notification_id=None):
+        # notification_id --> list of the time span's multi preference events, see `get_multi_pref_digest_events()`
+        if multi_pref_events_by_notification_id is None:
+            multi_pref_events_by_notification_id = get_multi_pref_digest_events(timescope_notification_events, 
+                                                                                portal_group_ids)
+        self.multi_pref_events_by_notification_id = multi_pref_events_by_notification_id
+        # user_id --> list of (event_id, group_id, notification_id)
+        entries_by_user_id = defaultdict(list)
+        entries = DigestBufferEntry.objects.filter(user_id__in=user_ids, digest_setting=digest_setting, 
+                                                   group_id__in=portal_group_ids, 
+                                                   event__in=timescope_notification_events.values('id'))\
+                .values_list('user_id', 'event_id', 'group_id', 'notification_id')
+        event_ids = set()
+        for user_id, event_id, group_id, notification_id in entries:
+            entries_by_user_id[user_id].append((event_id, group_id, notification_id))
+            event_ids.add(event_id)
+        self.entries_by_user_id = entries_by_user_id
+        
+        self.events_by_id = {}
+        for event_id_chunk in chunked(event_ids):
+            events = list(NotificationEvent.objects.filter(id__in=event_id_chunk).select_related(*DIGEST_EVENT_SELECT_RELATED))
+            prefetch_notification_event_targets(events)
+            self.events_by_id.update([(event.id, event) for event in events])
+    
+    def get_events_for_user(self, user_id, group_ids, multi_pref_notification_ids=None):
+        """ Returns all events in the user's buffer in the given groups, plus all events in the portal
+            for the given multi preference notification ids. 
+            @return: a list of events, ordered by date """
+        events = [self.events_by_id[event_id] for event_id, group_id, __ in self.entries_by_user_id.get(user_id, [])
+                  if group_id in group_ids and event_id in self.events_by_id]
+        if multi_pref_notification_ids:
+            event_ids = set([event.id for event in events])
+            for notification_id in set(multi_pref_notification_ids):
+                for event in self.multi_pref_events_by_notification_id.get(notification_id, []):
+                    if event.id not in event_ids:
+                        event_ids.add(event.id)
+                        events.append(event)
+        return sorted(events, key=lambda e: (e.date, e.id))
+
+
+def get_user_digest_events(timescope_notification_events, user, group_ids, multi_pref_notification_ids, portal_group_ids):
+    """ Retrieves a user's candidate events for a digest from the DB.
+        @param group_ids: only events in these groups that have the user in their audience are included
+        @param multi_pref_notification_ids: all events in the portal's groups for these notification ids are included
+        @return: a list of events, ordered by date """
+    if USE_AUDIENCE_INDEX:
+        # (a subquery instead of a join, so OR-ing in the multi pref events below doesn't cause duplicates)
+        events = timescope_notification_events.filter(
+            id__in=NotificationEventAudience.objects.filter(user_id=user.id).values('event_id'))
+    else:
+        events = timescope_notification_events.filter(audience__contains=',%d,' % user.id)
+    events = events.filter(group_id__in=group_ids)
+    if multi_pref_notification_ids:
+        # filter all notification events to fit multi prefs and be in the current portal
+        multi_pref_events = timescope_notification_events.filter(
+            notification_id__in=multi_pref_notification_ids,
+            group_id__in=portal_group_ids
+        )
+        events = events | multi_pref_events
+    events = list(events.select_related(*DIGEST_EVENT_SELECT_RELATED).order_by('date', 'id'))
+    prefetch_notification_event_targets(events)
+    return events
+
+
+class DigestRenderCache(object):
+    """ Caches of rendered HTML fragments shared between all users of a digest run.
+        A rendered digest item only depends on its event and the active language and time zone, 
+        so it is rendered once per run for each language/time zone combination instead of for every user.
+        The same goes for a rendered group block, which only depends on the group's visible events. """
+    
+    def __init__(self, max_items=None, max_group_blocks=None, profiler=None):
+        self.item_cache = LRUCache(max_items or DIGEST_FRAGMENT_CACHE_SIZE)
+        self.group_block_cache = LRUCache(max_group_blocks or DIGEST_GROUP_BLOCK_CACHE_SIZE)
+        # a `DigestRunProfiler` the rendering times are attributed to
+        self.profiler = profiler or DigestRunProfiler()
+    
+    def _get_locale_key(self):
+        return (translation.get_language(), timezone.get_current_timezone_name())
+    
+    def _render_item(self, event):
+        with self.profiler.phase('item_rendering'):
+            return render_digest_item_for_notification_event(event)
+    
+    def render_item(self, event):
+        """ Returns the same as `render_digest_item_for_notification_event(event)` """
+        if event.id is None:
+            return self._render_item(event)
+        return self.item_cache.get_or_set((event.id,) + self._get_locale_key(), 
+                                          lambda: self._render_item(event))
+    
+    def _render_group_block(self, group_events):
+        with self.profiler.phase('group_rendering'):
+            return self._render_group_block_html(group_events)
+    
+    def _render_group_block_html(self, group_events):
+        group = group_events[0].group # needs to be resolved, values_list returns only id ints
+        group_body_html = '\n'.join([self.render_item(event) for event in group_events])
+        group_template_context = {
+            'group_body_html': mark_safe(group_body_html),
+            'group_image_url': CosinnusPortal.get_current().get_domain() + group.get_avatar_thumbnail_url(),
+            'group_url': group.get_absolute_url(),
+            'group_name': group['name'],
+        }
+        return render_to_string('cosinnus/html_mail/summary_group.html', context=group_template_context)
+    
+    def render_group_block(self, group_events):
+        """ Renders the digest block of a group with its visible events. Users that see the exact same
+            list of events in a group share the rendered block.
+            @param group_events: the ordered, visible events of a single group """
+        event_ids = [event.id for event in group_events]
+        if None in event_ids:
+            return self._render_group_block(group_events)
+        event_ids_hash = hashlib.sha1(','.join([str(event_id) for event_id in event_ids]).encode('utf-8')).hexdigest()
+        return self.group_block_cache.get_or_set((group_events[0].group_id, event_ids_hash) + self._get_locale_key(),
+                                                 lambda: self._render_group_block(group_events))
+    
+    def get_stats(self):
+        return {
+            'item_cache_hits': self.item_cache.hits,
+            'item_cache_misses': self.item_cache.misses,
+            'group_block_cache_hits': self.group_block_cache.hits,
+            'group_block_cache_misses': self.group_block_cache.misses,
+        }
+
+
+def render_digest_body_for_user(user, events, global_wanted, only_multi_prefs_wanted, wanted_group_notifications,
+                                render_cache=None, access_memo=None, profiler=None):
+    """ Renders the body HTML of a user's digest from their candidate events. The events are clustered 
+        by categories and then by group, and filtered down to those the user actually wants to and may see.
+        @param events: the user's candidate events (as retrieved by `get_user_digest_events()`), ordered by date
+        @param wanted_group_notifications: a list of `[group_id]__[notification_id]` strings of the user's 
+            preferences. only used if neither `global_wanted` nor `only_multi_prefs_wanted` are set
+        @param render_cache: a `DigestRenderCache` shared by all users of a digest run. if None, 
+            all fragments are rendered for this user only
+        @param access_memo: an `AccessCheckMemo` shared by all users of a digest run. if None, 
+            the access checks are memoized for this user only
+        @param profiler: the `DigestRunProfiler` of the digest run, if any
+        @return: the body HTML, or an empty string if no events remained """
+    portal = CosinnusPortal.get_current()
+    if render_cache is None:
+        render_cache = DigestRenderCache()
+    if access_memo is None:
+        access_memo = AccessCheckMemo()
+    if profiler is None:
+        profiler = DigestRunProfiler()
+    events_by_group_id = defaultdict(list)
+    for event in events:
+        events_by_group_id[event.group_id].append(event)
+    
+    categories = copy.deepcopy(settings.COSINNUS_NOTIFICATIONS_DIGEST_CATEGORIES) or []
+    categories += DEFAULT_DIGEST_CATEGORY
+    body_parts = []
+    categorized_notification_ids = [nid for __,nids,__,__,__ in categories for nid in nids]
+    for cat_label, cat_notification_ids, cat_icon, cat_url_rev, cat_group_func in categories:
+        # add category header if there is more than one category
+        category_header_html = ''
+        category_parts = []
+        if len(categories) > 1:
+            header_context = {
+                'group_body_html': '', # empty on purpose as a header has no body
+                'group_image_url': portal.get_domain() + get_image_url_for_icon(cat_icon, large=True),
+                'group_url': reverse(cat_url_rev),
+                'group_name': cat_label,
+            }
+            category_header_html = render_to_string('cosinnus/html_mail/summary_group.html', context=header_context)
+        
+        for group in list(set([event.group_id for event in events])): 
+            group_events = sorted(events_by_group_id[group], key=lambda e: e.id, reverse=True)
+            
+            # filter only those events that the user actually has in his prefs, for this group and also
+            # check for target object existing, being visible to user, and other sanity checks if the user should see this object
+            wanted_group_events = []
+            with profiler.phase('access_checks'):
+                for event in group_events:
+                    # include the event only if it belongs to the right category,
+                    # i.e. it is either in the current list of category-ids or 
+                    # the current list is empty ("all ids") and the id does not 
+                    # appear in any other category
+                    _app_label, current_notification_id = event.notification_id.split('__')
+                    if not (current_notification_id in cat_notification_ids or \
+                            (len(cat_notification_ids) == 0 and current_notification_id not in categorized_notification_ids)):
+                        continue
+                    if cat_group_func is not None and hasattr(event, 'group') and event.group and not cat_group_func(event.group):
+                        continue
+                    
+                    is_multipref = is_notification_multipref(event.notification_id)
+                    statecheck = get_requires_object_state_check(event.notification_id)
+                    if user == event.user:
+                        continue  # users don't receive infos about events they caused
+                    if not access_memo.is_actor_active(event.user):
+                        continue # users who are inactive by now are probably banned, so ignore their content
+                    if not is_multipref and not global_wanted and not only_multi_prefs_wanted: # skip finegrained preference check on blanket YES
+                        if not (('%d__%s' % (event.group_id, ALL_NOTIFICATIONS_ID) in wanted_group_notifications) or \
+                                ('%d__%s' % (event.group_id, event.notification_id) in wanted_group_notifications)):
+                            continue  # must have an actual subscription to that event type
+                    if event.target_object is None:
+                        continue  # referenced object has been deleted by now
+                    if not access_memo.check_read_access(event.target_object, user):
+                        continue  # user must be able to even see referenced object 
+                    # statecheck if defined, for example for checking if the user is still following the object
+                    if statecheck:
+                        if not access_memo.check_object_state(event.target_object, statecheck, user):
+                            continue
+                    wanted_group_events.append(event)
+            
+            wanted_group_events = sorted(wanted_group_events,  key=lambda e: e.date)
+            
+            # Throw out duplicate events (eg "X was updated" multiple times) for the same object and superceded events. 
+            # The most recent event is always kept.
+            with profiler.phase('dedup'):
+                wanted_group_events = deduplicate_notification_events(wanted_group_events)
+            
+            if wanted_group_events:
+                # categories may display their items in a condensed list directly under their header
+                # and the default category displays in a clustered form within a header for each group
+                # note: currently disabled and not extracted into a conf setting until it is wished for
+                condense_categories = False
+                if condense_categories and len(cat_notification_ids) > 0:
+                    category_parts.extend([render_cache.render_item(event) for event in wanted_group_events])
+                else:
+                    category_parts.append(render_cache.render_group_block(wanted_group_events))
+        # end for group
+        
+        if category_parts:
+            body_parts.append(category_header_html + '\n' + ''.join([part + '\n' for part in category_parts]) + '\n')
+            # we currently don't have a proper category header, so add a larger space in-between categories, except for the last
+            if len(cat_notification_ids) > 0:
+                body_parts.append('<br/><br/>\n')
+    # end for category
+    return ''.join(body_parts)
 
 
 def _get_digest_email_context(receiver, body_html, digest_generation_time, digest_setting):
     """ Gets the context for rendering the template for the actual digest mail.
-        Used for `_send_digest_email()` """
+        Used for `_build_digest_email()` """
     portal_name =  _(settings.COSINNUS_BASE_PAGE_TITLE_TRANS)
     if digest_setting == UserNotificationPreference.SETTING_DAILY:
         subject = _('Your daily digest for %(portal_name)s') % {'portal_name': portal_name}
@@ -363,11 +1296,11 @@ def _get_digest_email_context(receiver, body_html, digest_generation_time, diges
     return context
 
 
-def _send_digest_email(receiver, body_html, digest_generation_time, digest_setting):
-    """ Prepares the actual digest mail and sends it """
+def _build_digest_email(receiver, body_html, digest_generation_time, digest_setting):
+    """ Prepares the actual digest mail message """
     template = '/cosinnus/html_mail/digest.html'
     context = _get_digest_email_context(receiver, body_html, digest_generation_time, digest_setting)
-    send_mail_or_fail(receiver.email, context['subject'], template, context, is_html=True)
+    return build_html_mail_message(receiver.email, context['subject'], render_to_string(template, context))
 
 
 def cleanup_stale_notifications():
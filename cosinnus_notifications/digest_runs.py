@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+import logging
+import multiprocessing
+import os
+import socket
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.db import transaction, IntegrityError, connections
+from django.db.models import Min, Max, Q
+from django.utils.encoding import force_text
+from django.utils.timezone import now
+
+from cosinnus.conf import settings
+from cosinnus.models.group import CosinnusPortal
+from cosinnus_notifications.digest import get_digest_time_span, finish_digest,\
+    send_digest_for_users
+from cosinnus_notifications.models import DigestRun, DigestRunRange
+
+
+logger = logging.getLogger('cosinnus')
+
+# number of user ids (not users!) in each range of a digest run
+DIGEST_RUN_RANGE_SIZE = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_RUN_RANGE_SIZE', 2000)
+# seconds a node's lease on a range is valid, unless renewed
+DIGEST_RUN_LEASE_SECONDS = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_RUN_LEASE_SECONDS', 60*10)
+# number of times a range of a distributed run is claimed before it is marked as failed, along with its run, 
+# so that the next invocation starts a new run instead of retrying the same range forever.
+# local runs are never failed, they are resumed by hand with all of their recipients
+DIGEST_RUN_MAX_RANGE_ATTEMPTS = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_RUN_MAX_RANGE_ATTEMPTS', 3)
+
+
+class DigestRangeLeaseLost(Exception):
+    """ Raised when a node's lease on a range has expired and the range might have been claimed by another node """
+    pass
+
+
+class DigestRunConflict(Exception):
+    """ Raised when a node wants to join a distributed digest run while a local digest run is running """
+    pass
+
+
+def get_node_id():
+    """ A unique identifier for this process, used as lease owner """
+    return '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def get_or_create_digest_run(digest_setting, range_size=None):
+    """ Returns the running `DigestRun` for the current portal and a digest setting, or creates a new one
+        for the time span since the last sent digest, with all of its user id ranges.
+        Concurrently starting nodes will all end up with the same run.
+        @raise DigestRunConflict: if a local (non-distributed) run is currently running """
+    portal = CosinnusPortal.get_current()
+    range_size = range_size or DIGEST_RUN_RANGE_SIZE
+    run = DigestRun.objects.filter(portal=portal, digest_setting=digest_setting, state=DigestRun.STATE_RUNNING).first()
+    if run is not None:
+        if not run.distributed:
+            raise DigestRunConflict('A local digest run is running: %s' % str(run))
+        return run
+
+    window_start, window_end = get_digest_time_span(portal, digest_setting)
+    user_ids = get_user_model().objects.filter(id__in=portal.members).aggregate(min_id=Min('id'), max_id=Max('id'))
+    try:
+        with transaction.atomic():
+            run = DigestRun.objects.create(portal=portal, digest_setting=digest_setting,
+                                           window_start=window_start, window_end=window_end)
+            ranges = []
+            if user_ids['min_id'] is not None:
+                for user_id_start in range(user_ids['min_id'], user_ids['max_id'] + 1, range_size):
+                    ranges.append(DigestRunRange(run=run, user_id_start=user_id_start, user_id_end=user_id_start + range_size))
+            DigestRunRange.objects.bulk_create(ranges)
+    except IntegrityError:
+        # another node has created the run at the same time
+        run = DigestRun.objects.get(portal=portal, digest_setting=digest_setting, cohort='', state=DigestRun.STATE_RUNNING)
+        if not run.distributed:
+            raise DigestRunConflict('A local digest run is running: %s' % str(run))
+        return run
+    logger.info('Created a new digest run. Data in extra.', extra={'digest_run': str(run), 'ranges': len(ranges)})
+    return run
+
+
+def fail_digest_run(run, digest_range):
+    """ Marks a running run as failed because one of its ranges has failed. Its recipient markers are deleted,
+        and the next invocation starts a new run for the time span since the last sent digest.
+        Users that have already been sent the failed run's digest will get its events again! """
+    failed = DigestRun.objects.filter(id=run.id, state=DigestRun.STATE_RUNNING).update(state=DigestRun.STATE_FAILED)
+    if failed:
+        run.recipients.all().delete()
+        logger.error('A digest run range failed too many times, the digest run has failed! A new run will be started '
+                     'on the next invocation. Data in extra.', extra={'digest_run': str(run), 'digest_range': str(digest_range)})
+
+
+def fail_digest_range(digest_range):
+    """ Marks a range that has reached `DIGEST_RUN_MAX_RANGE_ATTEMPTS` as failed, along with its run """
+    DigestRunRange.objects.filter(id=digest_range.id).update(state=DigestRunRange.STATE_FAILED, lease_expires_at=None)
+    fail_digest_run(digest_range.run, digest_range)
+
+
+def claim_digest_range(run, node_id, exclude_range_ids=None, lease_seconds=None):
+    """ Leases the next pending range of a run, or a range with an expired lease, for a node.
+        Rows locked by other nodes are skipped (`SELECT ... FOR UPDATE SKIP LOCKED`).
+        A range of a distributed run with an expired lease that has already been claimed 
+        `DIGEST_RUN_MAX_RANGE_ATTEMPTS` times fails instead (its nodes have probably crashed while processing it).
+        @return: the claimed `DigestRunRange` or None if no range is available """
+    claim_time = now()
+    if not DigestRun.objects.filter(id=run.id, state=DigestRun.STATE_RUNNING).exists():
+        # the run has failed or been completed in the meantime
+        return None
+    with transaction.atomic():
+        ranges = DigestRunRange.objects.select_for_update(skip_locked=True).filter(run=run).filter(
+            Q(state=DigestRunRange.STATE_PENDING) |
+            Q(state=DigestRunRange.STATE_LEASED, lease_expires_at__lt=claim_time)
+        )
+        if exclude_range_ids:
+            ranges = ranges.exclude(id__in=exclude_range_ids)
+        digest_range = ranges.order_by('id').first()
+        if digest_range is None:
+            return None
+        if run.distributed and digest_range.attempts >= DIGEST_RUN_MAX_RANGE_ATTEMPTS:
+            fail_digest_range(digest_range)
+            return None
+        if digest_range.state == DigestRunRange.STATE_LEASED:
+            logger.warning('Taking over a digest run range with an expired lease. Data in extra.',
+                           extra={'digest_range': str(digest_range), 'node_id': node_id})
+        digest_range.state = DigestRunRange.STATE_LEASED
+        digest_range.lease_owner = node_id
+        digest_range.lease_expires_at = claim_time + timedelta(seconds=lease_seconds or DIGEST_RUN_LEASE_SECONDS)
+        digest_range.attempts += 1
+        digest_range.save(update_fields=['state', 'lease_owner', 'lease_expires_at', 'attempts'])
+    return digest_range
+
+
+def renew_digest_range_lease(digest_range, node_id, lease_seconds=None):
+    """ Extends the node's lease on a range.
+        @raise DigestRangeLeaseLost: if the node does not hold the lease anymore """
+    renewed = DigestRunRange.objects.filter(id=digest_range.id, state=DigestRunRange.STATE_LEASED, lease_owner=node_id)\
+            .update(lease_expires_at=now() + timedelta(seconds=lease_seconds or DIGEST_RUN_LEASE_SECONDS))
+    if not renewed:
+        raise DigestRangeLeaseLost('Lost the lease on %s' % str(digest_range))
+
+
+def complete_digest_range(digest_range, node_id, stats):
+    """ Marks a leased range as done, if the node still holds its lease """
+    completed = DigestRunRange.objects.filter(id=digest_range.id, state=DigestRunRange.STATE_LEASED, lease_owner=node_id)\
+            .update(state=DigestRunRange.STATE_DONE, completed_at=now(),
+                    users_emailed=stats['users_emailed'], total_users=stats['total_users'])
+    if not completed:
+        raise DigestRangeLeaseLost('Lost the lease on %s' % str(digest_range))
+
+
+def release_digest_range(digest_range, node_id):
+    """ Gives up a node's lease on a range after an error, so that other nodes may claim it again.
+        For a distributed run, the range fails instead after `DIGEST_RUN_MAX_RANGE_ATTEMPTS` """
+    if digest_range.run.distributed and digest_range.attempts >= DIGEST_RUN_MAX_RANGE_ATTEMPTS:
+        fail_digest_range(digest_range)
+        return
+    DigestRunRange.objects.filter(id=digest_range.id, state=DigestRunRange.STATE_LEASED, lease_owner=node_id)\
+            .update(state=DigestRunRange.STATE_PENDING, lease_expires_at=None)
+
+
+def try_complete_digest_run(run):
+    """ Completes a run if all of its ranges are done: saves the time of the last sent digest and
+        logs the stats of all ranges. Only ever succeeds for one node.
+        @return: True if the run was completed by this call """
+    with transaction.atomic():
+        run = DigestRun.objects.select_for_update().get(id=run.id)
+        if run.state != DigestRun.STATE_RUNNING:
+            return False
+        if run.ranges.exclude(state=DigestRunRange.STATE_DONE).exists():
+            return False
+        run.state = DigestRun.STATE_COMPLETED
+        run.completed_at = now()
+        run.save(update_fields=['state', 'completed_at'])
+        range_stats = list(run.ranges.values('users_emailed', 'total_users'))
+        finish_digest(run.portal, run.digest_setting, run.window_end, range_stats, digest_run=run)
+    return True
+
+
+def get_lease_renewal_callback(digest_range, node_id, lease_seconds=None):
+    """ Returns a progress callback for `send_digest_for_users()` that renews the node's lease on a range
+        while the digests are being sent.
+        @raise DigestRangeLeaseLost: from the callback, if the lease could not be renewed in time """
+    lease_seconds = lease_seconds or DIGEST_RUN_LEASE_SECONDS
+    last_renewal = [time.monotonic()]
+    def renew_lease(processed_users):
+        # renew after a third of the lease time, so that a single slow user doesn't make us lose the lease
+        if time.monotonic() - last_renewal[0] > lease_seconds / 3.0:
+            renew_digest_range_lease(digest_range, node_id, lease_seconds=lease_seconds)
+            last_renewal[0] = time.monotonic()
+    return renew_lease
+
+
+def is_digest_run_leased(run):
+    """ Checks if a process currently holds an unexpired lease on any range of a run """
+    return run.ranges.filter(state=DigestRunRange.STATE_LEASED, lease_expires_at__gte=now()).exists()
+
+
+def create_local_digest_run_range(run):
+    """ Creates the single range spanning all users of a local digest run, which the process sending
+        the run holds a lease on, so that the run can't be resumed while it is still being sent """
+    max_user_id = get_user_model().objects.aggregate(max_id=Max('id'))['max_id'] or 0
+    return DigestRunRange.objects.create(run=run, user_id_start=0, user_id_end=max_user_id + 1)
+
+
+def claim_local_digest_run(run, node_id, lease_seconds=None):
+    """ Leases a local digest run for this process, via its single range.
+        @return: the leased `DigestRunRange`, or None if the run isn't running anymore or another process 
+            still holds the lease """
+    if not run.ranges.exists():
+        # runs started before local runs had a range
+        create_local_digest_run_range(run)
+    digest_range = claim_digest_range(run, node_id, lease_seconds=lease_seconds)
+    if digest_range is None:
+        run.refresh_from_db(fields=['state'])
+        if run.state != DigestRun.STATE_RUNNING:
+            logger.error('Cannot send the digest run, it is not running anymore. Data in extra.',
+                         extra={'digest_run': str(run)})
+        else:
+            logger.error('Cannot send the digest run, it is being sent by another process. Data in extra.',
+                         extra={'digest_run': str(run)})
+    return digest_range
+
+
+def process_digest_range(run, digest_range, node_id, lease_seconds=None):
+    """ Sends the digests to all users in a leased range, renewing the lease while doing so.
+        @raise DigestRangeLeaseLost: if the lease could not be renewed in time """
+    portal = CosinnusPortal.get_current()
+    users = get_user_model().objects.filter(id__in=portal.members).filter(
+        id__gte=digest_range.user_id_start, id__lt=digest_range.user_id_end).order_by('id')
+
+    # users that have already been sent the digest by a node that lost its lease on the range are skipped
+    stats = send_digest_for_users(run.digest_setting, users, run.window_start, run.window_end,
+                                  progress_callback=get_lease_renewal_callback(digest_range, node_id, lease_seconds), 
+                                  digest_run=run)
+    complete_digest_range(digest_range, node_id, stats)
+    return stats
+
+
+def run_digest_node(digest_setting, range_size=None, lease_seconds=None):
+    """ Takes part in the running digest run of the current portal and a digest setting (or starts one):
+        claims and processes ranges until no more are available, then tries to complete the run.
+        Any number of nodes on any number of hosts may run this concurrently.
+        @return: the number of ranges processed by this node """
+    node_id = get_node_id()
+    run = get_or_create_digest_run(digest_setting, range_size=range_size)
+    failed_range_ids = []
+    processed_ranges = 0
+    while True:
+        digest_range = claim_digest_range(run, node_id, exclude_range_ids=failed_range_ids, lease_seconds=lease_seconds)
+        if digest_range is None:
+            break
+        try:
+            process_digest_range(run, digest_range, node_id, lease_seconds=lease_seconds)
+            processed_ranges += 1
+        except DigestRangeLeaseLost as e:
+            logger.error('Lost the lease on a digest run range while processing it! Exception was: %s' % force_text(e),
+                         extra={'digest_range': str(digest_range), 'node_id': node_id})
+        except Exception as e:
+            # let another node (or the next invocation) retry the range
+            logger.error('An error occured while processing a digest run range! Exception was: %s' % force_text(e),
+                         extra={'exception': e, 'digest_range': str(digest_range), 'node_id': node_id})
+            release_digest_range(digest_range, node_id)
+            failed_range_ids.append(digest_range.id)
+            if settings.DEBUG:
+                raise
+
+    if try_complete_digest_run(run):
+        logger.info('Completed digest run. Data in extra.', extra={'digest_run': str(run), 'node_id': node_id})
+    return processed_ranges
+
+
+def _run_digest_node_process(digest_setting, range_size, lease_seconds):
+    """ Entry point of a forked digest node process """
+    try:
+        return run_digest_node(digest_setting, range_size=range_size, lease_seconds=lease_seconds)
+    finally:
+        connections.close_all()
+
+
+def run_digest_nodes(digest_setting, workers=1, range_size=None, lease_seconds=None):
+    """ Runs `workers` digest nodes on this host, each in its own forked process if there is more than one """
+    if workers <= 1:
+        return run_digest_node(digest_setting, range_size=range_size, lease_seconds=lease_seconds)
+    # make sure the run exists before forking, the nodes will all join it
+    get_or_create_digest_run(digest_setting, range_size=range_size)
+    connections.close_all()
+    mp_context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+        futures = [executor.submit(_run_digest_node_process, digest_setting, range_size, lease_seconds)
+                   for __ in range(workers)]
+        processed_ranges = 0
+        for future in futures:
+            try:
+                processed_ranges += future.result()
+            except Exception as e:
+                logger.error('A digest node process failed! Exception was: %s' % force_text(e),
+                             extra={'exception': e, 'digest_setting': digest_setting})
+    return processed_ranges
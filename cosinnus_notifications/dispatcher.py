@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import atexit
+import logging
+import os
+import queue
+import threading
+
+from django.db import close_old_connections
+from django.utils.encoding import force_text
+
+from cosinnus.conf import settings
+from cosinnus_notifications.mail import get_notification_mailer
+
+
+logger = logging.getLogger('cosinnus')
+
+# sentinel put into the queue once for each worker to make it exit after draining
+_STOP_WORKER = object()
+
+
+class NotificationDispatcher(object):
+    """ A fixed-size pool of worker threads with a bounded queue in front of it, that processes
+        `NotificationsThread` runs (by calling their `inner_run()`).
+
+        This replaces starting a new thread for every received notification signal, so that a burst
+        of events no longer causes an unbounded number of concurrent threads and DB connections.
+        Each worker keeps at most one DB connection and one mail connection open.
+
+        Backpressure: If the queue is full, `submit()` blocks for up to `submit_timeout` seconds,
+            and if there is still no space, the notification run is executed synchronously in
+            the calling thread. This slows down the producer instead of dropping notifications.
+        Shutdown: `shutdown()` (also registered on interpreter exit) lets the workers drain all
+            queued runs before they exit.
+
+        @param num_workers: number of worker threads. If 0, all runs are executed synchronously.
+        @param queue_size: maximum number of queued notification runs before backpressure is applied
+        @param submit_timeout: seconds `submit()` will wait for a free queue slot """
+
+    def __init__(self, num_workers, queue_size, submit_timeout):
+        self.num_workers = max(int(num_workers), 0)
+        self.queue_size = max(int(queue_size), 1)
+        self.submit_timeout = submit_timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """ (Re-)creates the queue and worker list. Also used after a process fork,
+            because worker threads do not survive a fork. """
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self.workers = []
+        self.is_shut_down = False
+        self._pid = os.getpid()
+
+    @property
+    def queue_depth(self):
+        """ The approximate number of notification runs currently waiting for a worker """
+        return self.queue.qsize()
+
+    def _ensure_workers(self):
+        """ Lazily starts the worker threads on first use (and again in a forked child process) """
+        if self.workers and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            if self.workers or self.is_shut_down:
+                return
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self._worker_loop, name='cosinnus-notifications-%d' % i)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, notification_thread):
+        """ Queues a `NotificationsThread` to be run by one of the workers.
+            Blocks or runs it synchronously if the queue is full (see class docstring). """
+        if self.num_workers == 0 or self.is_shut_down:
+            self._run(notification_thread)
+            return
+        self._ensure_workers()
+        try:
+            self.queue.put(notification_thread, timeout=self.submit_timeout)
+        except queue.Full:
+            logger.warning('Cosinnus_notifications: Notification dispatcher queue is full, running notification in the calling thread.',
+                           extra={'queue_depth': self.queue_depth, 'workers': self.num_workers})
+            self._run(notification_thread)
+
+    def _worker_loop(self):
+        while True:
+            notification_thread = self.queue.get()
+            try:
+                if notification_thread is _STOP_WORKER:
+                    get_notification_mailer().close()
+                    return
+                # drop DB connections that are broken or past their max age before and after each run
+                close_old_connections()
+                self._run(notification_thread, keep_mail_connection=True)
+                close_old_connections()
+            finally:
+                self.queue.task_done()
+
+    def _run(self, notification_thread, keep_mail_connection=False):
+        """ Runs a notification and sends out all of its mails.
+            @param keep_mail_connection: if True, the thread's mail connection is kept open for the next run.
+                Only workers keep their connection, runs in the calling thread close it. """
+        try:
+            notification_thread.inner_run()
+        except Exception as e:
+            logger.exception('Cosinnus_notifications: An error occured while processing a notification run! Exception in extra.',
+                             extra={'exception': force_text(e), 'notification_id': getattr(notification_thread, 'notification_id', None)})
+        finally:
+            mailer = get_notification_mailer()
+            if keep_mail_connection:
+                mailer.flush()
+            else:
+                mailer.close()
+
+    def shutdown(self, wait=True, timeout=None):
+        """ Stops accepting new work into the queue and lets the workers finish all queued runs.
+            Any runs submitted after this are executed synchronously. """
+        with self._lock:
+            if self.is_shut_down or self._pid != os.getpid():
+                return
+            self.is_shut_down = True
+            workers = list(self.workers)
+        for __ in workers:
+            self.queue.put(_STOP_WORKER)
+        if wait:
+            for worker in workers:
+                worker.join(timeout)
+        remaining = self.queue_depth
+        if remaining:
+            logger.warning('Cosinnus_notifications: Notification dispatcher shut down with runs still queued!',
+                           extra={'queue_depth': remaining})
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_notification_dispatcher():
+    """ Returns the process-wide `NotificationDispatcher`, configured by the settings
+        `COSINNUS_NOTIFICATIONS_DISPATCHER_WORKERS`, `COSINNUS_NOTIFICATIONS_DISPATCHER_QUEUE_SIZE`
+        and `COSINNUS_NOTIFICATIONS_DISPATCHER_SUBMIT_TIMEOUT`. """
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = NotificationDispatcher(
+                    num_workers=getattr(settings, 'COSINNUS_NOTIFICATIONS_DISPATCHER_WORKERS', 4),
+                    queue_size=getattr(settings, 'COSINNUS_NOTIFICATIONS_DISPATCHER_QUEUE_SIZE', 200),
+                    submit_timeout=getattr(settings, 'COSINNUS_NOTIFICATIONS_DISPATCHER_SUBMIT_TIMEOUT', 5),
+                )
+                atexit.register(_dispatcher.shutdown)
+    return _dispatcher
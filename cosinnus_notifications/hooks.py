@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 from cosinnus.core import signals
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch.dispatcher import receiver
 from annoying.functions import get_object_or_None
-from cosinnus_notifications.models import UserNotificationPreference
+from cosinnus_notifications.models import UserNotificationPreference,\
+    UserMultiNotificationPreference
 from cosinnus_notifications.notifications import ALL_NOTIFICATIONS_ID,\
     NO_NOTIFICATIONS_ID
 from cosinnus.conf import settings
@@ -17,4 +20,12 @@ def assign_default_group_notification_preference_on_group_join(sender, user, gro
     pref_all = get_object_or_None(UserNotificationPreference, user=user, group=group, notification_id=ALL_NOTIFICATIONS_ID)
     if not pref_all:
         pref_all = UserNotificationPreference.objects.create(user=user, group=group, notification_id=ALL_NOTIFICATIONS_ID, setting=default_setting)
+
+
+@receiver(post_save, sender=UserMultiNotificationPreference)
+@receiver(post_delete, sender=UserMultiNotificationPreference)
+def clear_multi_notification_preference_cache(sender, instance, **kwargs):
+    """ Invalidate the cached multi preference settings of the user, once the change is committed """
+    user_id, portal_id = instance.user_id, instance.portal_id
+    transaction.on_commit(lambda: UserMultiNotificationPreference.clear_cache_for_user(user_id, portal_id))
     
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import mailbox
+import os
+import re
+import threading
+import time
+
+from django.core.mail import get_connection
+from django.core.mail.message import EmailMessage
+from django.utils.encoding import force_text
+
+from cosinnus.conf import settings
+
+
+logger = logging.getLogger('cosinnus')
+
+# characters replaced in the file names of mails written by `EmailFileWriter`
+_UNSAFE_FILE_NAME_CHARS = re.compile(r'[^\w.@+-]')
+
+# number of buffered messages that are handed to the mail backend in a single `send_messages()` call
+MAIL_BATCH_SIZE = getattr(settings, 'COSINNUS_NOTIFICATIONS_MAIL_BATCH_SIZE', 50)
+# maximum number of messages sent over one mail backend connection before it is re-opened. 0 for no limit
+MAIL_MAX_MESSAGES_PER_CONNECTION = getattr(settings, 'COSINNUS_NOTIFICATIONS_MAIL_MAX_MESSAGES_PER_CONNECTION', 500)
+# an open connection that has not been used for this many seconds is re-opened before sending,
+# as the mail server has likely dropped it
+MAIL_CONNECTION_MAX_IDLE_SECONDS = getattr(settings, 'COSINNUS_NOTIFICATIONS_MAIL_CONNECTION_MAX_IDLE_SECONDS', 30)
+
+
+def build_html_mail_message(to, subject, html_content, from_email=None):
+    """ Builds a single-part HTML email message from an already rendered HTML mail body,
+        in the same format as `send_mail_or_fail(..., is_html=True)` sends.
+        Used instead of `send_mail_or_fail()` where the same rendered mail body is
+        reused for many recipients. """
+    if from_email is None:
+        from_email = settings.COSINNUS_DEFAULT_FROM_EMAIL
+    # newlines would break the mail header
+    subject = ' '.join(force_text(subject).splitlines())
+    message = EmailMessage(subject, html_content, from_email, [to])
+    message.content_subtype = 'html'
+    return message
+
+
+def build_text_mail_message(to, subject, text_content, from_email=None):
+    """ Builds a plain text email message from an already rendered mail body """
+    if from_email is None:
+        from_email = settings.COSINNUS_DEFAULT_FROM_EMAIL
+    subject = ' '.join(force_text(subject).splitlines())
+    return EmailMessage(subject, text_content, from_email, [to])
+
+
+def send_mail_message_or_fail(message):
+    """ Sends a prepared email message. Errors are logged and never raised, like in `send_mail_or_fail()` """
+    try:
+        message.send()
+        return True
+    except Exception as e:
+        logger.error('Cosinnus_notifications: Failed to send a notification mail!',
+                     extra={'exception': force_text(e), 'to': message.to, 'subject': message.subject})
+        return False
+
+
+class NotificationMailer(object):
+    """ Sends notification mails over one long-lived mail backend connection, instead of opening
+        a new connection (and for SMTP, doing a new TLS handshake) for every single message.
+        
+        Messages passed to `send()` are buffered and handed to the backend in batches of
+        `batch_size` via `send_messages()`. The connection is re-opened after `max_messages_per_connection`
+        messages and when it has been idle for too long. Call `flush()` after a unit of work
+        to send out all buffered messages, and `close()` once done with the mailer.
+        
+        If a batch fails, its messages are re-sent one at a time on a fresh connection, so that a single
+        refused recipient doesn't cost the whole batch. `flush()` returns the messages that could not be sent.
+        
+        Like `send_mail_or_fail()`, sending errors are logged and never raised.
+        Not thread-safe: use one mailer per thread, e.g. via `get_notification_mailer()`. """
+    
+    def __init__(self, batch_size=None, max_messages_per_connection=None, max_idle_seconds=None):
+        self.batch_size = max(int(batch_size or MAIL_BATCH_SIZE), 1)
+        self.max_messages_per_connection = MAIL_MAX_MESSAGES_PER_CONNECTION \
+                if max_messages_per_connection is None else max_messages_per_connection
+        self.max_idle_seconds = MAIL_CONNECTION_MAX_IDLE_SECONDS if max_idle_seconds is None else max_idle_seconds
+        self.connection = None
+        self.connection_message_count = 0
+        self.connection_last_used = None
+        self.pending_messages = []
+        # messages that failed since the last `flush()`, including those of batches sent by `send()`
+        self.failed_messages = []
+        # total counts, for logging
+        self.sent_count = 0
+        self.failed_count = 0
+    
+    def send(self, message):
+        """ Buffers a prepared email message, sending out the buffer once a batch is full """
+        self.pending_messages.append(message)
+        if len(self.pending_messages) >= self.batch_size:
+            self._send_pending()
+    
+    def _get_connection(self):
+        """ Returns the open connection, or (re-)opens one if there is none, it has been idle for too long,
+            or it has reached its message limit """
+        if self.connection is not None:
+            idle_seconds = time.monotonic() - self.connection_last_used
+            message_limit_reached = self.max_messages_per_connection and \
+                    self.connection_message_count >= self.max_messages_per_connection
+            if message_limit_reached or idle_seconds > self.max_idle_seconds:
+                self.close_connection()
+        if self.connection is None:
+            self.connection = get_connection()
+            self.connection.open()
+            self.connection_message_count = 0
+        return self.connection
+    
+    def _send_batch(self, messages):
+        """ Sends a batch of messages, falling back to sending them one at a time if the batch fails.
+            @return: the list of messages that could not be sent """
+        try:
+            connection = self._get_connection()
+            sent = connection.send_messages(messages) or 0
+            self.connection_message_count += len(messages)
+            self.connection_last_used = time.monotonic()
+        except Exception as e:
+            logger.warning('Cosinnus_notifications: Failed to send a batch of notification mails, sending them one by one.',
+                           extra={'exception': force_text(e), 'batch_size': len(messages)})
+            # the connection may be in an undefined state now, so never reuse it
+            self.close_connection()
+            return self._send_one_by_one(messages)
+        failed_messages = []
+        if sent < len(messages):
+            # the backend skips messages without any recipients instead of raising
+            failed_messages = [message for message in messages if not message.recipients()]
+        self.sent_count += len(messages) - len(failed_messages)
+        self.failed_count += len(failed_messages)
+        return failed_messages
+    
+    def _send_one_by_one(self, messages):
+        """ Sends each message on its own, opening a fresh connection after each failure.
+            @return: the list of messages that could not be sent """
+        failed_messages = []
+        for message in messages:
+            try:
+                connection = self._get_connection()
+                sent = connection.send_messages([message]) or 0
+                self.connection_message_count += 1
+                self.connection_last_used = time.monotonic()
+            except Exception as e:
+                sent = 0
+                logger.error('Cosinnus_notifications: Failed to send a notification mail!',
+                             extra={'exception': force_text(e), 'to': message.to, 'subject': message.subject})
+                self.close_connection()
+            if sent:
+                self.sent_count += 1
+            else:
+                self.failed_count += 1
+                failed_messages.append(message)
+        return failed_messages
+    
+    def _send_pending(self):
+        """ Sends all buffered messages in batches, collecting the failed ones in `failed_messages` """
+        while self.pending_messages:
+            batch_size = self.batch_size
+            if self.max_messages_per_connection:
+                # don't let a batch span the connection's message limit
+                remaining = self.max_messages_per_connection - self.connection_message_count
+                if self.connection is None or remaining <= 0:
+                    # a new connection will be opened for this batch
+                    remaining = self.max_messages_per_connection
+                batch_size = min(batch_size, remaining)
+            messages = self.pending_messages[:batch_size]
+            self.pending_messages = self.pending_messages[batch_size:]
+            self.failed_messages.extend(self._send_batch(messages))
+    
+    def flush(self):
+        """ Sends all buffered messages. The connection is kept open for further messages.
+            @return: the list of messages that could not be sent since the last flush """
+        self._send_pending()
+        failed_messages = self.failed_messages
+        self.failed_messages = []
+        return failed_messages
+    
+    def close_connection(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+        self.connection_message_count = 0
+    
+    def close(self):
+        """ Sends all buffered messages and closes the connection """
+        self.flush()
+        self.close_connection()
+
+
+class EmailFileWriter(object):
+    """ A drop-in replacement for `NotificationMailer` that writes the messages to files instead of sending them,
+        for inspecting, benchmarking and diffing generated mails without a mail server.
+        Each message is written as a `<recipient>.eml` file into `output_dir`, or appended to a single
+        `messages.mbox` file there if `mbox` is set. """
+    
+    def __init__(self, output_dir, mbox=False):
+        self.output_dir = output_dir
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        self.mbox = mailbox.mbox(os.path.join(output_dir, 'messages.mbox')) if mbox else None
+        self.failed_messages = []
+        self.sent_count = 0
+        self.failed_count = 0
+    
+    def _get_file_path(self, message):
+        file_name = _UNSAFE_FILE_NAME_CHARS.sub('_', ','.join(message.to)) or 'message'
+        file_path = os.path.join(self.output_dir, '%s.eml' % file_name)
+        counter = 1
+        while os.path.exists(file_path):
+            counter += 1
+            file_path = os.path.join(self.output_dir, '%s_%d.eml' % (file_name, counter))
+        return file_path
+    
+    def send(self, message):
+        try:
+            if self.mbox is not None:
+                self.mbox.add(message.message())
+            else:
+                with open(self._get_file_path(message), 'wb') as eml_file:
+                    eml_file.write(message.message().as_bytes())
+            self.sent_count += 1
+        except Exception as e:
+            self.failed_count += 1
+            self.failed_messages.append(message)
+            logger.error('Cosinnus_notifications: Failed to write a notification mail to a file!',
+                         extra={'exception': force_text(e), 'to': message.to, 'output_dir': self.output_dir})
+    
+    def flush(self):
+        if self.mbox is not None:
+            self.mbox.flush()
+        failed_messages = self.failed_messages
+        self.failed_messages = []
+        return failed_messages
+    
+    def close(self):
+        if self.mbox is not None:
+            self.mbox.close()
+            self.mbox = None
+
+
+_thread_local = threading.local()
+
+
+def get_notification_mailer():
+    """ Returns the `NotificationMailer` of the current thread, so that each notification worker
+        thread sends all of its mails over its own long-lived connection """
+    mailer = getattr(_thread_local, 'notification_mailer', None)
+    if mailer is None:
+        mailer = NotificationMailer()
+        _thread_local.notification_mailer = mailer
+    return mailer
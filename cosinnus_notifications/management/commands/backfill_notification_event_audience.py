@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cosinnus_notifications.models import NotificationEvent, NotificationEventAudience
+
+logger = logging.getLogger('cosinnus')
+
+
+class Command(BaseCommand):
+    help = 'Creates the indexed audience entries for all existing notification events that do not have them yet. ' + \
+        'Needs to be run once after migrating, before enabling COSINNUS_NOTIFICATIONS_DIGEST_USE_AUDIENCE_INDEX, ' + \
+        'so that digests contain events created before the migration.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of notification events processed per transaction')
+
+    def handle(self, *args, **options):
+        events = NotificationEvent.objects.filter(audience_entries__isnull=True).order_by('id')\
+                    .only('id', 'audience')
+        last_id = 0
+        total_events = 0
+        while True:
+            batch = list(events.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            audience_user_ids = dict([(event.id, event.get_audience_user_ids()) for event in batch])
+            # old audiences may contain users that have since been deleted
+            existing_user_ids = set(get_user_model().objects.filter(
+                id__in=set([user_id for user_ids in audience_user_ids.values() for user_id in user_ids])
+            ).values_list('id', flat=True))
+            with transaction.atomic():
+                for event in batch:
+                    NotificationEventAudience.create_for_event(event, user_ids=[
+                        user_id for user_id in audience_user_ids[event.id] if user_id in existing_user_ids])
+            last_id = batch[-1].id
+            total_events += len(batch)
+            if options['verbosity'] > 1:
+                self.stdout.write('Backfilled audience entries for %d notification events...' % total_events)
+        
+        logger.info('Backfilled audience entries for notification events.', extra={'event_count': total_events})
+        self.stdout.write('Backfilled audience entries for %d notification events.' % total_events)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import time
+import traceback
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils.encoding import force_text
+
+from cosinnus.conf import settings
+from cosinnus.core.middleware.cosinnus_middleware import initialize_cosinnus_after_startup
+from cosinnus_notifications.outbox import process_outbox_batch
+
+logger = logging.getLogger('cosinnus')
+
+
+class Command(BaseCommand):
+    help = 'Processes pending notifications from the notification outbox. Any number of these workers may run concurrently.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Number of outbox entries claimed per batch')
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Keep polling for new entries instead of exiting once the outbox is empty')
+        parser.add_argument('--sleep', type=float, default=5.0,
+                            help='Seconds to wait between polls when the outbox is empty (only with --loop)')
+        parser.add_argument('--max-batches', type=int, default=0,
+                            help='Exit after this many batches (0 for no limit)')
+
+    def handle(self, *args, **options):
+        initialize_cosinnus_after_startup()
+        batches = 0
+        total_claimed = 0
+        total_processed = 0
+        while True:
+            try:
+                claimed, processed = process_outbox_batch(options['batch_size'])
+            except Exception as e:
+                logger.error('An error occured while claiming notification outbox entries! Exception was: %s' % force_text(e),
+                             extra={'exception': e, 'trace': traceback.format_exc()})
+                if settings.DEBUG:
+                    raise
+                claimed, processed = 0, 0
+            close_old_connections()
+            batches += 1
+            total_claimed += claimed
+            total_processed += processed
+            if options['max_batches'] and batches >= options['max_batches']:
+                break
+            if claimed == 0:
+                if not options['loop']:
+                    break
+                time.sleep(options['sleep'])
+        
+        if options['verbosity'] > 1:
+            self.stdout.write('Processed %d of %d claimed notification outbox entries.' % (total_processed, total_claimed))
@@ -6,7 +6,9 @@ import traceback
 
 from django.core.management.base import BaseCommand, CommandError
 from cosinnus.conf import settings
-from cosinnus_notifications.digest import send_digest_for_current_portal
+from cosinnus_notifications.digest import send_digest_for_current_portal,\
+    render_digests_for_current_portal, DIGEST_LOCAL_SEND_HOUR
+from cosinnus_notifications.digest_runs import run_digest_nodes
 from cosinnus_notifications.models import UserNotificationPreference
 from cosinnus.core.middleware.cosinnus_middleware import initialize_cosinnus_after_startup
 from django.utils.encoding import force_text
@@ -17,10 +19,60 @@ logger = logging.getLogger('cosinnus')
 class Command(BaseCommand):
     help = 'Closes the specified poll for voting'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_WORKERS', 1),
+                            help='Number of worker processes to split the users into (by user id) and generate digests in parallel. '
+                                 'To split a digest run across several hosts, use --distributed')
+        parser.add_argument('--distributed', action='store_true', default=False,
+                            help='Take part in a digest run shared by several hosts, by leasing user id ranges from the DB')
+        parser.add_argument('--range-size', type=int, default=None,
+                            help='Number of user ids per leased range when starting a new distributed digest run')
+        parser.add_argument('--lease-seconds', type=int, default=None,
+                            help='Seconds a lease on a range is valid before another host may take it over')
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help='Resume the last interrupted digest run, skipping all users that have already been sent its digest. '
+                                 'Distributed digest runs are always resumed')
+        parser.add_argument('--render-only', action='store_true', default=False,
+                            help='Render the digests and write them into --output-dir instead of sending them. Saves nothing')
+        parser.add_argument('--output-dir', default=None,
+                            help='The directory the digest mails are written into with --render-only')
+        parser.add_argument('--mbox', action='store_true', default=False,
+                            help='With --render-only, write all digest mails into a single mbox file instead of one .eml file each')
+        parser.add_argument('--sample', type=int, default=None,
+                            help='With --render-only, only render the digests of a random sample of this many users')
+        parser.add_argument('--sample-seed', type=int, default=0,
+                            help='The seed for picking the --sample, to render the same sample again')
+        parser.add_argument('--report-file', default=None,
+                            help='Also write the timings of the digest run into this file as JSON report. '
+                                 'Not supported with --distributed, where each range logs its own timings')
+        parser.add_argument('--send-hour', type=int, default=DIGEST_LOCAL_SEND_HOUR,
+                            help='Deliver the digests staggered by the users\' timezones, once their local time has reached '
+                                 'this hour (0-23). The command should then be run hourly')
+
     def handle(self, *args, **options):
+        if options['render_only']:
+            if not options['output_dir']:
+                raise CommandError('--render-only requires an --output-dir!')
+            initialize_cosinnus_after_startup()
+            stats = render_digests_for_current_portal(UserNotificationPreference.SETTING_WEEKLY, options['output_dir'],
+                    sample_size=options['sample'], sample_seed=options['sample_seed'], mbox=options['mbox'],
+                    report_file=options['report_file'])
+            self.stdout.write('Rendered %(users_emailed)d digests for %(total_users)d users in %(duration_seconds).1fs.' % stats)
+            return
+        if options['send_hour'] is not None:
+            if not 0 <= options['send_hour'] <= 23:
+                raise CommandError('--send-hour must be an hour between 0 and 23!')
+            if options['distributed']:
+                raise CommandError('--distributed does not support staggered digest delivery with --send-hour!')
         try:
             initialize_cosinnus_after_startup()
-            send_digest_for_current_portal(UserNotificationPreference.SETTING_WEEKLY)
+            if options['distributed']:
+                run_digest_nodes(UserNotificationPreference.SETTING_WEEKLY, workers=max(options['workers'], 1),
+                                 range_size=options['range_size'], lease_seconds=options['lease_seconds'])
+            else:
+                send_digest_for_current_portal(UserNotificationPreference.SETTING_WEEKLY, workers=max(options['workers'], 1),
+                                               resume=options['resume'], report_file=options['report_file'],
+                                               send_hour=options['send_hour'])
         except Exception as e:
             logger.error('An critical error occured during weekly digest generation and bubbled up completely! Exception was: %s' % force_text(e),
                          extra={'exception': e, 'trace': traceback.format_exc()})
@@ -0,0 +1,35 @@
+# Generated by Django 3.2 on 2026-10-18 10:00
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cosinnus', '0051_auto_20191017_2138'),
+        ('cosinnus_notifications', '0010_auto_20220117_1735'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationOutboxEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('frames', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, help_text='A list of serialized notification frames (ids only) that are run sequentially, in one session.')),
+                ('state', models.PositiveSmallIntegerField(choices=[(0, 'Pending'), (1, 'Processing'), (2, 'Failed')], db_index=True, default=0)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('claimed_at', models.DateTimeField(blank=True, help_text='When the entry was last claimed by a worker. Stale claims are picked up again.', null=True)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('portal', models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, related_name='notification_outbox_entries', to='cosinnus.CosinnusPortal', verbose_name='Portal')),
+            ],
+            options={
+                'verbose_name': 'Notification Outbox Entry',
+                'verbose_name_plural': 'Notification Outbox Entries',
+                'ordering': ('id',),
+                'index_together': {('state', 'portal')},
+            },
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 3.2 on 2026-10-18 14:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cosinnus', '0051_auto_20191017_2138'),
+        ('cosinnus_notifications', '0012_notificationeventaudience'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DigestRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest_setting', models.PositiveSmallIntegerField(help_text='UserNotificationPreference.SETTING_DAILY or UserNotificationPreference.SETTING_WEEKLY')),
+                ('window_start', models.DateTimeField()),
+                ('window_end', models.DateTimeField()),
+                ('state', models.PositiveSmallIntegerField(choices=[(0, 'Running'), (1, 'Completed')], db_index=True, default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('portal', models.ForeignKey(default=1, on_delete=django.db.models.deletion.CASCADE, related_name='digest_runs', to='cosinnus.CosinnusPortal', verbose_name='Portal')),
+            ],
+            options={
+                'verbose_name': 'Digest Run',
+                'verbose_name_plural': 'Digest Runs',
+                'ordering': ('-id',),
+                'unique_together': {('portal', 'digest_setting', 'window_end')},
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='digestrun',
+            constraint=models.UniqueConstraint(condition=models.Q(state=0), fields=('portal', 'digest_setting'), name='cosinnus_notifications_unique_running_digest_run'),
+        ),
+        migrations.CreateModel(
+            name='DigestRunRange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id_start', models.PositiveIntegerField()),
+                ('user_id_end', models.PositiveIntegerField()),
+                ('state', models.PositiveSmallIntegerField(choices=[(0, 'Pending'), (1, 'Leased'), (2, 'Done')], default=0)),
+                ('lease_owner', models.CharField(blank=True, help_text='The node currently holding (or last holding) the lease on this range', max_length=250, null=True)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('users_emailed', models.PositiveIntegerField(default=0)),
+                ('total_users', models.PositiveIntegerField(default=0)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ranges', to='cosinnus_notifications.digestrun')),
+            ],
+            options={
+                'verbose_name': 'Digest Run Range',
+                'verbose_name_plural': 'Digest Run Ranges',
+                'ordering': ('id',),
+                'index_together': {('run', 'state')},
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2 on 2026-10-18 16:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        migrations.swappable_dependency(settings.COSINNUS_GROUP_OBJECT_MODEL),
+        ('cosinnus_notifications', '0013_digestrun_digestrunrange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DigestBufferEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest_setting', models.PositiveSmallIntegerField(help_text='UserNotificationPreference.SETTING_DAILY or UserNotificationPreference.SETTING_WEEKLY')),
+                ('notification_id', models.CharField(max_length=100)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='digest_buffer_entries', to='cosinnus_notifications.notificationevent')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.COSINNUS_GROUP_OBJECT_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'digest_setting', 'event')},
+            },
+        ),
+    ]
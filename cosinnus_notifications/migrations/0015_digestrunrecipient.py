@@ -0,0 +1,38 @@
+# Generated by Django 3.2 on 2026-10-18 18:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cosinnus_notifications', '0014_digestbufferentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='digestrun',
+            name='distributed',
+            field=models.BooleanField(default=True, help_text='If the run is shared by several nodes via its ranges, or sent by a single (local) command'),
+        ),
+        migrations.AlterField(
+            model_name='digestrun',
+            name='state',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Running'), (1, 'Completed'), (2, 'Abandoned')], db_index=True, default=0),
+        ),
+        migrations.CreateModel(
+            name='DigestRunRecipient',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sent_at', models.DateTimeField(auto_now_add=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='cosinnus_notifications.digestrun')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('run', 'user')},
+            },
+        ),
+    ]
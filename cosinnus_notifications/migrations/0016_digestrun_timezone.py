@@ -0,0 +1,30 @@
+# Generated by Django 3.2 on 2026-10-18 19:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cosinnus_notifications', '0015_digestrunrecipient'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='digestrun',
+            name='cosinnus_notifications_unique_running_digest_run',
+        ),
+        migrations.AddField(
+            model_name='digestrun',
+            name='timezone',
+            field=models.CharField(blank=True, default='', help_text="With staggered digest delivery, the timezone of the run's users. Empty for runs of all users", max_length=100),
+        ),
+        migrations.AlterUniqueTogether(
+            name='digestrun',
+            unique_together={('portal', 'digest_setting', 'timezone', 'window_end')},
+        ),
+        migrations.AddConstraint(
+            model_name='digestrun',
+            constraint=models.UniqueConstraint(condition=models.Q(state=0), fields=('portal', 'digest_setting', 'timezone'), name='cosinnus_notifications_unique_running_digest_run'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-18 20:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cosinnus_notifications', '0016_digestrun_timezone'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='digestrun',
+            name='state',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Running'), (1, 'Completed'), (2, 'Abandoned'), (3, 'Failed')], db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name='digestrunrange',
+            name='state',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Pending'), (1, 'Leased'), (2, 'Done'), (3, 'Failed')], default=0),
+        ),
+    ]
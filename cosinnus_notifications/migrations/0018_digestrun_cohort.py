@@ -0,0 +1,44 @@
+# Generated by Django 3.2 on 2026-10-18 21:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cosinnus_notifications', '0017_digestrun_failed_state'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='digestrun',
+            name='cosinnus_notifications_unique_running_digest_run',
+        ),
+        migrations.AlterUniqueTogether(
+            name='digestrun',
+            unique_together=set(),
+        ),
+        migrations.RenameField(
+            model_name='digestrun',
+            old_name='timezone',
+            new_name='cohort',
+        ),
+        migrations.AlterField(
+            model_name='digestrun',
+            name='cohort',
+            field=models.CharField(blank=True, default='', help_text="With staggered digest delivery, the key of the run's cohort of timezones. Empty for runs of all users", max_length=100),
+        ),
+        migrations.AddField(
+            model_name='digestrun',
+            name='timezones',
+            field=models.TextField(blank=True, default='', help_text="With staggered digest delivery, the comma-separated timezones of the run's users"),
+        ),
+        migrations.AlterUniqueTogether(
+            name='digestrun',
+            unique_together={('portal', 'digest_setting', 'cohort', 'window_end')},
+        ),
+        migrations.AddConstraint(
+            model_name='digestrun',
+            constraint=models.UniqueConstraint(condition=models.Q(state=0), fields=('portal', 'digest_setting', 'cohort'), name='cosinnus_notifications_unique_running_digest_run'),
+        ),
+    ]
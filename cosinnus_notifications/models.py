@@ -6,9 +6,9 @@ from builtins import str
 import logging
 import six
 
-from annoying.functions import get_object_or_None
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.db.models import Q
@@ -28,6 +28,14 @@ logger = logging.getLogger('cosinnus')
 # global for from cosinnus_notifications.notifications import notifications
 NOTIFICATIONS_DICT = None
 
+# one cache entry holds all of a user's stored multi notification preferences in a portal
+MULTI_NOTIFICATION_PREFERENCE_CACHE_KEY = 'cosinnus/notifications/multi_preferences/portal/%(portal_id)s/user/%(user_id)s'
+MULTI_NOTIFICATION_PREFERENCE_CACHE_TIMEOUT = getattr(settings, 'COSINNUS_NOTIFICATIONS_MULTI_PREFERENCE_CACHE_TIMEOUT', 60*60*24)
+# maximum number of users retrieved in one cache/DB lookup in `get_settings_for_users()`
+MULTI_NOTIFICATION_PREFERENCE_CHUNK_SIZE = 1000
+# number of `NotificationEventAudience` entries written in one query
+NOTIFICATION_EVENT_AUDIENCE_BATCH_SIZE = 1000
+
 
 class BaseUserNotificationPreference(models.Model):
     
@@ -117,18 +125,57 @@ class UserMultiNotificationPreference(BaseUserNotificationPreference):
         }
         
     @classmethod
-    def get_setting_for_user(cls, user, multi_notification_id, portal=None):
-        """ Gets the setting for a multi-preference set for a user, or the default value
-            TODO: cache!
-        """
+    def _get_cache_key(cls, user_id, portal_id):
+        return MULTI_NOTIFICATION_PREFERENCE_CACHE_KEY % {'portal_id': portal_id, 'user_id': user_id}
+    
+    @classmethod
+    def get_settings_for_users(cls, user_ids, portal=None):
+        """ Gets all stored multi-preference settings for many users, using one cache entry per user
+            and a single query for all users missing from the cache.
+            @return: a dict of {user_id: {multi_notification_id: setting}}. Contains an entry for each given user,
+                but the inner dicts only contain settings the user has explicitly stored, not the defaults! """
         if portal is None:
             portal = CosinnusPortal.get_current()
-        multi_pref = get_object_or_None(cls, user=user, multi_notification_id=multi_notification_id, portal=portal)
-        if multi_pref is not None:
-            return multi_pref.setting
+        user_ids = list(user_ids)
+        user_settings = {}
+        for i in range(0, len(user_ids), MULTI_NOTIFICATION_PREFERENCE_CHUNK_SIZE):
+            cache_keys = dict([(cls._get_cache_key(user_id, portal.id), user_id) for user_id in 
+                               user_ids[i:i + MULTI_NOTIFICATION_PREFERENCE_CHUNK_SIZE]])
+            cached = cache.get_many(list(cache_keys.keys()))
+            missing_user_settings = {}
+            for cache_key, user_id in cache_keys.items():
+                if cache_key in cached:
+                    user_settings[user_id] = cached[cache_key]
+                else:
+                    missing_user_settings[user_id] = {}
+            if missing_user_settings:
+                multi_prefs = cls.objects.filter(user_id__in=list(missing_user_settings.keys()), portal=portal)\
+                    .values_list('user_id', 'multi_notification_id', 'setting')
+                for user_id, multi_notification_id, setting in multi_prefs:
+                    missing_user_settings[user_id][multi_notification_id] = setting
+                cache.set_many(dict([(cls._get_cache_key(user_id, portal.id), settings_dict) for user_id, settings_dict in 
+                                     missing_user_settings.items()]), MULTI_NOTIFICATION_PREFERENCE_CACHE_TIMEOUT)
+                user_settings.update(missing_user_settings)
+        return user_settings
+    
+    @classmethod
+    def get_settings_for_user(cls, user, portal=None):
+        """ Gets all stored multi-preference settings for a user as dict of {multi_notification_id: setting} (cached) """
+        return cls.get_settings_for_users([user.id], portal=portal)[user.id]
+    
+    @classmethod
+    def get_setting_for_user(cls, user, multi_notification_id, portal=None):
+        """ Gets the setting for a multi-preference set for a user, or the default value """
+        setting = cls.get_settings_for_user(user, portal=portal).get(multi_notification_id, None)
+        if setting is not None:
+            return setting
         else:
             from cosinnus_notifications.notifications import MULTI_NOTIFICATION_IDS
             return MULTI_NOTIFICATION_IDS[multi_notification_id]
+    
+    @classmethod
+    def clear_cache_for_user(cls, user_id, portal_id):
+        cache.delete(cls._get_cache_key(user_id, portal_id))
 
 
 @six.python_2_unicode_compatible
@@ -154,6 +201,17 @@ class NotificationEvent(models.Model):
     
     date = models.DateTimeField(auto_now_add=True, editable=False)
     
+    def get_audience_user_ids(self):
+        """ Parses the pseudo comma-seperated `audience` field.
+            @return: a list of the unique user ids in the audience, in order """
+        user_ids = []
+        seen_user_ids = set()
+        for user_id in self.audience.split(','):
+            if user_id.isdigit() and int(user_id) not in seen_user_ids:
+                seen_user_ids.add(int(user_id))
+                user_ids.append(int(user_id))
+        return user_ids
+    
     def __str__(self):
         return "<NotificationEvent: %(user)s, group: %(group)s, notification_id: %(notification_id)s, date: %(date)s>" % {
             'user': self.user,
@@ -163,6 +221,253 @@ class NotificationEvent(models.Model):
         }
 
 
+@six.python_2_unicode_compatible
+class NotificationEventAudience(models.Model):
+    """ An indexed (user, event) entry for each user in the audience of a `NotificationEvent`.
+        Used to retrieve all events of a user for the digest with an index lookup, instead of
+        scanning the `NotificationEvent.audience` text field. """
+    
+    class Meta(object):
+        unique_together = (('user', 'event'),)
+    
+    event = models.ForeignKey(NotificationEvent, related_name='audience_entries', on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE)
+    
+    @classmethod
+    def create_for_event(cls, event, user_ids=None):
+        """ Creates the audience entries for a `NotificationEvent` in bulk.
+            @param user_ids: the event's audience user ids. if None, they are parsed from the event """
+        if user_ids is None:
+            user_ids = event.get_audience_user_ids()
+        cls.objects.bulk_create([cls(event_id=event.id, user_id=user_id) for user_id in user_ids],
+                                batch_size=NOTIFICATION_EVENT_AUDIENCE_BATCH_SIZE, ignore_conflicts=True)
+    
+    def __str__(self):
+        return "<NotificationEventAudience: event: %(event_id)s, user: %(user_id)s>" % {
+            'event_id': self.event_id,
+            'user_id': self.user_id,
+        }
+
+
+@six.python_2_unicode_compatible
+class DigestBufferEntry(models.Model):
+    """ A notification event that will appear in a user's daily or weekly digest, appended to the user's
+        digest buffer at event time if `COSINNUS_NOTIFICATIONS_DIGEST_BUFFER_ENABLED` is set.
+        Only created for audience users whose group preferences put the event into that digest. Events reaching
+        a digest through a multi preference are selected by the digest run itself.
+        A digest run then reads its users' buffers instead of selecting their candidate events
+        from all events of its time span, and truncates the buffers once it is finished. """
+    
+    class Meta(object):
+        unique_together = (('user', 'digest_setting', 'event'),)
+    
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE)
+    digest_setting = models.PositiveSmallIntegerField(
+        help_text='UserNotificationPreference.SETTING_DAILY or UserNotificationPreference.SETTING_WEEKLY')
+    event = models.ForeignKey(NotificationEvent, related_name='digest_buffer_entries', on_delete=models.CASCADE)
+    # denormalized from the event, so the buffer can be filtered without joining the events
+    group = models.ForeignKey(settings.COSINNUS_GROUP_OBJECT_MODEL, related_name='+', on_delete=models.CASCADE)
+    notification_id = models.CharField(max_length=100)
+    
+    @classmethod
+    def create_for_event(cls, event, user_digest_settings):
+        """ Appends a `NotificationEvent` to the digest buffers of many users in bulk.
+            @param user_digest_settings: a list of (user_id, digest_setting) """
+        cls.objects.bulk_create([
+            cls(user_id=user_id, digest_setting=digest_setting, event_id=event.id, group_id=event.group_id,
+                notification_id=event.notification_id) for user_id, digest_setting in user_digest_settings
+        ], batch_size=NOTIFICATION_EVENT_AUDIENCE_BATCH_SIZE, ignore_conflicts=True)
+    
+    def __str__(self):
+        return "<DigestBufferEntry: user: %(user_id)s, digest_setting: %(digest_setting)s, event: %(event_id)s>" % {
+            'user_id': self.user_id,
+            'digest_setting': self.digest_setting,
+            'event_id': self.event_id,
+        }
+
+
+@six.python_2_unicode_compatible
+class NotificationOutboxEntry(models.Model):
+    """ A durable, not yet processed notification run, as queued by `notification_receiver`
+        if `COSINNUS_NOTIFICATIONS_OUTBOX_ENABLED` is set.
+
+        Each entry holds the serialized arguments of one `NotificationsThread` run (a single
+        notification, or all notifications of a session) and is processed by the
+        `process_notification_outbox` management command. See `cosinnus_notifications.outbox`. """
+
+    STATE_PENDING = 0
+    STATE_PROCESSING = 1
+    STATE_FAILED = 2
+    STATE_CHOICES = (
+        (STATE_PENDING, 'Pending'),
+        (STATE_PROCESSING, 'Processing'),
+        (STATE_FAILED, 'Failed'),
+    )
+
+    class Meta(object):
+        ordering = ('id',)
+        index_together = (('state', 'portal'),)
+        verbose_name = _('Notification Outbox Entry')
+        verbose_name_plural = _('Notification Outbox Entries')
+
+    portal = models.ForeignKey('cosinnus.CosinnusPortal', verbose_name=_('Portal'), related_name='notification_outbox_entries',
+        null=False, blank=False, default=1, on_delete=models.CASCADE)
+    frames = models.JSONField(encoder=DjangoJSONEncoder,
+            help_text='A list of serialized notification frames (ids only) that are run sequentially, in one session.')
+    state = models.PositiveSmallIntegerField(default=STATE_PENDING, choices=STATE_CHOICES, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    claimed_at = models.DateTimeField(null=True, blank=True,
+            help_text='When the entry was last claimed by a worker. Stale claims are picked up again.')
+    last_error = models.TextField(null=True, blank=True)
+
+    def __str__(self):
+        return "<NotificationOutboxEntry: %(id)s, state: %(state)s, frames: %(frames)d, attempts: %(attempts)d>" % {
+            'id': self.id,
+            'state': self.get_state_display(),
+            'frames': len(self.frames or []),
+            'attempts': self.attempts,
+        }
+
+
+@six.python_2_unicode_compatible
+class DigestRun(models.Model):
+    """ A digest run for one time span of a portal and digest setting.
+        
+        A distributed run is shared by any number of nodes. Its users are split into `DigestRunRange`s of 
+        user ids, which are leased by the nodes one at a time. The node that finds all ranges done completes 
+        the run and saves the time of the last sent digest. See `cosinnus_notifications.digest_runs`.
+        
+        A local run is sent by `send_digest_for_current_portal()`. If it is interrupted, it can be resumed
+        with its original time span. The sending process holds a lease on the run's single range spanning 
+        all users, so that the run can't be resumed while it is still being sent.
+        
+        For both, each user that has been sent the digest is recorded as a `DigestRunRecipient`, so that 
+        no user gets the same digest twice.
+        
+        With staggered digest delivery, each local run only covers the users of the `timezones` of one 
+        `cohort`, see `send_digest_for_current_portal()`. """
+    
+    STATE_RUNNING = 0
+    STATE_COMPLETED = 1
+    STATE_ABANDONED = 2
+    STATE_FAILED = 3
+    STATE_CHOICES = (
+        (STATE_RUNNING, 'Running'),
+        (STATE_COMPLETED, 'Completed'),
+        (STATE_ABANDONED, 'Abandoned'),
+        (STATE_FAILED, 'Failed'),
+    )
+    
+    class Meta(object):
+        ordering = ('-id',)
+        unique_together = (('portal', 'digest_setting', 'cohort', 'window_end'),)
+        constraints = [
+            # there may only be one running digest run per portal, digest setting and cohort
+            models.UniqueConstraint(fields=['portal', 'digest_setting', 'cohort'], condition=Q(state=0),
+                                    name='cosinnus_notifications_unique_running_digest_run'),
+        ]
+        verbose_name = _('Digest Run')
+        verbose_name_plural = _('Digest Runs')
+    
+    portal = models.ForeignKey('cosinnus.CosinnusPortal', verbose_name=_('Portal'), related_name='digest_runs', 
+        null=False, blank=False, default=1, on_delete=models.CASCADE)
+    digest_setting = models.PositiveSmallIntegerField(
+        help_text='UserNotificationPreference.SETTING_DAILY or UserNotificationPreference.SETTING_WEEKLY')
+    window_start = models.DateTimeField()
+    window_end = models.DateTimeField()
+    state = models.PositiveSmallIntegerField(default=STATE_RUNNING, choices=STATE_CHOICES, db_index=True)
+    distributed = models.BooleanField(default=True,
+            help_text='If the run is shared by several nodes via its ranges, or sent by a single (local) command')
+    cohort = models.CharField(max_length=100, blank=True, default='',
+            help_text='With staggered digest delivery, the key of the run\'s cohort of timezones. Empty for runs of all users')
+    timezones = models.TextField(blank=True, default='',
+            help_text='With staggered digest delivery, the comma-separated timezones of the run\'s users')
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return "<DigestRun: %(id)s, portal: %(portal_id)s, digest_setting: %(digest_setting)s, cohort: %(cohort)s, window_end: %(window_end)s, state: %(state)s>" % {
+            'id': self.id,
+            'portal_id': self.portal_id,
+            'digest_setting': self.digest_setting,
+            'cohort': self.cohort or '-',
+            'window_end': str(self.window_end),
+            'state': self.get_state_display(),
+        }
+    
+    def get_timezone_names(self):
+        return [timezone_name for timezone_name in self.timezones.split(',') if timezone_name]
+    
+    def set_timezone_names(self, timezone_names):
+        self.timezones = ','.join(sorted(timezone_names))
+
+
+@six.python_2_unicode_compatible
+class DigestRunRange(models.Model):
+    """ A range of user ids (`user_id_start` <= id < `user_id_end`) of a `DigestRun`, processed by one node at a time.
+        A node holds a lease on the range while processing it, which it must renew before `lease_expires_at`.
+        Ranges with an expired lease can be claimed by other nodes. A range that could not be processed
+        after `COSINNUS_NOTIFICATIONS_DIGEST_RUN_MAX_RANGE_ATTEMPTS` attempts fails, along with its run. """
+    
+    STATE_PENDING = 0
+    STATE_LEASED = 1
+    STATE_DONE = 2
+    STATE_FAILED = 3
+    STATE_CHOICES = (
+        (STATE_PENDING, 'Pending'),
+        (STATE_LEASED, 'Leased'),
+        (STATE_DONE, 'Done'),
+        (STATE_FAILED, 'Failed'),
+    )
+    
+    class Meta(object):
+        ordering = ('id',)
+        index_together = (('run', 'state'),)
+        verbose_name = _('Digest Run Range')
+        verbose_name_plural = _('Digest Run Ranges')
+    
+    run = models.ForeignKey(DigestRun, related_name='ranges', on_delete=models.CASCADE)
+    user_id_start = models.PositiveIntegerField()
+    user_id_end = models.PositiveIntegerField()
+    state = models.PositiveSmallIntegerField(default=STATE_PENDING, choices=STATE_CHOICES)
+    lease_owner = models.CharField(max_length=250, null=True, blank=True,
+            help_text='The node currently holding (or last holding) the lease on this range')
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    users_emailed = models.PositiveIntegerField(default=0)
+    total_users = models.PositiveIntegerField(default=0)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return "<DigestRunRange: run: %(run_id)s, users: %(start)s-%(end)s, state: %(state)s, owner: %(owner)s>" % {
+            'run_id': self.run_id,
+            'start': self.user_id_start,
+            'end': self.user_id_end,
+            'state': self.get_state_display(),
+            'owner': self.lease_owner,
+        }
+
+
+@six.python_2_unicode_compatible
+class DigestRunRecipient(models.Model):
+    """ Marks a user as having been sent the digest of a `DigestRun`. Users with a marker are skipped when
+        the run is resumed or one of its ranges is retried. The markers are deleted once the run is completed. """
+    
+    class Meta(object):
+        unique_together = (('run', 'user'),)
+    
+    run = models.ForeignKey(DigestRun, related_name='recipients', on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE)
+    sent_at = models.DateTimeField(auto_now_add=True, editable=False)
+    
+    def __str__(self):
+        return "<DigestRunRecipient: run: %(run_id)s, user: %(user_id)s>" % {
+            'run_id': self.run_id,
+            'user_id': self.user_id,
+        }
+
+
 @six.python_2_unicode_compatible
 class NotificationAlert(models.Model):
     """ An instant notification alert for something relevant that happened for a user, shown in the navbar dropdown.
@@ -7,6 +7,7 @@ import datetime
 from cosinnus.utils.context_processors import cosinnus
 
 from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
 from django.urls import reverse
 from django.utils import translation, formats, timezone
 from importlib import import_module
@@ -15,12 +16,13 @@ from django.utils.translation import gettext, ugettext_lazy as _
 from django.template.loader import render_to_string
 
 from cosinnus.conf import settings
-from cosinnus.core.mail import get_common_mail_context, send_mail_or_fail
+from cosinnus.core.mail import get_common_mail_context
 from cosinnus.core.registries.apps import app_registry
 from cosinnus.models.group import CosinnusGroup, CosinnusPortal
 from cosinnus.models.tagged import BaseTaggableObjectModel, BaseTagObject
 from cosinnus_notifications.models import UserNotificationPreference,\
-    NotificationEvent, UserMultiNotificationPreference, NotificationAlert
+    NotificationEvent, UserMultiNotificationPreference, NotificationAlert,\
+    NotificationEventAudience, DigestBufferEntry
 from cosinnus.templatetags.cosinnus_tags import full_name, cosinnus_setting,\
     textfield
 from cosinnus.utils.functions import ensure_dict_keys, resolve_attributes
@@ -28,9 +30,8 @@ from threading import Thread
 from django.utils.safestring import mark_safe
 from django.utils.html import strip_tags, urlize, escape
 from django.contrib.contenttypes.models import ContentType
-from cosinnus.utils.permissions import check_object_read_access,\
-    check_user_can_receive_emails, check_user_portal_admin,\
-    check_user_portal_moderator
+from cosinnus.utils.permissions import check_user_can_receive_emails,\
+    check_user_portal_admin, check_user_portal_moderator
 from django.templatetags.static import static
 from django.utils.encoding import force_text
 from cosinnus.utils.group import get_cosinnus_group_model,\
@@ -41,13 +42,21 @@ from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
 import six
 from _collections import defaultdict
-from cosinnus_notifications.alerts import create_user_alert
+from cosinnus_notifications.alerts import create_user_alert,\
+    create_user_alerts_bulk
 from cosinnus.utils.files import get_image_url_for_icon
 from copy import copy
+from types import MappingProxyType
 from django.template.defaultfilters import truncatewords_html,\
     truncatechars_html
 from cosinnus.utils.html import replace_non_portal_urls
 from cosinnus.models.group_extra import CosinnusProject, CosinnusSociety
+from cosinnus_notifications.dispatcher import get_notification_dispatcher
+from cosinnus_notifications.outbox import enqueue_notification_thread
+from cosinnus_notifications.preferences import AudienceNotificationPreferences
+from cosinnus_notifications.access import AccessCheckMemo
+from cosinnus_notifications.mail import build_html_mail_message,\
+    build_text_mail_message, get_notification_mailer
 
 
 
@@ -56,6 +65,15 @@ logger = logging.getLogger('cosinnus')
 ALL_NOTIFICATIONS_ID = 'notifications__all'
 NO_NOTIFICATIONS_ID = 'notifications__none'
 
+# the preference settings that are sent out as digests
+DIGEST_SETTINGS = (UserNotificationPreference.SETTING_DAILY, UserNotificationPreference.SETTING_WEEKLY)
+
+# if True, notification events are appended to the `DigestBufferEntry` digest buffers of their audience users
+# at event time, and digest runs read the buffers instead of selecting candidate events from all events.
+# the buffers are only filled from the time on this is enabled, so the first digests after enabling it
+# will miss the events from before
+DIGEST_BUFFER_ENABLED = getattr(settings, 'COSINNUS_NOTIFICATIONS_DIGEST_BUFFER_ENABLED', False)
+
 # the dict to store all configured notification signals and options
 # notification settings from all cosinnus apps are added to this one
 notifications = {
@@ -236,42 +254,123 @@ NOTIFICATIONS_DEFAULTS = {
 
 DIGEST_ITEM_TITLE_MAX_LENGTH = 50
 
+# placeholders for the recipient-specific parts of an instant HTML notification mail, 
+# which is rendered only once and shared by all recipients with the same language and time zone
+ADDRESSEE_PLACEHOLDER = '__COSINNUS_NOTIFICATION_ADDRESSEE__'
+PREFS_URL_PLACEHOLDER = '__COSINNUS_NOTIFICATION_PREFS_URL__'
+
+
+class NotificationRegistryIndex(object):
+    """ Immutable lookup maps derived from the `notifications` registry, so that the hot paths
+        (the signal receiver, digest generation) never have to scan the whole registry.
+        A new index is built (and swapped in with a single assignment) every time the
+        registry is (re-)initialized in `init_notifications()`. """
+    
+    def __init__(self, notifications_dict):
+        signal_map = {}
+        multi_pref_map = defaultdict(set)
+        supercede_map = defaultdict(set)
+        superceding_notifications_map = defaultdict(set)
+        for notification_id, notification_options in list(notifications_dict.items()):
+            for signal in notification_options.get('signals', []):
+                # as with a linear scan, the first configured notification for a signal wins
+                signal_map.setdefault(signal, notification_id)
+            for superceded_notif in notification_options.get('supercedes_notifications', None) or []:
+                superceding_notifications_map[superceded_notif].add(notification_id)
+            multi_pref_set = notification_options.get('multi_preference_set', None)
+            if multi_pref_set:
+                multi_pref_map[multi_pref_set].add(notification_id)
+                for superceded_notif in notification_options.get('supercedes_notifications', None) or []:
+                    supercede_map[superceded_notif].add(multi_pref_set)
+        # signal -> notification_id
+        self.signal_notifications = MappingProxyType(signal_map)
+        # multi_pref_set -> (notification_id, ...)
+        self.multi_pref_notifications = MappingProxyType(dict([(k, tuple(v)) for k, v in multi_pref_map.items()]))
+        # unprefixed notification_id -> (superceding multi_pref_set, ...)
+        self.superceding_multi_prefs = MappingProxyType(dict([(k, tuple(v)) for k, v in supercede_map.items()]))
+        # unprefixed notification_id -> (superceding notification_id, ...)
+        self.superceding_notifications = MappingProxyType(dict([(k, tuple(v)) for k, v in superceding_notifications_map.items()]))
+
+
+_notification_index = None
+
+
+def _get_notification_index():
+    """ Returns the current registry index, building it if `init_notifications()` hasn't run yet """
+    global _notification_index
+    if _notification_index is None:
+        _notification_index = NotificationRegistryIndex(notifications)
+    return _notification_index
+
 
 def _find_notification(signal):
     """ Finds a configured notification for a received signal """
-    for signal_id, options in list(notifications.items()):
-        if signal in options['signals']:
-            return signal_id
-    return None
-
-REVERESE_MULTI_PREF_SUPERCEDE_DICT = None
+    return _get_notification_index().signal_notifications.get(signal, None)
 
 
 def get_superceding_multi_preferences(notification_id):
     """ Returns all multi-pref-set ids from MULTI_NOTIFICATION_IDS that supercede the given notification_id """
-    global REVERESE_MULTI_PREF_SUPERCEDE_DICT
-    if REVERESE_MULTI_PREF_SUPERCEDE_DICT is None:
-        # build reverse lookup dict
-        lookup_dict = defaultdict(set)
-        for __, notification_options in notifications.items():
-            supercedes = notification_options.get('supercedes_notifications', [])
-            multi_pref_set = notification_options.get('multi_preference_set', None)
-            if multi_pref_set and supercedes:
-                for superceded_notif in supercedes:
-                    lookup_dict[superceded_notif].add(multi_pref_set)
-        lookup_dict = dict(lookup_dict)
-        for k,v in lookup_dict.items():
-            lookup_dict[k] = list(v)
-        REVERESE_MULTI_PREF_SUPERCEDE_DICT = lookup_dict
-    
     # remove the leading app_name from the given notification
     if '__' in notification_id:
         notification_id = notification_id.split('__')[1]
-    return REVERESE_MULTI_PREF_SUPERCEDE_DICT.get(notification_id, [])
+    return _get_notification_index().superceding_multi_prefs.get(notification_id, ())
 
 def get_superceded_multi_preferences(notification_id):
     return notifications[notification_id]['supercedes_notifications']
 
+def get_superceding_notifications(notification_id):
+    """ Returns all notification ids whose events supercede events of the given notification_id
+        (i.e. that list it in their `supercedes_notifications`) """
+    # remove the leading app_name from the given notification
+    if '__' in notification_id:
+        notification_id = notification_id.split('__')[1]
+    return _get_notification_index().superceding_notifications.get(notification_id, ())
+
+
+def _get_notification_event_target_key(notification_event):
+    """ A key identifying the target object of a notification event without loading it. Proxy models share the
+        key of their concrete model, just as model instances compare equal """
+    model_class = ContentType.objects.get_for_id(notification_event.content_type_id).model_class()
+    if model_class is not None:
+        return (model_class._meta.concrete_model, notification_event.object_id)
+    return (notification_event.content_type_id, notification_event.object_id)
+
+
+def deduplicate_notification_events(notification_events):
+    """ Throws out duplicate events (eg "X was updated" multiple times) for the same object and superceded events. 
+        The most recent event is always kept.
+        - follow-events have a supercede list of events that are always less important than the follow-event
+        - this means that a "created" event would be thrown out by a later "an item you followed was updated" on the same object
+        
+        Events are compared by the key of (target model, object_id, notification_id) instead of comparing 
+        their target objects, in linear time. The result is the same as comparing each event with each other 
+        remaining event: an event is dropped if any other remaining event for the same object has the same 
+        notification id, or supercedes it.
+        
+        @param notification_events: a list of events, ordered by date
+        @return: a new list of the remaining events, in the same order """
+    events_by_target = defaultdict(list)
+    for event in notification_events:
+        events_by_target[_get_notification_event_target_key(event)].append(event)
+    
+    dropped_event_ids = set()
+    for target_events in events_by_target.values():
+        if len(target_events) < 2:
+            continue
+        # count of remaining events for this object, by notification id
+        remaining_counts = defaultdict(int)
+        for event in target_events:
+            remaining_counts[event.notification_id] += 1
+        for event in target_events:
+            superceded = remaining_counts[event.notification_id] > 1 or \
+                any([remaining_counts[notification_id] > 0 for notification_id in 
+                     get_superceding_notifications(event.notification_id) if notification_id != event.notification_id])
+            if superceded:
+                remaining_counts[event.notification_id] -= 1
+                dropped_event_ids.add(id(event))
+    return [event for event in notification_events if id(event) not in dropped_event_ids]
+
+
 def get_requires_object_state_check(notification_id):
     return notifications[notification_id]['requires_object_state_check']
 
@@ -280,24 +379,9 @@ def is_notification_multipref(notification_id):
     return bool(notifications[notification_id].get('multi_preference_set', None))
 
 
-MULTI_PREF_NOTIFICATION_DICT = None
-
 def get_multi_preference_notification_ids(multi_pref_id):
     """ Returns all notification_ids that are part of a multi_preference_set """
-    global MULTI_PREF_NOTIFICATION_DICT
-    if MULTI_PREF_NOTIFICATION_DICT is None:
-        # build reverse lookup dict
-        lookup_dict = defaultdict(set)
-        for notification_id, notification_options in notifications.items():
-            multi_pref_set = notification_options.get('multi_preference_set', None)
-            if multi_pref_set:
-                lookup_dict[multi_pref_set].add(notification_id)
-        lookup_dict = dict(lookup_dict)
-        for k,v in lookup_dict.items():
-            lookup_dict[k] = list(v)
-        MULTI_PREF_NOTIFICATION_DICT = lookup_dict
-    
-    return MULTI_PREF_NOTIFICATION_DICT.get(multi_pref_id, [])
+    return _get_notification_index().multi_pref_notifications.get(multi_pref_id, ())
 
 
 def set_user_group_notifications_special(user, group, all_or_none_or_custom):
@@ -337,6 +421,7 @@ def set_user_group_notifications_special(user, group, all_or_none_or_custom):
 
 def init_notifications():
     global notifications 
+    global _notification_index
     
     all_items = [item for item in list(app_registry.items())]
     all_items.append( ('cosinnus', 'cosinnus', '') )
@@ -371,6 +456,8 @@ def init_notifications():
                 # connect to signals
                 for signal in options['signals']:
                     signal.connect(notification_receiver)
+    # rebuild all lookup indexes and swap them in at once
+    _notification_index = NotificationRegistryIndex(notifications)
     logger.info('Cosinnus_notifications: init complete. Available notification signals: %s' % list(notifications.keys()))
 
 
@@ -389,6 +476,9 @@ class NotificationsThread(Thread):
         very similar event notifications and only send out 1 mail for each actual event.
         Example: If I follow my own News Post and somebody comments on it, I will only receive the
             'somebody commented on your post', and not also the 'a comment on a post you follow' notification.
+        Note: Instead of being started as its own thread, a finished thread object is handed to the
+            `NotificationDispatcher`, whose fixed pool of workers calls `inner_run()` on it, or is
+            persisted into the notification outbox (see `cosinnus_notifications.outbox`).
          """
     NOTIFICATION_CONTENT_GROUP_TYPES = [
         CosinnusProject.GROUP_MODEL_TYPE,
@@ -419,6 +509,12 @@ class NotificationsThread(Thread):
         self.notification_preference_triggered = None
         # will be set at runtime
         self.group = None
+        # `AudienceNotificationPreferences` for the audience, will be set at runtime
+        self.audience_preferences = None
+        # rendered HTML mails for this event, by recipient bucket. see `render_html_notification_for_bucket()`
+        self.html_mail_bucket_cache = {}
+        # memoized read access checks for this event's audience
+        self.access_memo = AccessCheckMemo()
         
     def add_session_frame(self, sender, user, obj, audience, notification_id, options):
         """ Add a set of init variables to the queue of params,
@@ -434,14 +530,17 @@ class NotificationsThread(Thread):
         
     def is_notification_active(self, notification_id, user, group, alternate_settings_compare=[]):
         """ Checks against the DB if a user notifcation preference exists, and if so, if it is set to active """
-        try:
-            preference = UserNotificationPreference.objects.get(user=user, group=group, notification_id=notification_id)
+        if self.audience_preferences is not None:
+            preference = self.audience_preferences.get_preference(user, notification_id, group)
+        else:
+            preference = get_object_or_None(UserNotificationPreference, user=user, group=group, notification_id=notification_id)
+        if preference is not None:
             self.notification_preference_triggered = preference
             if len(alternate_settings_compare) == 0:
                 return preference.setting == UserNotificationPreference.SETTING_NOW
             else:
                 return preference.setting in alternate_settings_compare
-        except UserNotificationPreference.DoesNotExist:
+        else:
             # if not set in DB, check if preference is default on (and matching the setting value we're comparing to)
             if notification_id in notifications:
                 default_preference_setting = notifications[notification_id].get('default', 0)
@@ -452,6 +551,17 @@ class NotificationsThread(Thread):
                         return default_preference_setting == 1
         return False
         
+    def get_user_global_setting(self, user):
+        """ Returns the user's global notification setting, from the bulk-loaded audience preferences if possible """
+        if self.audience_preferences is not None:
+            return self.audience_preferences.get_global_setting(user)
+        return GlobalUserNotificationSetting.objects.get_for_user(user)
+    
+    def get_user_multi_setting(self, user, multi_preference_set):
+        """ Returns the user's setting for a multi preference, from the bulk-loaded audience preferences if possible """
+        if self.audience_preferences is not None:
+            return self.audience_preferences.get_multi_setting(user, multi_preference_set)
+        return UserMultiNotificationPreference.get_setting_for_user(user, multi_preference_set)
     
     def check_user_wants_notification(self, user, notification_id, obj, notification_moderator_check=False):
         """ Do multiple pre-checks and a DB check to find if the user wants to receive a mail for a 
@@ -489,7 +599,7 @@ class NotificationsThread(Thread):
                 return False
         
         # user must be able to read object, unless it is a group (otherwise group invitations would never be sent)
-        if not check_object_read_access(obj, user) and not (type(obj) is get_cosinnus_group_model() or issubclass(obj.__class__, get_cosinnus_group_model())):
+        if not self.access_memo.check_read_access(obj, user) and not (type(obj) is get_cosinnus_group_model() or issubclass(obj.__class__, get_cosinnus_group_model())):
             return False
 
         # check if user receives an instant email notification of being invited to a group even if his/her notification settings say otherwise (daily/ weekly)
@@ -501,7 +611,7 @@ class NotificationsThread(Thread):
         if notification_moderator_check:
             if check_user_portal_admin(user) and check_user_portal_moderator(user):
                 # check if object is publicly visible
-                if check_object_read_access(obj, AnonymousUser()) or getattr(obj, 'cosinnus_always_visible_by_users_moderator_flag', False):
+                if self.access_memo.check_read_access(obj, AnonymousUser()) or getattr(obj, 'cosinnus_always_visible_by_users_moderator_flag', False):
                     return True
             # for this special check, we cancel the rest here, because only the moderation check counts
             return False
@@ -509,14 +619,14 @@ class NotificationsThread(Thread):
         # check the specific multi-preference if this notification belongs to it
         multi_preference_set = notifications[notification_id].get('multi_preference_set', None)
         if multi_preference_set:
-            if UserMultiNotificationPreference.get_setting_for_user(user, multi_preference_set) == UserMultiNotificationPreference.SETTING_NOW:
+            if self.get_user_multi_setting(user, multi_preference_set) == UserMultiNotificationPreference.SETTING_NOW:
                 return True
             else:
                 # we actually return False here, because this setting is on a different category than the other notifications
                 return False
         
         # global settings check, blanketing the finer grained checks
-        global_setting = GlobalUserNotificationSetting.objects.get_for_user(user)
+        global_setting = self.get_user_global_setting(user)
         if global_setting in [GlobalUserNotificationSetting.SETTING_NEVER, 
                 GlobalUserNotificationSetting.SETTING_DAILY, GlobalUserNotificationSetting.SETTING_WEEKLY]:
             # user either wants no notification or a digest (the event for which is saved elsewhere)
@@ -575,7 +685,7 @@ class NotificationsThread(Thread):
         if type(obj) is get_cosinnus_group_model() or issubclass(obj.__class__, get_cosinnus_group_model()):
             return 'is_group'
         # user must be able to see an object if it is contained in a group 
-        if not check_object_read_access(obj, user):
+        if not self.access_memo.check_read_access(obj, user):
             return False
         # user must be either
         #    - the creator of the object (likes, attendances) OR
@@ -592,6 +702,92 @@ class NotificationsThread(Thread):
         
         return False
     
+    def get_user_digest_settings(self, user, notification_id):
+        """ Determines in which digests this thread's notification event will appear for a user, following the
+            same group preference rules as the digest generation. Used to fill the user's digest buffer at event time.
+            Multi preferences are not considered: a digest run selects the multi preference events of its time span 
+            for all users with the multi preference set to it, not only for the event's audience.
+            @return: a set of the digest settings (`UserNotificationPreference.SETTING_DAILY` and/or
+                `UserNotificationPreference.SETTING_WEEKLY`) """
+        digest_settings = set()
+        if not user.is_authenticated or not user.is_active:
+            return digest_settings
+        
+        global_setting = self.get_user_global_setting(user)
+        if global_setting == GlobalUserNotificationSetting.SETTING_DAILY:
+            digest_settings.add(UserNotificationPreference.SETTING_DAILY)
+        elif global_setting == GlobalUserNotificationSetting.SETTING_WEEKLY:
+            digest_settings.add(UserNotificationPreference.SETTING_WEEKLY)
+        elif global_setting == GlobalUserNotificationSetting.SETTING_GROUP_INDIVIDUAL:
+            if self.audience_preferences is not None:
+                get_preference = lambda nid: self.audience_preferences.get_preference(user, nid, self.group)
+            else:
+                get_preference = lambda nid: get_object_or_None(UserNotificationPreference, user=user, group=self.group, notification_id=nid)
+            # a blanketing NONE preference excludes the group from all digests
+            if get_preference(NO_NOTIFICATIONS_ID) is None:
+                all_preference = get_preference(ALL_NOTIFICATIONS_ID)
+                preference = get_preference(notification_id)
+                for digest_setting in DIGEST_SETTINGS:
+                    # a blanketing ALL preference of another setting excludes the group from this digest
+                    if all_preference is not None and all_preference.setting != digest_setting:
+                        continue
+                    if all_preference is not None or (preference is not None and preference.setting == digest_setting):
+                        digest_settings.add(digest_setting)
+        return digest_settings
+    
+    def render_html_notification_for_bucket(self, notification_event, reason_key, site, domain, has_addressee):
+        """ Renders the full HTML mail body and subject for this thread's notification event only once for each
+            bucket of recipients with the same language, time zone and notification reason.
+            Must be called with the recipient's language and time zone activated.
+            @return: a tuple of (html_content, subject). The html_content contains the placeholders
+                `ADDRESSEE_PLACEHOLDER` and `PREFS_URL_PLACEHOLDER` for the recipient-specific parts. """
+        bucket_key = (translation.get_language(), timezone.get_current_timezone_name(), reason_key, has_addressee)
+        if bucket_key in self.html_mail_bucket_cache:
+            return self.html_mail_bucket_cache[bucket_key]
+        
+        template = '/cosinnus/html_mail/notification.html'
+        portal_name =  _(settings.COSINNUS_BASE_PAGE_TITLE_TRANS)
+        
+        if reason_key:
+            reason = NOTIFICATION_REASONS[reason_key]
+        else:
+            reason = NOTIFICATION_REASONS[self.options.get('notification_reason')] 
+        portal_image_url = '%s%s' % (domain, static('img/email-header.png'))
+        
+        # render the notification item (and get back some data from the event)
+        notification_item_html, data = render_digest_item_for_notification_event(notification_event, return_data=True)
+        
+        topic = None
+        if self.options.get('topic'):
+            topic = mark_safe(self.options.get('topic') % data.get('string_variables'))
+        context = {
+            'site': site,
+            'site_name': site.name,
+            'domain_url': domain,
+            'portal_url': domain,
+            'portal_image_url': portal_image_url,
+            'portal_name': portal_name,
+            'receiver': None, # the mail body is shared between recipients
+            'addressee': mark_safe(ADDRESSEE_PLACEHOLDER) if has_addressee else None,
+            'prefs_url': mark_safe(PREFS_URL_PLACEHOLDER),
+            'topic': topic,
+            'notification_raw_html': None, # this is raw-html pastable section
+            'notification_item_html': mark_safe(notification_item_html),
+            'notification_reason': reason,
+        }
+        # add object name to outer template for preview text
+        if data.get('object_name', None):
+            context['preview_summary'] = data.get('object_name')
+        subject = _unescape(self.options.get('subject_text') % data.get('string_variables'))
+        # prefix "[Goupname]" before subject
+        team_name_prefix = data.get('string_variables').get('team_name_short', None)
+        if team_name_prefix:
+            subject = f'[{team_name_prefix}] {subject}'
+        
+        html_content = render_to_string(template, context)
+        self.html_mail_bucket_cache[bucket_key] = (html_content, subject)
+        return html_content, subject
+    
     def send_instant_notification(self, notification_event, receiver, reason_key=None):
         """ Sends out an instant notification for this thread's event to someone who wants it """
         
@@ -627,44 +823,12 @@ class NotificationsThread(Thread):
             is_html = self.options.get('is_html', False)
             
             if is_html:
-                template = '/cosinnus/html_mail/notification.html'
-                portal_name =  _(settings.COSINNUS_BASE_PAGE_TITLE_TRANS)
-                
-                if reason_key:
-                    reason = NOTIFICATION_REASONS[reason_key]
-                else:
-                    reason = NOTIFICATION_REASONS[self.options.get('notification_reason')] 
-                portal_image_url = '%s%s' % (domain, static('img/email-header.png'))
-                
-                # render the notification item (and get back some data from the event)
-                notification_item_html, data = render_digest_item_for_notification_event(notification_event, return_data=True)
-                
-                topic = None
-                if self.options.get('topic'):
-                    topic = mark_safe(self.options.get('topic') % data.get('string_variables'))
-                context = {
-                    'site': site,
-                    'site_name': site.name,
-                    'domain_url': domain,
-                    'portal_url': domain,
-                    'portal_image_url': portal_image_url,
-                    'portal_name': portal_name,
-                    'receiver': receiver, 
-                    'addressee': mark_safe(strip_tags(receiver.first_name)) if not type(receiver) is AnonymousUser else None,
-                    'prefs_url': mark_safe(preference_url),
-                    'topic': topic,
-                    'notification_raw_html': None, # this is raw-html pastable section
-                    'notification_item_html': mark_safe(notification_item_html),
-                    'notification_reason': reason,
-                }
-                # add object name to outer template for preview text
-                if data.get('object_name', None):
-                    context['preview_summary'] = data.get('object_name')
-                subject = _unescape(self.options.get('subject_text') % data.get('string_variables'))
-                # prefix "[Goupname]" before subject
-                team_name_prefix = data.get('string_variables').get('team_name_short', None)
-                if team_name_prefix:
-                    subject = f'[{team_name_prefix}] {subject}'
+                addressee = mark_safe(strip_tags(receiver.first_name)) if not type(receiver) is AnonymousUser else None
+                html_content, subject = self.render_html_notification_for_bucket(notification_event, reason_key, 
+                                                                                 site, domain, bool(addressee))
+                # fill in the only recipient-specific parts of the shared mail body
+                html_content = html_content.replace(ADDRESSEE_PLACEHOLDER, addressee or '')\
+                    .replace(PREFS_URL_PLACEHOLDER, preference_url)
             else:
                 
                 template = self.options['mail_template']
@@ -705,7 +869,12 @@ class NotificationsThread(Thread):
                 from_email = '%(username)s via %(portal_name)s <%(from_email)s>' % {'username': username,'portal_name': portal_name, 'from_email': settings.COSINNUS_DEFAULT_FROM_EMAIL}
                 # Workaround: django 2.x does not support non-ascii chars in the from_email, so strip all non-ascii chars!
                 from_email = from_email.encode("ascii", errors="ignore").decode()
-            send_mail_or_fail(receiver.email, subject, template, context, from_email=from_email, is_html=is_html)
+            if is_html:
+                message = build_html_mail_message(receiver.email, subject, html_content, from_email=from_email)
+            else:
+                message = build_text_mail_message(receiver.email, subject, render_to_string(template, context), from_email=from_email)
+            # sent in batches over this worker's mail connection
+            get_notification_mailer().send(message)
             
         finally:
             translation.activate(cur_language)
@@ -716,9 +885,19 @@ class NotificationsThread(Thread):
         create_user_alert(notification_event.target_object, notification_event.group, 
                           receiver, notification_event.user, notification_event.notification_id,
                           reason_key=reason_key)
+    
+    def create_new_user_alerts(self, notification_event, receivers):
+        """ Creates NotificationAlerts for this Thread for a NotificationEvent to everyone who wants it,
+            in bulk.
+            @param receivers: a list of tuples of (receiver, reason_key) """
+        create_user_alerts_bulk(notification_event.target_object, notification_event.group,
+                                receivers, notification_event.user, notification_event.notification_id)
         
     def run(self):
-        self.inner_run()
+        try:
+            self.inner_run()
+        finally:
+            get_notification_mailer().close()
         
     def inner_run(self):
         # set group, inferred from object
@@ -742,6 +921,12 @@ class NotificationsThread(Thread):
         setattr(notification_event, '_target_object', self.obj) # this helps reduce lookups by local caching the generic foreign key object
         
         options = notifications[self.notification_id]
+        if options['can_be_email'] and self.audience:
+            # bulk-load all notification preferences of the audience instead of querying them for each receiver
+            self.audience_preferences = AudienceNotificationPreferences(self.audience, self.group)
+        
+        # list of (receiver, reason_key) for whom NotificationAlerts will be created in bulk
+        alert_receivers = []
         for receiver in self.audience:
             # check for alerts if this notification type can be an alert,
             # that the user is not a temporary email one, and that we do not alert a user for this session twice
@@ -750,8 +935,7 @@ class NotificationsThread(Thread):
                 try:
                     alert_reason = self.check_user_wants_alert(receiver, self.notification_id, self.obj)
                     if alert_reason:
-                        # create a new NotificationAlert
-                        self.create_new_user_alert(notification_event, receiver, reason_key=alert_reason)
+                        alert_receivers.append((receiver, alert_reason))
                         self.already_alerted_user_ids.append(receiver.id)
                 except Exception as e:
                     logger.exception('An unknown error occured during NotificationAlert check/creation! Exception in extra.', extra={'exception': force_text(e)})
@@ -764,6 +948,15 @@ class NotificationsThread(Thread):
                     self.send_instant_notification(notification_event, receiver)
                     self.already_emailed_user_emails.append(receiver.email)
         
+        if alert_receivers:
+            try:
+                # create all new NotificationAlerts
+                self.create_new_user_alerts(notification_event, alert_receivers)
+            except Exception as e:
+                logger.exception('An unknown error occured during NotificationAlert check/creation! Exception in extra.', extra={'exception': force_text(e)})
+                if settings.DEBUG:
+                    raise
+        
         # for moderatable notifications, also always mix in portal admins into audience, because they might be portal moderators
         if self.options['moderatable_content']:
             portal_admins = get_user_model().objects.filter(id__in=CosinnusPortal.get_current().admins)
@@ -776,14 +969,23 @@ class NotificationsThread(Thread):
             # create a new NotificationEvent that saves this event for digest re-generation
             # no need to worry about de-duplicating events here, the digest generation handles it
             content_type = ContentType.objects.get_for_model(self.obj.__class__)
-            notifevent = NotificationEvent.objects.create(
-                content_type=content_type,
-                object_id=self.obj.id,
-                group=self.group,
-                user=self.user,
-                notification_id=self.notification_id,
-                audience=',%s,' % ','.join([str(receiver.id) for receiver in self.audience]),
-            )
+            with transaction.atomic():
+                notifevent = NotificationEvent.objects.create(
+                    content_type=content_type,
+                    object_id=self.obj.id,
+                    group=self.group,
+                    user=self.user,
+                    notification_id=self.notification_id,
+                    audience=',%s,' % ','.join([str(receiver.id) for receiver in self.audience]),
+                )
+                # index the audience for the digest
+                NotificationEventAudience.create_for_event(notifevent)
+                if DIGEST_BUFFER_ENABLED:
+                    # append the event to the digest buffers of all users that will get it in a digest
+                    DigestBufferEntry.create_for_event(notifevent, [
+                        (receiver.id, digest_setting) for receiver in self.audience if receiver.id
+                        for digest_setting in self.get_user_digest_settings(receiver, self.notification_id)
+                    ])
         
         if len(self.next_session_args) > 0:
             self._apply_next_session_frame_and_run()
@@ -1036,6 +1238,22 @@ def render_digest_item_for_notification_event(notification_event, return_data=Fa
 notification_sessions = {}
 
 
+def _dispatch_notification_thread(notification_thread):
+    """ Hands a fully set up notification thread over for processing. If `COSINNUS_NOTIFICATIONS_OUTBOX_ENABLED`
+        is set, it is persisted into the notification outbox to be run by the `process_notification_outbox` command,
+        otherwise it is queued into the in-process `NotificationDispatcher`. """
+    if getattr(settings, 'COSINNUS_NOTIFICATIONS_OUTBOX_ENABLED', False):
+        try:
+            enqueue_notification_thread(notification_thread)
+            return
+        except Exception as e:
+            logger.exception('Cosinnus_notifications: Could not write a notification to the outbox, dispatching it in-process instead. Exception in extra.',
+                             extra={'exception': force_text(e), 'notification_id': notification_thread.notification_id})
+            if settings.DEBUG:
+                raise
+    get_notification_dispatcher().submit(notification_thread)
+
+
 def notification_receiver(sender, user, obj, audience, session_id=None, end_session=False, **kwargs):
     """ Generic receiver function for all notifications 
         sender: the main object that is being updated / created
@@ -1075,9 +1293,9 @@ def notification_receiver(sender, user, obj, audience, session_id=None, end_sess
     audience = [aud_user for aud_user in audience if ((aud_user.is_active or not aud_user.is_authenticated) and aud_user.email)]
     
     if not session_id:
-        # we start this notification thread instantly and alone
+        # we queue this notification thread instantly and alone
         notification_thread = NotificationsThread(sender, user, obj, audience, notification_id, options)
-        notification_thread.start()
+        _dispatch_notification_thread(notification_thread)
     elif session_id and session_id not in notification_sessions:
         # we are starting a new session and waiting for more events to be pooled into the thread
         notification_thread = NotificationsThread(sender, user, obj, audience, notification_id, options)
@@ -1088,9 +1306,9 @@ def notification_receiver(sender, user, obj, audience, session_id=None, end_sess
         notification_thread.add_session_frame(sender, user, obj, audience, notification_id, options)
         
     if session_id and end_session and session_id in notification_sessions:
-        # we also end the session here, so we start the thread
+        # we also end the session here, so we queue the thread
         notification_thread = notification_sessions.pop(session_id)
-        notification_thread.start()
+        _dispatch_notification_thread(notification_thread)
 
 
 def _unescape(text):
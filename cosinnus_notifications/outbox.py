@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+import logging
+import traceback
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import Q
+from django.utils.encoding import force_text
+from django.utils.timezone import now
+
+from cosinnus.conf import settings
+from cosinnus.models.group import CosinnusPortal
+from cosinnus_notifications.mail import get_notification_mailer
+from cosinnus_notifications.models import NotificationOutboxEntry
+
+
+logger = logging.getLogger('cosinnus')
+
+# how many times an outbox entry is tried before it is marked as failed
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'COSINNUS_NOTIFICATIONS_OUTBOX_MAX_ATTEMPTS', 3)
+# after how many seconds a claimed, but unfinished entry is considered abandoned (e.g. by a killed worker)
+OUTBOX_CLAIM_TIMEOUT_SECONDS = getattr(settings, 'COSINNUS_NOTIFICATIONS_OUTBOX_CLAIM_TIMEOUT_SECONDS', 60*30)
+
+
+class OutboxNotificationSender(object):
+    """ Stand-in for the original signal sender of a notification replayed from the outbox.
+        The sender itself is not persisted, so there is no request available for mail contexts. """
+    request = None
+
+
+def _get_extra_options(notification_id, options):
+    """ Returns only those notification options that were overridden by the signal's `extra` kwarg,
+        by comparing them to the registered options of the notification """
+    from cosinnus_notifications.notifications import notifications
+    registered_options = notifications.get(notification_id, {})
+    return dict([(key, value) for key, value in options.items()
+                 if key not in registered_options or registered_options[key] is not value])
+
+
+def serialize_notification_frame(sender, user, obj, audience, notification_id, options):
+    """ Serializes the arguments of a `NotificationsThread` frame into a JSON-compatible dict,
+        containing only ids instead of objects. Audience members that aren't real users
+        (anonymous recipients for an email address) are stored by their email and name. """
+    audience_ids = []
+    anonymous_audience = []
+    for receiver in audience:
+        if receiver.is_authenticated and receiver.id:
+            audience_ids.append(receiver.id)
+        else:
+            anonymous_audience.append({
+                'email': receiver.email,
+                'first_name': getattr(receiver, 'first_name', ''),
+                'last_name': getattr(receiver, 'last_name', ''),
+            })
+    return {
+        'user_id': user.id if user is not None else None,
+        'content_type_id': ContentType.objects.get_for_model(obj.__class__).id,
+        'object_id': obj.pk,
+        'audience_ids': audience_ids,
+        'anonymous_audience': anonymous_audience,
+        'notification_id': notification_id,
+        'extra': _get_extra_options(notification_id, options),
+    }
+
+
+def deserialize_notification_frame(frame):
+    """ Re-creates the arguments for a `NotificationsThread` frame from a serialized frame.
+        @return: a tuple of (sender, user, obj, audience, notification_id, options) or None
+            if the notification can no longer be sent (its object or user were deleted) """
+    from cosinnus_notifications.notifications import notifications
+    notification_id = frame['notification_id']
+    if notification_id not in notifications:
+        logger.warning('Cosinnus_notifications: Dropping a notification outbox frame for an unknown notification id.',
+                       extra={'notification_id': notification_id})
+        return None
+    try:
+        content_type = ContentType.objects.get_for_id(frame['content_type_id'])
+        obj = content_type.get_object_for_this_type(pk=frame['object_id'])
+        user = get_user_model().objects.get(id=frame['user_id']) if frame['user_id'] else AnonymousUser()
+    except ObjectDoesNotExist:
+        logger.info('Cosinnus_notifications: Dropping a notification outbox frame because its object or user no longer exists.',
+                    extra={'notification_id': notification_id, 'object_id': frame['object_id']})
+        return None
+
+    # sanity check as in `notification_receiver`: users may have been deactivated in the meantime
+    audience = [aud_user for aud_user in get_user_model().objects.filter(id__in=frame['audience_ids'])
+                if aud_user.is_active and aud_user.email]
+    for anonymous_receiver in frame['anonymous_audience']:
+        receiver = AnonymousUser()
+        receiver.email = anonymous_receiver['email']
+        receiver.first_name = anonymous_receiver['first_name']
+        receiver.last_name = anonymous_receiver['last_name']
+        audience.append(receiver)
+
+    options = notifications[notification_id]
+    if frame['extra']:
+        # deepcopy does not work here, so create a new dict
+        copy_options = {}
+        copy_options.update(options)
+        copy_options.update(frame['extra'])
+        options = copy_options
+    return (OutboxNotificationSender(), user, obj, audience, notification_id, options)
+
+
+def enqueue_notification_thread(notification_thread):
+    """ Persists a fully set up (but not started) `NotificationsThread`, with all of its session frames,
+        as a single `NotificationOutboxEntry`. If called inside a transaction, the entry will only
+        become visible to workers once the transaction (that likely created the notification's object) commits. """
+    frames = [serialize_notification_frame(notification_thread.sender, notification_thread.user, notification_thread.obj,
+                    notification_thread.audience, notification_thread.notification_id, notification_thread.options)]
+    for session_args in notification_thread.next_session_args:
+        frames.append(serialize_notification_frame(*session_args[:6]))
+    # use a savepoint so a failing insert does not break a surrounding transaction
+    with transaction.atomic():
+        return NotificationOutboxEntry.objects.create(portal=CosinnusPortal.get_current(), frames=frames)
+
+
+def build_notification_thread(frames):
+    """ Re-creates a `NotificationsThread` with all its session frames from a list of serialized frames.
+        @return: the thread (not started) or None if none of the frames can be sent anymore """
+    from cosinnus_notifications.notifications import NotificationsThread
+    notification_thread = None
+    for frame in frames:
+        args = deserialize_notification_frame(frame)
+        if args is None:
+            continue
+        if notification_thread is None:
+            notification_thread = NotificationsThread(*args)
+        else:
+            notification_thread.add_session_frame(*args)
+    return notification_thread
+
+
+def claim_outbox_entries(batch_size):
+    """ Claims up to `batch_size` pending outbox entries of the current portal for this worker.
+        Rows locked by other workers are skipped (`SELECT ... FOR UPDATE SKIP LOCKED`), so any number of
+        workers can run concurrently. Entries that have been claimed for longer than
+        `OUTBOX_CLAIM_TIMEOUT_SECONDS` are considered abandoned and may be claimed again. """
+    claim_time = now()
+    stale_claim_time = claim_time - timedelta(seconds=OUTBOX_CLAIM_TIMEOUT_SECONDS)
+    with transaction.atomic():
+        entries = NotificationOutboxEntry.objects.select_for_update(skip_locked=True).filter(
+            Q(state=NotificationOutboxEntry.STATE_PENDING) |
+            Q(state=NotificationOutboxEntry.STATE_PROCESSING, claimed_at__lt=stale_claim_time),
+            portal=CosinnusPortal.get_current(),
+        ).order_by('id')[:batch_size]
+        entries = list(entries)
+        for entry in entries:
+            entry.state = NotificationOutboxEntry.STATE_PROCESSING
+            entry.claimed_at = claim_time
+            entry.attempts += 1
+        NotificationOutboxEntry.objects.bulk_update(entries, ['state', 'claimed_at', 'attempts'])
+    return entries
+
+
+def process_outbox_entry(entry):
+    """ Runs the notification of a claimed outbox entry and deletes the entry on success.
+        On errors, the entry is released to be retried, or marked as failed after `OUTBOX_MAX_ATTEMPTS`.
+        @return: True if the entry was processed successfully """
+    try:
+        notification_thread = build_notification_thread(entry.frames)
+        if notification_thread is not None:
+            notification_thread.inner_run()
+            get_notification_mailer().flush()
+        entry.delete()
+        return True
+    except Exception as e:
+        logger.exception('Cosinnus_notifications: An error occured while processing a notification outbox entry! Exception in extra.',
+                         extra={'exception': force_text(e), 'outbox_entry_id': entry.id, 'attempts': entry.attempts})
+        entry.last_error = traceback.format_exc()
+        if entry.attempts >= OUTBOX_MAX_ATTEMPTS:
+            entry.state = NotificationOutboxEntry.STATE_FAILED
+        else:
+            entry.state = NotificationOutboxEntry.STATE_PENDING
+        entry.save(update_fields=['state', 'last_error'])
+        return False
+
+
+def process_outbox_batch(batch_size):
+    """ Claims and processes one batch of outbox entries.
+        @return: a tuple of (claimed entry count, successfully processed entry count) """
+    entries = claim_outbox_entries(batch_size)
+    processed = 0
+    try:
+        for entry in entries:
+            if process_outbox_entry(entry):
+                processed += 1
+    finally:
+        get_notification_mailer().close()
+    return len(entries), processed
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import logging
+
+from django.db.models import Q
+
+from cosinnus.models.group import CosinnusPortal
+from cosinnus.models.profile import GlobalUserNotificationSetting
+from cosinnus_notifications.models import UserNotificationPreference,\
+    UserMultiNotificationPreference
+
+
+logger = logging.getLogger('cosinnus')
+
+# maximum number of user ids used in a single `user_id__in` lookup
+PREFERENCE_QUERY_CHUNK_SIZE = 5000
+
+
+def chunked(items, chunk_size=PREFERENCE_QUERY_CHUNK_SIZE):
+    """ Yields successive lists of at most `chunk_size` items from a list """
+    items = list(items)
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def get_global_notification_settings_for_users(user_ids, portal=None):
+    """ Bulk-loads the stored `GlobalUserNotificationSetting` values for many users.
+        @return: a dict of {user_id: setting}. Users without a stored setting are missing from the dict,
+            their value must be retrieved via `GlobalUserNotificationSetting.objects.get_for_user()`! """
+    if portal is None:
+        portal = CosinnusPortal.get_current()
+    global_settings = {}
+    for user_id_chunk in chunked(user_ids):
+        global_settings.update(
+            GlobalUserNotificationSetting.objects.filter(user_id__in=user_id_chunk, portal=portal)\
+                .values_list('user_id', 'setting')
+        )
+    return global_settings
+
+
+class AudienceNotificationPreferences(object):
+    """ All notification preferences relevant to a notification event, bulk-loaded for its whole audience
+        with a constant number of queries:
+            - the `UserNotificationPreference`s of all audience users for the event's group
+            - the `GlobalUserNotificationSetting`s of all audience users
+            - the `UserMultiNotificationPreference`s of all audience users (cached)
+        The lookup methods return exactly what the single-user queries in `NotificationsThread` would,
+        including the defaults for unset preferences. Users that weren't part of the audience are
+        looked up with single queries. """
+
+    def __init__(self, users, group, portal=None):
+        self.group = group
+        self.portal = portal or CosinnusPortal.get_current()
+        self.user_ids = set([user.id for user in users if user.is_authenticated and user.id])
+
+        # (user_id, notification_id) --> UserNotificationPreference
+        self.group_preferences = {}
+        if self.group is not None:
+            for user_id_chunk in chunked(self.user_ids):
+                for preference in UserNotificationPreference.objects.filter(user_id__in=user_id_chunk, group=self.group):
+                    self.group_preferences[(preference.user_id, preference.notification_id)] = preference
+
+        # user_id --> global setting (only for stored settings)
+        self.global_settings = get_global_notification_settings_for_users(self.user_ids, portal=self.portal)
+
+        # user_id --> {multi_notification_id: setting} (only for stored settings)
+        self.multi_settings = UserMultiNotificationPreference.get_settings_for_users(self.user_ids, portal=self.portal)
+
+    def has_user(self, user):
+        return user.id in self.user_ids
+
+    def get_preference(self, user, notification_id, group):
+        """ Returns the user's stored `UserNotificationPreference` for a notification in a group, or None """
+        if not self.has_user(user) or group != self.group:
+            try:
+                return UserNotificationPreference.objects.get(user=user, group=group, notification_id=notification_id)
+            except UserNotificationPreference.DoesNotExist:
+                return None
+        return self.group_preferences.get((user.id, notification_id), None)
+
+    def get_global_setting(self, user):
+        """ Returns the same as `GlobalUserNotificationSetting.objects.get_for_user(user)` """
+        setting = self.global_settings.get(user.id, None)
+        if setting is None:
+            # no stored setting, so the manager determines the default
+            setting = GlobalUserNotificationSetting.objects.get_for_user(user)
+            if self.has_user(user):
+                self.global_settings[user.id] = setting
+        return setting
+
+    def get_multi_setting(self, user, multi_notification_id):
+        """ Returns the same as `UserMultiNotificationPreference.get_setting_for_user(user, multi_notification_id)` """
+        if not self.has_user(user):
+            return UserMultiNotificationPreference.get_setting_for_user(user, multi_notification_id, portal=self.portal)
+        setting = self.multi_settings[user.id].get(multi_notification_id, None)
+        if setting is None:
+            from cosinnus_notifications.notifications import MULTI_NOTIFICATION_IDS
+            setting = MULTI_NOTIFICATION_IDS[multi_notification_id]
+        return setting
+
+
+class DigestUserPreferences(object):
+    """ A compact snapshot of all of a user's notification preferences relevant to a digest run.
+        See `load_digest_preferences()`. """
+    
+    __slots__ = ('global_setting', 'multi_settings', 'group_preferences')
+    
+    def __init__(self, global_setting, multi_settings, group_preferences):
+        # the stored `GlobalUserNotificationSetting` value, or None if the user has none stored
+        self.global_setting = global_setting
+        # {multi_notification_id: setting} of all stored `UserMultiNotificationPreference`s 
+        self.multi_settings = multi_settings
+        # a list of (group_id, notification_id) of all of the user's `UserNotificationPreference`s set to the
+        # digest setting, excluding the groups blanketed by another setting
+        self.group_preferences = group_preferences
+
+
+def load_digest_preferences(user_ids, digest_setting, portal_group_ids, portal=None):
+    """ Bulk-loads the notification preferences of many users for a digest run, with a few set-based queries
+        (chunked by users) instead of several queries per user.
+        @return: a dict of {user_id: `DigestUserPreferences`} """
+    from cosinnus_notifications.notifications import ALL_NOTIFICATIONS_ID, NO_NOTIFICATIONS_ID
+    if portal is None:
+        portal = CosinnusPortal.get_current()
+    user_ids = list(user_ids)
+    global_settings = get_global_notification_settings_for_users(user_ids, portal=portal)
+    multi_settings = UserMultiNotificationPreference.get_settings_for_users(user_ids, portal=portal)
+    
+    # only preferences set to this digest, and the blanketing ALL/NONE preferences are relevant
+    digest_preferences = defaultdict(list)
+    excluded_groups = defaultdict(set)
+    for user_id_chunk in chunked(user_ids):
+        preferences = UserNotificationPreference.objects.filter(user_id__in=user_id_chunk, group_id__in=portal_group_ids)\
+            .filter(Q(setting=digest_setting) | Q(notification_id__in=[ALL_NOTIFICATIONS_ID, NO_NOTIFICATIONS_ID]))\
+            .values_list('user_id', 'group_id', 'notification_id', 'setting')
+        for user_id, group_id, notification_id, setting in preferences:
+            # these groups will never get digest notifications because they have a blanketing NONE setting or 
+            # ALL setting (of anything but this ``digest_setting``)
+            if notification_id == NO_NOTIFICATIONS_ID or \
+                    (notification_id == ALL_NOTIFICATIONS_ID and setting != digest_setting):
+                excluded_groups[user_id].add(group_id)
+            elif setting == digest_setting:
+                digest_preferences[user_id].append((group_id, notification_id))
+    
+    return dict([
+        (user_id, DigestUserPreferences(
+            global_settings.get(user_id, None),
+            multi_settings.get(user_id, {}),
+            [(group_id, notification_id) for group_id, notification_id in digest_preferences[user_id]
+                if group_id not in excluded_groups[user_id]],
+        )) for user_id in user_ids
+    ])
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from array import array
+from collections import defaultdict
+from contextlib import contextmanager
+import heapq
+import json
+import logging
+import time
+
+from django.db import connection
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+logger = logging.getLogger('cosinnus')
+
+# the phases of a digest run, in pipeline order
+DIGEST_PHASES = (
+    'user_selection',
+    'preference_loading',
+    'event_selection',
+    'access_checks',
+    'dedup',
+    'item_rendering',
+    'group_rendering',
+    'mail_rendering',
+    'sending',
+)
+# time and queries outside of any phase
+OTHER_PHASE = 'other'
+
+# number of the slowest users kept for the summary
+DIGEST_SLOWEST_USER_SAMPLES = 10
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = min(int(round(percent / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class DigestRunProfiler(object):
+    """ Collects timings of a digest run: the exclusive wall time, number of calls and number of DB queries
+        for each of the `DIGEST_PHASES`, the latency of each user and samples of the slowest users.
+
+        Phases may be nested, time spent in an inner phase (e.g. rendering the items of a group block)
+        only counts for the inner phase. DB queries are only counted while `track_queries()` is active.
+        Not thread-safe: use one profiler per digest run. """
+
+    def __init__(self, slowest_user_samples=None):
+        self.slowest_user_samples = slowest_user_samples or DIGEST_SLOWEST_USER_SAMPLES
+        self.phase_seconds = defaultdict(float)
+        self.phase_calls = defaultdict(int)
+        self.phase_queries = defaultdict(int)
+        # stack of the currently active phases
+        self._phase_stack = []
+        self._phase_resumed_at = None
+        # latency of each finished user in seconds, in a compact array
+        self.user_latencies = array('d')
+        # min-heap of (seconds, user_id) of the slowest users
+        self._slowest_users = []
+        self._current_user_id = None
+        self._current_user_started_at = None
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    def _pause_current_phase(self, current_time):
+        if self._phase_stack:
+            self.phase_seconds[self._phase_stack[-1]] += current_time - self._phase_resumed_at
+
+    @contextmanager
+    def phase(self, name):
+        """ Context manager that attributes the time and queries inside of it to a phase """
+        current_time = time.monotonic()
+        self._pause_current_phase(current_time)
+        self._phase_stack.append(name)
+        self._phase_resumed_at = current_time
+        self.phase_calls[name] += 1
+        try:
+            yield
+        finally:
+            current_time = time.monotonic()
+            self._pause_current_phase(current_time)
+            self._phase_stack.pop()
+            self._phase_resumed_at = current_time
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.phase_queries[self._phase_stack[-1] if self._phase_stack else OTHER_PHASE] += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def track_queries(self):
+        """ Context manager that counts all DB queries inside of it for the active phase """
+        with connection.execute_wrapper(self._count_query):
+            yield
+
+    def start_user(self, user_id):
+        """ Starts measuring the latency of a user, ending the one of the previous user """
+        self.end_user()
+        self._current_user_id = user_id
+        self._current_user_started_at = time.monotonic()
+
+    def end_user(self):
+        """ Ends measuring the latency of the current user, if any """
+        if self._current_user_id is None:
+            return
+        seconds = time.monotonic() - self._current_user_started_at
+        self.user_latencies.append(seconds)
+        sample = (seconds, self._current_user_id)
+        if len(self._slowest_users) < self.slowest_user_samples:
+            heapq.heappush(self._slowest_users, sample)
+        elif sample > self._slowest_users[0]:
+            heapq.heapreplace(self._slowest_users, sample)
+        self._current_user_id = None
+
+    def finish(self):
+        self.end_user()
+        self.finished_at = time.monotonic()
+
+    def get_summary(self):
+        """ Returns all collected timings as a JSON-serializable dict """
+        total_seconds = (self.finished_at or time.monotonic()) - self.started_at
+        phases = {}
+        for name in list(DIGEST_PHASES) + sorted(set(self.phase_calls) - set(DIGEST_PHASES)):
+            phases[name] = {
+                'seconds': round(self.phase_seconds[name], 3),
+                'calls': self.phase_calls[name],
+                'queries': self.phase_queries[name],
+            }
+        phases[OTHER_PHASE] = {
+            'seconds': round(max(total_seconds - sum(self.phase_seconds.values()), 0.0), 3),
+            'calls': 0,
+            'queries': self.phase_queries[OTHER_PHASE],
+        }
+        latencies = sorted(self.user_latencies)
+        return {
+            'total_seconds': round(total_seconds, 3),
+            'total_queries': sum(self.phase_queries.values()),
+            'phases': phases,
+            'user_latency': {
+                'users': len(latencies),
+                'p50': _percentile(latencies, 50),
+                'p90': _percentile(latencies, 90),
+                'p99': _percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+                'mean': (sum(latencies) / len(latencies)) if latencies else None,
+            },
+            'slowest_users': [{'user_id': user_id, 'seconds': round(seconds, 3)}
+                              for seconds, user_id in sorted(self._slowest_users, reverse=True)],
+        }
+
+
+def merge_profile_summaries(summaries):
+    """ Merges the profile summaries of several parts of a digest run (e.g. worker shards) into one.
+        Phase timings and query counts are summed up, the user latency percentiles are those of the
+        slowest part, as exact percentiles can't be merged. The mean latency is weighted by each part's users. """
+    summaries = [summary for summary in summaries if summary]
+    merged = {
+        'total_seconds': max([summary['total_seconds'] for summary in summaries] or [0]),
+        'total_queries': sum([summary['total_queries'] for summary in summaries]),
+        'phases': {},
+        'user_latency': {'users': sum([summary['user_latency']['users'] for summary in summaries])},
+        'slowest_users': [],
+    }
+    for summary in summaries:
+        for name, phase in summary['phases'].items():
+            merged_phase = merged['phases'].setdefault(name, {'seconds': 0.0, 'calls': 0, 'queries': 0})
+            merged_phase['seconds'] = round(merged_phase['seconds'] + phase['seconds'], 3)
+            merged_phase['calls'] += phase['calls']
+            merged_phase['queries'] += phase['queries']
+        merged['slowest_users'].extend(summary['slowest_users'])
+    for key in ('p50', 'p90', 'p99', 'max'):
+        values = [summary['user_latency'][key] for summary in summaries if summary['user_latency'][key] is not None]
+        merged['user_latency'][key] = max(values) if values else None
+    user_count = merged['user_latency']['users']
+    merged['user_latency']['mean'] = sum([summary['user_latency']['mean'] * summary['user_latency']['users'] 
+                                          for summary in summaries if summary['user_latency']['mean'] is not None]) \
+            / user_count if user_count else None
+    merged['slowest_users'] = sorted(merged['slowest_users'], key=lambda sample: sample['seconds'],
+                                     reverse=True)[:DIGEST_SLOWEST_USER_SAMPLES]
+    return merged
+
+
+def write_profile_report(report_file, report):
+    """ Writes a digest run's profile report as JSON file """
+    try:
+        with open(report_file, 'w') as f:
+            json.dump(report, f, cls=DjangoJSONEncoder, indent=2, sort_keys=True)
+    except Exception as e:
+        logger.error('Could not write the digest profile report file!',
+                     extra={'exception': e, 'report_file': report_file})
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ A simple in-memory dict cache that holds at most `max_size` entries, evicting the least recently
+        used entry when full. Not thread-safe: use one instance per thread or process. """
+    
+    def __init__(self, max_size):
+        self.max_size = max(int(max_size), 1)
+        self._data = OrderedDict()
+        # stats, for logging
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+    
+    def get_or_set(self, key, value_func):
+        """ Returns the cached value for `key`, or calls `value_func()` and caches its result """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = value_func()
+            self.set(key, value)
+        return value
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, key):
+        return key in self._data
+
+
+_MISSING = object()
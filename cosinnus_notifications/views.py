@@ -150,6 +150,9 @@ class NotificationPreferenceView(ListView):
                             except UserNotificationPreference.DoesNotExist:
                                 pref = UserNotificationPreference.objects.create(user=request.user, group=group, notification_id=notification_id, setting=value)
         
+        # make sure the user's cached multi preferences are fresh after the transaction
+        UserMultiNotificationPreference.clear_cache_for_user(request.user.id, CosinnusPortal.get_current().id)
+        
         messages.success(request, self.message_success)
         return HttpResponseRedirect(self.success_url)
     